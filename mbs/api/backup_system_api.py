@@ -54,6 +54,18 @@ class BackupSystemApiServer(ApiServer):
             send_api_error("get-backup", e)
             return error_response(msg)
 
+    ###########################################################################
+    def get_plan_load_curve(self):
+        try:
+            load_curve = self.backup_system.get_plan_load_curve()
+            return document_pretty_string(load_curve)
+        except Exception, e:
+            msg = "Error while trying to get plan load curve: %s" % e
+            logger.error(msg)
+            logger.error(traceback.format_exc())
+            send_api_error("get-plan-load-curve", e)
+            return error_response(msg)
+
     ###########################################################################
     def get_backup_database_names(self, backup_id):
         try:
@@ -108,11 +120,13 @@ class BackupSystemApiServer(ApiServer):
         no_roles_restore = arg_json.get('noRolesRestore')
         tags = arg_json.get('tags')
         source_database_name = arg_json.get('sourceDatabaseName')
+        source_collection_names = arg_json.get('sourceCollectionNames')
         try:
             bs = self.backup_system
             r = bs.schedule_backup_restore(backup_id,
                                            destination_uri,
                                            source_database_name=source_database_name,
+                                           source_collection_names=source_collection_names,
                                            no_index_restore=no_index_restore,
                                            no_users_restore=no_users_restore,
                                            no_roles_restore=no_roles_restore,
@@ -158,6 +172,14 @@ class BackupSystemApiServer(ApiServer):
             response.headers["mbs-api-server"] = HOST_NAME
             return response
 
+        # build get plan load curve
+        @flask_server.route('/get-plan-load-curve', methods=['GET'])
+        @self.api_auth_service.auth("/get-plan-load-curve")
+        @crossdomain(origin='*')
+        @self.mbs_endpoint
+        def get_plan_load_curve_request():
+            return self.get_plan_load_curve()
+
         # build get backup database names
         @flask_server.route('/get-backup-database-names',
                             methods=['GET'])
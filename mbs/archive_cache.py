@@ -0,0 +1,212 @@
+__author__ = 'abdul'
+
+import os
+import time
+import errno
+import fcntl
+import shutil
+import logging
+
+from contextlib import contextmanager
+
+from base import MBSObject
+from utils import resolve_path, ensure_dir, which, execute_command
+
+###############################################################################
+# LOGGER
+###############################################################################
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+###############################################################################
+# CONSTANTS
+###############################################################################
+DEFAULT_CACHE_DIR = "~/.mbs/archive-cache"
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024 * 1024
+
+LOCK_FILE_NAME = ".lock"
+TEMP_PREFIX = ".tmp-"
+
+###############################################################################
+# ArchiveCache
+###############################################################################
+class ArchiveCache(MBSObject):
+    """
+        Size bounded on-disk cache of downloaded backup archives shared by the
+        task workers of an engine so that restoring the same backup again does
+        not download it again. Entries are keyed by the archive checksum
+        (archives without recorded checksums are not cached) and evicted least
+        recently used first. Files are hardlinked (or reflinked) between the
+        cache and restore workspaces, so the cache dir should be on the same
+        filesystem as the workspaces
+    """
+    ###########################################################################
+    def __init__(self):
+        MBSObject.__init__(self)
+        self._cache_dir = DEFAULT_CACHE_DIR
+        self._max_size = DEFAULT_MAX_SIZE
+
+    ###########################################################################
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @cache_dir.setter
+    def cache_dir(self, val):
+        self._cache_dir = val
+
+    ###########################################################################
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, val):
+        self._max_size = val
+
+    ###########################################################################
+    def get(self, file_reference, destination_path):
+        """
+            Links the cached archive of file_reference to destination_path.
+            Returns False if it is not cached
+        """
+        key = _cache_key(file_reference)
+        if not key:
+            return False
+
+        entry_path = self._entry_path(key)
+        try:
+            # the entry might be evicted concurrently
+            if os.path.getsize(entry_path) != file_reference.file_size:
+                logger.warning("ArchiveCache: size mismatch for '%s'. "
+                               "Ignoring cached file" % entry_path)
+                return False
+            _link_or_copy(entry_path, destination_path)
+            # recently used
+            os.utime(entry_path, None)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logger.error("ArchiveCache: error while getting '%s': %s" %
+                             (entry_path, e))
+            return False
+
+        logger.info("ArchiveCache: hit for '%s' (%s)" %
+                    (file_reference.file_path, key))
+        return True
+
+    ###########################################################################
+    def put(self, file_reference, file_path):
+        """
+            Adds the downloaded (verified) archive at file_path to the cache
+            then evicts least recently used entries beyond max_size. Never
+            fails the caller
+        """
+        key = _cache_key(file_reference)
+        size = os.path.getsize(file_path)
+        if not key or size > self.max_size:
+            return
+
+        try:
+            with self._lock():
+                entry_path = self._entry_path(key)
+                if not os.path.exists(entry_path):
+                    temp_path = self._entry_path(TEMP_PREFIX + key)
+                    # left behind by a worker that died while adding it
+                    _remove_if_exists(temp_path)
+                    _link_or_copy(file_path, temp_path)
+                    os.rename(temp_path, entry_path)
+                    logger.info("ArchiveCache: added '%s' (%s, %s bytes)" %
+                                (file_reference.file_path, key, size))
+                self._evict()
+        except Exception, e:
+            logger.exception("ArchiveCache: error while adding '%s': %s" %
+                             (file_path, e))
+
+    ###########################################################################
+    def _evict(self):
+        entries = []
+        total_size = 0
+        cache_dir = resolve_path(self.cache_dir)
+        for name in os.listdir(cache_dir):
+            if name.startswith(TEMP_PREFIX):
+                # temp files are only written under the lock (held by the
+                # caller) so any temp file is a leftover of a dead worker
+                logger.info("ArchiveCache: removing stale temp file '%s'" %
+                            name)
+                _remove_if_exists(os.path.join(cache_dir, name))
+                continue
+            if name.startswith("."):
+                continue
+            entry_stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((entry_stat.st_mtime, name, entry_stat.st_size))
+            total_size += entry_stat.st_size
+
+        for mtime, name, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.info("ArchiveCache: evicting '%s' (last used %s)" %
+                        (name, time.ctime(mtime)))
+            os.remove(os.path.join(cache_dir, name))
+            total_size -= size
+
+    ###########################################################################
+    @contextmanager
+    def _lock(self):
+        """
+            Serializes cache changes of the worker processes of the engine
+        """
+        cache_dir = resolve_path(self.cache_dir)
+        ensure_dir(cache_dir)
+        with open(os.path.join(cache_dir, LOCK_FILE_NAME), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    ###########################################################################
+    def _entry_path(self, key):
+        return os.path.join(resolve_path(self.cache_dir), key)
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        return {
+            "_type": "ArchiveCache",
+            "cacheDir": self.cache_dir,
+            "maxSize": self.max_size
+        }
+
+###############################################################################
+def _cache_key(file_reference):
+    return file_reference.sha256 or file_reference.md5
+
+###############################################################################
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+###############################################################################
+def _link_or_copy(source_path, destination_path):
+    """
+        Hardlinks source_path to destination_path. Falls back to a reflink
+        copy then a regular copy across filesystems
+    """
+    try:
+        os.link(source_path, destination_path)
+        return
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+
+    try:
+        execute_command([which("cp"), "--reflink=always", source_path,
+                         destination_path])
+        return
+    except Exception, e:
+        logger.info("ArchiveCache: could not reflink '%s': %s. Copying" %
+                    (source_path, e))
+
+    shutil.copyfile(source_path, destination_path)
@@ -25,6 +25,7 @@ class Backup(MBSTask):
         self._deleted_date = None
         self._data_stats = {}
         self._cluster_stats = None
+        self._upload_ledgers = None
 
 
 ###########################################################################
@@ -214,6 +215,18 @@ class Backup(MBSTask):
     def data_stats(self, val):
         self._data_stats = val
 
+    ###########################################################################
+    @property
+    def upload_ledgers(self):
+        """
+            UploadLedger of each target of an ongoing multi-part upload
+        """
+        return self._upload_ledgers
+
+    @upload_ledgers.setter
+    def upload_ledgers(self, val):
+        self._upload_ledgers = val
+
     ###########################################################################
     def to_document(self, display_only=False):
 
@@ -262,4 +275,9 @@ class Backup(MBSTask):
         if self.data_stats:
             doc["dataStats"] = self.data_stats
 
+        if self.upload_ledgers:
+            doc["uploadLedgers"] = \
+                map(lambda l: l.to_document(display_only=display_only),
+                    self.upload_ledgers)
+
         return doc
@@ -1,13 +1,22 @@
 __author__ = 'abdul'
 
 import os
+import bson
+import struct
 import shutil
 import logging
+import subprocess
+import tempfile
 
 from utils import ensure_dir, which, execute_command, execute_command_wrapper, listify, list_dir_subdirs
 import errors
 from subprocess import CalledProcessError
-from target import multi_target_upload_file
+from target import multi_target_upload_file, multi_target_upload_stream
+from target import ChunkManifestReference, IndexedArchiveReference, DEFAULT_DOWNLOAD_CONCURRENCY
+from compression import get_codec, tar_create_command, tar_extract_command
+from dedup import dedup_upload_dump, dedup_download_dump
+from indexed_archive import create_indexed_archive, read_archive_index, extract_indexed_archive
+from indexed_archive import SYSTEM_INDEXES_FILE_NAME
 from errors import MBSError, ExtractError, RestoreError
 from mongo_uri_tools import mask_mongo_uri
 from base import MBSObject
@@ -39,16 +48,57 @@ class BackupAssistant(MBSObject):
     def dump_backup(self, backup, uri, destination, log_file_name, options=None):
         pass
 
+    ####################################################################################################################
+    def merge_dump_log_files(self, backup, dump_dir, part_log_file_names, log_file_name):
+        """
+        Concatenates the logs of a parallel dump into log_file_name and removes the part logs
+        """
+        pass
+
     ####################################################################################################################
     def upload_backup_log_file(self, backup, file_name, dump_dir, target, destination_path=None):
         pass
 
     ####################################################################################################################
-    def tar_backup(self, backup, dump_dir, file_name):
+    def tar_backup(self, backup, dump_dir, file_name, codec=None):
+        """
+        Archives the dump dir using the specified compression codec (gzip by default)
+        """
+        pass
+
+    ####################################################################################################################
+    def indexed_archive_backup(self, backup, dump_dir, file_name):
+        """
+        Archives the dump dir as an indexed archive (see indexed_archive.py). Returns the archive index
+        """
+        pass
+
+    ####################################################################################################################
+    def read_indexed_archive_index(self, backup, file_name):
+        pass
+
+    ####################################################################################################################
+    def upload_backup(self, backup, file_name, target, destination_path=None, upload_ledgers=None):
         pass
 
     ####################################################################################################################
-    def upload_backup(self, backup, file_name, target, destination_path=None):
+    def stream_backup(self, backup, dump_dir, target, destination_path=None, codec=None):
+        """
+        Archives the dump dir and uploads it to target(s) in one pipe without writing an intermediate tar file. The
+        dump dir is kept; call delete_dump_dir() once the upload is recorded
+        """
+        pass
+
+    ####################################################################################################################
+    def dedup_upload_backup(self, backup, dump_dir, target, destination_path=None):
+        """
+        Uploads the dump dir to target(s) as deduplicated chunks plus a manifest at destination_path. The dump dir is
+        kept; call delete_dump_dir() once the upload is recorded
+        """
+        pass
+
+    ####################################################################################################################
+    def delete_dump_dir(self, backup, dump_dir):
         pass
 
     ####################################################################################################################
@@ -60,11 +110,26 @@ class BackupAssistant(MBSObject):
         pass
 
     ####################################################################################################################
-    def download_restore_source_backup(self, restore):
+    def download_restore_source_backup(self, restore, backup=None):
+        pass
+
+    ####################################################################################################################
+    def extract_restore_source_backup(self, restore, backup=None):
+        pass
+
+    ####################################################################################################################
+    def stream_restore_source_backup(self, restore, backup=None, members=None):
         pass
 
     ####################################################################################################################
-    def extract_restore_source_backup(self, restore):
+    def prepare_oplog_replay_dump(self, restore, dump_dir):
+        pass
+
+    ####################################################################################################################
+    def get_dump_collection_sizes(self, restore, dump_dir, source_database_name=None):
+        """
+        Returns the bson file size of each collection to be restored from the dump dir
+        """
         pass
 
     ####################################################################################################################
@@ -98,6 +163,8 @@ class LocalBackupAssistant(BackupAssistant):
     def __init__(self):
         super(LocalBackupAssistant, self).__init__()
         self._temp_dir = None
+        self._download_concurrency = None
+        self._archive_cache = None
 
     ####################################################################################################################
     @property
@@ -108,6 +175,30 @@ class LocalBackupAssistant(BackupAssistant):
     def temp_dir(self, val):
         self._temp_dir = val
 
+    ####################################################################################################################
+    @property
+    def download_concurrency(self):
+        """
+            Number of parallel ranged connections used to download restore source backups
+        """
+        return self._download_concurrency or DEFAULT_DOWNLOAD_CONCURRENCY
+
+    @download_concurrency.setter
+    def download_concurrency(self, val):
+        self._download_concurrency = val
+
+    ####################################################################################################################
+    @property
+    def archive_cache(self):
+        """
+            Optional ArchiveCache of downloaded restore source backups (see archive_cache.py)
+        """
+        return self._archive_cache
+
+    @archive_cache.setter
+    def archive_cache(self, val):
+        self._archive_cache = val
+
     ####################################################################################################################
     def create_task_workspace(self, task):
         """
@@ -168,6 +259,19 @@ class LocalBackupAssistant(BackupAssistant):
         if return_code:
             errors.raise_dump_error(return_code, last_error_line["line"])
 
+    ####################################################################################################################
+    def merge_dump_log_files(self, backup, dump_dir, part_log_file_names, log_file_name):
+        workspace = self.get_task_workspace_dir(backup)
+        log_path = os.path.join(workspace, dump_dir, log_file_name)
+        with open(log_path, "w") as log_file:
+            for part_log_file_name in part_log_file_names:
+                part_log_path = os.path.join(workspace, dump_dir, part_log_file_name)
+                if not os.path.exists(part_log_path):
+                    continue
+                with open(part_log_path) as part_log_file:
+                    shutil.copyfileobj(part_log_file, log_file)
+                os.remove(part_log_path)
+
     ####################################################################################################################
     def upload_backup_log_file(self, backup, file_name, dump_dir, target, destination_path=None):
         workspace = self.get_task_workspace_dir(backup)
@@ -175,10 +279,8 @@ class LocalBackupAssistant(BackupAssistant):
         return target.put_file(file_path, destination_path=destination_path)
 
     ####################################################################################################################
-    def tar_backup(self, backup, dump_dir, file_name):
-        tar_exe = which("tar")
-
-        tar_cmd = [tar_exe, "-cvzf", file_name, dump_dir]
+    def tar_backup(self, backup, dump_dir, file_name, codec=None):
+        tar_cmd = tar_create_command(codec, file_name, dump_dir)
         cmd_display = " ".join(tar_cmd)
         workspace = self.get_task_workspace_dir(backup)
         try:
@@ -189,16 +291,29 @@ class LocalBackupAssistant(BackupAssistant):
             last_log_line = e.output.split("\n")[-1]
             errors.raise_archive_error(e.returncode, last_log_line)
 
+    ####################################################################################################################
+    def indexed_archive_backup(self, backup, dump_dir, file_name):
+        workspace = self.get_task_workspace_dir(backup)
+        logger.info("Creating indexed archive %s of dump dir %s" % (file_name, dump_dir))
+        index = create_indexed_archive(os.path.join(workspace, dump_dir), os.path.join(workspace, file_name))
+        self._delete_dump_dir(backup, dump_dir)
+        return index
+
+    ####################################################################################################################
+    def read_indexed_archive_index(self, backup, file_name):
+        workspace = self.get_task_workspace_dir(backup)
+        return read_archive_index(os.path.join(workspace, file_name))
 
     ####################################################################################################################
-    def upload_backup(self, backup, file_name, target, destination_path=None):
+    def upload_backup(self, backup, file_name, target, destination_path=None, upload_ledgers=None):
         targets = listify(target)
         workspace = self.get_task_workspace_dir(backup)
         file_path = os.path.join(workspace, file_name)
         metadata = {
             "Content-Type": "application/x-compressed"
         }
-        uploaders = multi_target_upload_file(targets, file_path, destination_path=destination_path, metadata=metadata)
+        uploaders = multi_target_upload_file(targets, file_path, destination_path=destination_path, metadata=metadata,
+                                             upload_ledgers=upload_ledgers)
 
         errored_uploaders = filter(lambda uploader: uploader.error is not None,
                                    uploaders)
@@ -213,6 +328,58 @@ class LocalBackupAssistant(BackupAssistant):
         else:
             return target_references[0]
 
+    ####################################################################################################################
+    def stream_backup(self, backup, dump_dir, target, destination_path=None, codec=None):
+        targets = listify(target)
+        tar_cmd = tar_create_command(codec, "-", dump_dir, verbose=False)
+        cmd_display = " ".join(tar_cmd)
+        workspace = self.get_task_workspace_dir(backup)
+        metadata = {
+            "Content-Type": "application/x-compressed"
+        }
+
+        logger.info("Running tar command and streaming output to targets: %s" % cmd_display)
+        # stderr goes to a temp file so that a chatty tar would never block the pipe
+        tar_stderr = tempfile.TemporaryFile()
+        tar_process = subprocess.Popen(tar_cmd, cwd=workspace, stdout=subprocess.PIPE, stderr=tar_stderr)
+        try:
+            target_references = multi_target_upload_stream(targets, tar_process.stdout, destination_path,
+                                                           metadata=metadata)
+        except Exception:
+            if tar_process.poll() is None:
+                tar_process.kill()
+            tar_process.wait()
+            raise
+        finally:
+            tar_process.stdout.close()
+
+        return_code = tar_process.wait()
+        if return_code:
+            tar_stderr.seek(0)
+            last_log_line = tar_stderr.read().strip().split("\n")[-1]
+            for target, target_reference in zip(targets, target_references):
+                target.delete_file(target_reference)
+            errors.raise_archive_error(return_code, last_log_line)
+
+        if isinstance(target, list):
+            return target_references
+        else:
+            return target_references[0]
+
+    ####################################################################################################################
+    def dedup_upload_backup(self, backup, dump_dir, target, destination_path=None):
+        targets = listify(target)
+        workspace = self.get_task_workspace_dir(backup)
+        dump_dir_path = os.path.join(workspace, dump_dir)
+
+        logger.info("Uploading dump dir %s as dedup chunks to '%s'" % (dump_dir_path, destination_path))
+        target_references = dedup_upload_dump(dump_dir_path, targets, destination_path, workspace)
+
+        if isinstance(target, list):
+            return target_references
+        else:
+            return target_references[0]
+
     ####################################################################################################################
     def suspend_io(self, backup, mongo_connector, cloud_block_storage):
         cloud_block_storage.suspend_io()
@@ -221,6 +388,10 @@ class LocalBackupAssistant(BackupAssistant):
     def resume_io(self, backup, mongo_connector, cloud_block_storage):
         cloud_block_storage.resume_io()
 
+    ####################################################################################################################
+    def delete_dump_dir(self, backup, dump_dir):
+        self._delete_dump_dir(backup, dump_dir)
+
     ####################################################################################################################
     def _delete_dump_dir(self, backup, dump_dir):
         workspace = self.get_task_workspace_dir(backup)
@@ -239,26 +410,60 @@ class LocalBackupAssistant(BackupAssistant):
                          (backup.id, e))
 
     ####################################################################################################################
-    def download_restore_source_backup(self, restore):
-        backup = restore.source_backup
+    def download_restore_source_backup(self, restore, backup=None):
+        backup = backup or restore.source_backup
         workspace = self.get_task_workspace_dir(restore)
         file_reference = backup.target_reference
+        if isinstance(file_reference, ChunkManifestReference):
+            logger.info("Rebuilding restore '%s' dump from dedup manifest '%s'" %
+                        (restore.id, file_reference.file_name))
+            dedup_download_dump(backup.target, file_reference, workspace)
+            return
+
+        if isinstance(file_reference, IndexedArchiveReference):
+            # only the members of the restored database/collections are downloaded
+            database_names = restore.source_database_name and [restore.source_database_name]
+            logger.info("Extracting restore '%s' dump from indexed archive '%s' (databases: %s, collections: %s)" %
+                        (restore.id, file_reference.file_name, database_names or "all",
+                         restore.source_collection_names or "all"))
+            extract_indexed_archive(backup.target, file_reference, workspace, database_names=database_names,
+                                    collection_names=restore.source_collection_names)
+            return
+
+        archive_path = os.path.join(workspace, file_reference.file_name)
+        if self.archive_cache:
+            # a file left by a previous attempt might be a link to a cache entry. Never write through it
+            if os.path.exists(archive_path):
+                os.remove(archive_path)
+            if self.archive_cache.get(file_reference, archive_path):
+                logger.info("Restore '%s' dump tar file '%s' found in archive cache" %
+                            (restore.id, file_reference.file_name))
+                return
+
         logger.info("Downloading restore '%s' dump tar file '%s'" %
                     (restore.id, file_reference.file_name))
 
-        backup.target.get_file(file_reference, workspace)
+        backup.target.get_file(file_reference, workspace, concurrency=self.download_concurrency)
+
+        if self.archive_cache:
+            self.archive_cache.put(file_reference, archive_path)
 
     ####################################################################################################################
-    def extract_restore_source_backup(self, restore):
+    def extract_restore_source_backup(self, restore, backup=None):
         working_dir = self.get_task_workspace_dir(restore)
-        file_reference = restore.source_backup.target_reference
+        file_reference = (backup or restore.source_backup).target_reference
+        if isinstance(file_reference, ChunkManifestReference):
+            logger.info("Nothing to extract. Dump was rebuilt from dedup chunks")
+            return
+
+        if isinstance(file_reference, IndexedArchiveReference):
+            logger.info("Nothing to extract. Indexed archive members were extracted while downloading")
+            return
+
         logger.info("Extracting tar file '%s'" % file_reference.file_name)
 
-        tarx_cmd = [
-            which("tar"),
-            "-xf",
-            file_reference.file_name
-        ]
+        codec = get_codec(file_reference.compression)
+        tarx_cmd = tar_extract_command(codec, file_reference.file_name)
 
         logger.info("Running tar extract command: %s" % tarx_cmd)
         try:
@@ -267,6 +472,77 @@ class LocalBackupAssistant(BackupAssistant):
             logger.error("Failed to execute extract command: %s" % tarx_cmd)
             raise ExtractError(cause=cpe)
 
+    ####################################################################################################################
+    def stream_restore_source_backup(self, restore, backup=None, members=None):
+        """
+            Downloads the source backup archive straight into tar so that the archive is never written to disk and
+            download/extract overlap. members limits the extract to these archive paths
+        """
+        backup = backup or restore.source_backup
+        working_dir = self.get_task_workspace_dir(restore)
+        file_reference = backup.target_reference
+
+        codec = get_codec(file_reference.compression)
+        tarx_cmd = tar_extract_command(codec, "-", members=members)
+
+        logger.info("Streaming restore '%s' dump tar file '%s' into tar extract command: %s" %
+                    (restore.id, file_reference.file_name, tarx_cmd))
+
+        tar_process = subprocess.Popen(tarx_cmd, cwd=working_dir, stdin=subprocess.PIPE)
+        try:
+            backup.target.download_to_stream(file_reference, tar_process.stdin)
+        except Exception:
+            # a tar failure breaks the download pipe. Report the tar failure
+            self._wait_for_stream_extract(tar_process, tarx_cmd)
+            raise
+
+        self._wait_for_stream_extract(tar_process, tarx_cmd)
+
+    ####################################################################################################################
+    def _wait_for_stream_extract(self, tar_process, tarx_cmd):
+        try:
+            tar_process.stdin.close()
+        except IOError:
+            pass
+
+        returncode = tar_process.wait()
+        if returncode:
+            logger.error("Failed to execute extract command: %s" % tarx_cmd)
+            raise ExtractError(cause=CalledProcessError(returncode, tarx_cmd))
+
+    ####################################################################################################################
+    def prepare_oplog_replay_dump(self, restore, dump_dir):
+        """
+            Turns an oplog dump (dump_dir/local/oplog.rs.bson) into a dump that mongorestore --oplogReplay only
+            replays (dump_dir/oplog.bson)
+        """
+        workspace = self.get_task_workspace_dir(restore)
+        dump_dir_path = os.path.join(workspace, dump_dir)
+        local_dir_path = os.path.join(dump_dir_path, "local")
+        oplog_path = os.path.join(local_dir_path, "oplog.rs.bson")
+        if os.path.exists(oplog_path):
+            logger.info("Moving '%s' to oplog.bson for oplog replay" % oplog_path)
+            os.rename(oplog_path, os.path.join(dump_dir_path, "oplog.bson"))
+            # never restore the local db itself
+            shutil.rmtree(local_dir_path)
+
+    ####################################################################################################################
+    def get_dump_collection_sizes(self, restore, dump_dir, source_database_name=None):
+        source_dir = os.path.join(self.get_task_workspace_dir(restore), dump_dir)
+        if source_database_name:
+            source_dir = os.path.join(source_dir, source_database_name)
+
+        sizes = {}
+        for root, dirs, file_names in os.walk(source_dir):
+            for file_name in file_names:
+                # oplog.bson of --oplog dumps is replayed, not restored
+                if not file_name.endswith(".bson") or file_name == "oplog.bson" or file_name.startswith("system."):
+                    continue
+                file_path = os.path.join(root, file_name)
+                sizes[os.path.relpath(file_path, source_dir)[:-len(".bson")]] = os.path.getsize(file_path)
+
+        return sizes
+
     ####################################################################################################################
     def run_mongo_restore(self, restore, destination_uri, dump_dir, source_database_name,
                           log_file_name, dump_log_file_name,
@@ -295,6 +571,9 @@ class LocalBackupAssistant(BackupAssistant):
         if exclude_system_roles:
             self._delete_roles_from_dump(restore, source_dir)
 
+        if source_database_name and restore.source_collection_names:
+            self._delete_unselected_collections_from_dump(restore, source_dir)
+
         working_dir = workspace
         log_path = os.path.join(workspace, log_file_name)
 
@@ -355,6 +634,49 @@ class LocalBackupAssistant(BackupAssistant):
         logger.info("Deleting admin.system.roles collection")
         self._delete_collection_from_dump(restore, restore_source_dir, "admin", "system.roles")
 
+    ####################################################################################################################
+    def _delete_unselected_collections_from_dump(self, restore, restore_source_dir):
+        """
+        deletes the files of the collections that are not in restore.source_collection_names from the database dump
+        dir (indexed archives only extract selected collections. tar archives extract all of them)
+        """
+        workspace = self.get_task_workspace_dir(restore)
+        restore_source_path = os.path.join(workspace, restore_source_dir)
+        selected = set(restore.source_collection_names)
+
+        for file_name in os.listdir(restore_source_path):
+            # pre-3.0 dumps have the indexes of all collections in system.indexes
+            if file_name == SYSTEM_INDEXES_FILE_NAME:
+                self._filter_system_indexes_file(os.path.join(restore_source_path, file_name), selected)
+                continue
+            for extension in (".metadata.json", ".bson"):
+                if file_name.endswith(extension):
+                    if file_name[:-len(extension)] not in selected:
+                        logger.info("Deleting unselected collection file '%s'" % file_name)
+                        os.remove(os.path.join(restore_source_path, file_name))
+                    break
+
+    ####################################################################################################################
+    def _filter_system_indexes_file(self, system_indexes_path, collection_names):
+        """
+        rewrites a system.indexes.bson dump file with the index documents of collection_names only
+        """
+        logger.info("Filtering indexes of unselected collections out of '%s'" % system_indexes_path)
+        filtered_path = "%s.filtered" % system_indexes_path
+        with open(system_indexes_path, "rb") as in_file, open(filtered_path, "wb") as out_file:
+            while True:
+                header = in_file.read(4)
+                if not header:
+                    break
+                doc_size = struct.unpack("<i", header)[0]
+                raw_doc = header + in_file.read(doc_size - 4)
+                # ns is "<db>.<collection>"
+                ns = bson.BSON(raw_doc).decode().get("ns") or ""
+                if ns.partition(".")[2] in collection_names:
+                    out_file.write(raw_doc)
+
+        os.rename(filtered_path, system_indexes_path)
+
     ####################################################################################################################
     def _delete_collection_from_dump(self, restore, restore_source_dir, dbname, coll_name):
         workspace = self.get_task_workspace_dir(restore)
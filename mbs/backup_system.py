@@ -31,16 +31,19 @@ from plan import BackupPlan
 from schedule import AbstractSchedule, Schedule
 from retention.policy import RetentionPolicy
 from strategy import BackupStrategy
-from target import BackupTarget
+from target import BackupTarget, IndexedArchiveReference
 from source import BackupSource
 from datetime import datetime
 
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
 import persistence
 
 from flask import Flask
 from flask.globals import request
 from monitor import BackupMonitor
-from scheduler import BackupScheduler
+from scheduler import BackupScheduler, projected_plan_load_curve
 from task_utils import set_task_retry_info, trigger_task_finished_event
 
 from notification.handler import NotificationPriority, NotificationType
@@ -299,6 +302,8 @@ class BackupSystem(Thread):
                        event_name=EVENT_STATE_CHANGE,
                        message="Rescheduling")
 
+        self._signal_task_wakeup("backups", backup)
+
 
     ###########################################################################
     def reschedule_restore(self, restore, force=False):
@@ -327,10 +332,92 @@ class BackupSystem(Thread):
         rc.update_task(restore, properties=props,
                        event_name=EVENT_STATE_CHANGE,
                        message="Rescheduling")
+
+        self._signal_task_wakeup("restores", restore)
+
     ###########################################################################
     def schedule_plan_backup(self, plan, one_time=False):
         self.info("Scheduling plan '%s'" % plan.id)
 
+        backup = self.schedule_backup(**self._plan_backup_args(plan, one_time=one_time))
+
+        #  update the plans next occurrence
+        self._save_plan_next_occurrence(plan)
+
+        self._request_plan_retention(plan)
+
+        return backup
+
+    ###########################################################################
+    def schedule_plan_backups(self, plans):
+        """
+            Batch version of schedule_plan_backup() for plans that are due at
+            the same time. Backups are saved with one unordered bulk insert and
+            plan next occurrences with one bulk update.
+            Returns (backups, failed_plans) where failed_plans is a list of
+            (plan, exception) for plans whose backup could not be saved. The
+            next occurrence of these plans is not updated
+        """
+        self.info("Scheduling %s plans" % len(plans))
+        bc = get_mbs().backup_collection
+
+        backups = []
+        failed_plans = []
+        for plan in plans:
+            try:
+                backups.append(self._new_backup(**self._plan_backup_args(plan)))
+            except Exception, e:
+                msg = "Failed to schedule backup for plan '%s'" % plan.id
+                logger.exception(msg)
+                failed_plans.append((plan, BackupSchedulingError(msg=msg, cause=e)))
+
+        if not backups:
+            return [], failed_plans
+
+        backup_docs = [backup.to_document() for backup in backups]
+        write_errors = self._bulk_insert_backup_docs(backup_docs)
+
+        scheduled_backups = []
+        for i, (backup, backup_doc) in enumerate(zip(backups, backup_docs)):
+            if i in write_errors:
+                try:
+                    raise BackupSchedulingError(msg="Failed to save backup for plan '%s'" % backup.plan.id,
+                                                cause=write_errors[i])
+                except BackupSchedulingError, e:
+                    self._task_failed_to_schedule(backup, bc, e)
+                    failed_plans.append((backup.plan, e))
+            else:
+                backup.id = backup_doc["_id"]
+                scheduled_backups.append(backup)
+
+        # backups of scheduled plans are saved. From here on errors are only
+        # logged since reporting these plans as failed would schedule them again
+        scheduled_plans = [backup.plan for backup in scheduled_backups]
+        self._bulk_save_plans_next_occurrence(scheduled_plans)
+
+        for backup in scheduled_backups:
+            try:
+                if backup.state == State.FAILED:
+                    trigger_task_finished_event(backup, State.FAILED)
+
+                self._request_plan_retention(backup.plan)
+            except Exception:
+                logger.exception("Error while post-processing scheduled backup '%s' of plan '%s'" %
+                                 (backup.id, backup.plan.id))
+
+        self._signal_tasks_wakeup("backups", scheduled_backups)
+
+        self.info("Scheduled %s backups (%s plans failed)" % (len(scheduled_backups), len(failed_plans)))
+
+        return scheduled_backups, failed_plans
+
+    ###########################################################################
+    def _plan_backup_args(self, plan, one_time=False):
+        """
+            Returns the schedule_backup() args for a backup of plan. Moves the
+            plan next occurrence to the next natural occurrence unless
+            one_time
+        """
         plan_occurrence = None
         backup_plan = None
 
@@ -347,65 +434,20 @@ class BackupSystem(Thread):
         if not strategy.max_lag_seconds and plan_occurrence:
             strategy.max_lag_seconds = plan.schedule.max_acceptable_lag(plan_occurrence)
 
-        backup = self.schedule_backup(strategy=plan.strategy,
-                                      source=plan.source,
-                                      target=plan.target,
-                                      priority=plan.priority,
-                                      tags=tags,
-                                      plan_occurrence=plan_occurrence,
-                                      plan=backup_plan,
-                                      secondary_targets=plan.secondary_targets)
-
-        #  update the plans next occurrence
-        self._save_plan_next_occurrence(plan)
-
-        self._request_plan_retention(plan)
-
-        return backup
+        return dict(strategy=plan.strategy,
+                    source=plan.source,
+                    target=plan.target,
+                    priority=plan.priority,
+                    tags=tags,
+                    plan_occurrence=plan_occurrence,
+                    plan=backup_plan,
+                    secondary_targets=plan.secondary_targets)
 
     ###########################################################################
     def schedule_backup(self, **kwargs):
 
         try:
-            backup = Backup()
-            backup.created_date = date_now()
-            backup.strategy = get_validate_arg(kwargs, "strategy",
-                                               expected_type=BackupStrategy)
-            backup.source = get_validate_arg(kwargs, "source", BackupSource)
-            backup.target = get_validate_arg(kwargs, "target", BackupTarget)
-            backup.priority = get_validate_arg(kwargs, "priority",
-                                               expected_type=(int, long,
-                                                              float, complex),
-                                               required=False)
-            backup.plan_occurrence = \
-                get_validate_arg(kwargs, "plan_occurrence",
-                                 expected_type=datetime,
-                                 required=False)
-            backup.plan = get_validate_arg(kwargs, "plan",
-                                           expected_type=BackupPlan,
-                                           required=False)
-
-            backup.secondary_targets = get_validate_arg(kwargs,
-                                                        "secondary_targets",
-                                                        expected_type=list,
-                                                        required=False)
-
-            backup.change_state(State.SCHEDULED)
-            # set tags
-            tags = get_validate_arg(kwargs, "tags", expected_type=dict,
-                                    required=False)
-
-            backup.tags = tags
-
-            bc = get_mbs().backup_collection
-            try:
-                # resolve tags
-
-                self._resolve_task_tags(backup)
-            except Exception, ex:
-                self._task_failed_to_schedule(backup, bc, ex)
-
-            self.set_custom_backup_props(backup)
+            backup = self._new_backup(**kwargs)
 
             backup_doc = backup.to_document()
             get_mbs().backup_collection.save_document(backup_doc)
@@ -418,6 +460,8 @@ class BackupSystem(Thread):
             if backup.state == State.FAILED:
                 trigger_task_finished_event(backup, State.FAILED)
 
+            self._signal_task_wakeup("backups", backup)
+
             return backup
         except Exception, e:
             args_str = dict_to_str(kwargs)
@@ -426,6 +470,111 @@ class BackupSystem(Thread):
             logger.error(traceback.format_exc())
             raise BackupSchedulingError(msg=msg, cause=e)
 
+    ###########################################################################
+    def _new_backup(self, **kwargs):
+        """
+            Returns a new (unsaved) scheduled backup for schedule_backup()
+            kwargs
+        """
+        backup = Backup()
+        backup.created_date = date_now()
+        backup.strategy = get_validate_arg(kwargs, "strategy",
+                                           expected_type=BackupStrategy)
+        backup.source = get_validate_arg(kwargs, "source", BackupSource)
+        backup.target = get_validate_arg(kwargs, "target", BackupTarget)
+        backup.priority = get_validate_arg(kwargs, "priority",
+                                           expected_type=(int, long,
+                                                          float, complex),
+                                           required=False)
+        backup.plan_occurrence = \
+            get_validate_arg(kwargs, "plan_occurrence",
+                             expected_type=datetime,
+                             required=False)
+        backup.plan = get_validate_arg(kwargs, "plan",
+                                       expected_type=BackupPlan,
+                                       required=False)
+
+        backup.secondary_targets = get_validate_arg(kwargs,
+                                                    "secondary_targets",
+                                                    expected_type=list,
+                                                    required=False)
+
+        backup.change_state(State.SCHEDULED)
+        # set tags
+        tags = get_validate_arg(kwargs, "tags", expected_type=dict,
+                                required=False)
+
+        backup.tags = tags
+
+        bc = get_mbs().backup_collection
+        try:
+            # resolve tags
+
+            self._resolve_task_tags(backup)
+        except Exception, ex:
+            self._task_failed_to_schedule(backup, bc, ex)
+
+        self.set_custom_backup_props(backup)
+
+        return backup
+
+    ###########################################################################
+    def _bulk_insert_backup_docs(self, backup_docs):
+        """
+            Inserts backup_docs with an unordered bulk insert (the _id of each
+            inserted doc is set). Returns {index: error} of the docs that were
+            not inserted
+        """
+        try:
+            get_mbs().backup_collection.collection.insert_many(backup_docs, ordered=False)
+            return {}
+        except BulkWriteError, e:
+            write_errors = e.details.get("writeErrors") or []
+            logger.error("%s of %s backups failed to insert: %s" %
+                         (len(write_errors), len(backup_docs), write_errors))
+            return dict((write_error["index"], BackupSystemError(write_error.get("errmsg")))
+                        for write_error in write_errors)
+        except Exception, e:
+            logger.exception("Bulk insert of %s backups failed" % len(backup_docs))
+            return self._find_uninserted_backup_docs(backup_docs, e)
+
+    ###########################################################################
+    def _find_uninserted_backup_docs(self, backup_docs, error):
+        """
+            Returns {index: error} of backup_docs that are not in the backups
+            collection after an insert failed midway (e.g. on a reconnect)
+        """
+        # insert_many() sets the _id of the docs before sending them
+        doc_ids = [backup_doc.get("_id") for backup_doc in backup_docs]
+        try:
+            cursor = get_mbs().backup_collection.collection.find({"_id": {"$in": doc_ids}}, {"_id": 1})
+            inserted_ids = set(doc["_id"] for doc in cursor)
+        except Exception:
+            logger.exception("Could not find which backups were inserted. Assuming none")
+            inserted_ids = set()
+
+        return dict((i, error) for i, doc_id in enumerate(doc_ids)
+                    if doc_id is None or doc_id not in inserted_ids)
+
+    ###########################################################################
+    def _bulk_save_plans_next_occurrence(self, plans):
+        if not plans:
+            return
+
+        updates = [UpdateOne({"_id": plan.id}, {"$set": {"nextOccurrence": plan.next_occurrence}})
+                   for plan in plans]
+        try:
+            get_mbs().plan_collection.collection.bulk_write(updates, ordered=False)
+        except BulkWriteError, e:
+            # backups of these plans were saved so there is nothing to report
+            # back. They get scheduled again when the plan is next processed
+            logger.error("Failed to update next occurrence of plans: %s" % e.details.get("writeErrors"))
+        except Exception:
+            logger.exception("Failed to update next occurrence of %s plans" % len(plans))
+
+        for plan in plans:
+            self._scheduler.plan_updated(plan)
+
     ###########################################################################
     def set_custom_backup_props(self, backup):
         pass
@@ -482,6 +631,10 @@ class BackupSystem(Thread):
             plan.tags = get_validate_arg(kwargs, "tags", expected_type=dict,
                                          required=False)
 
+            plan.spread_window_in_seconds = get_validate_arg(kwargs, "spread_window_in_seconds",
+                                                             expected_type=(int, long),
+                                                             required=False)
+
             plan_doc = plan.to_document()
             get_mbs().plan_collection.save_document(plan_doc)
             # set the backup plan id from the saved doc
@@ -513,6 +666,7 @@ class BackupSystem(Thread):
             }
         }
         get_mbs().plan_collection.update(spec=q, document=u)
+        self._scheduler.plan_updated(plan)
 
     ###########################################################################
     def save_plan(self, plan):
@@ -538,6 +692,7 @@ class BackupSystem(Thread):
                 plan_doc = plan.to_document()
                 get_mbs().plan_collection.save_document(plan_doc)
                 plan.id = plan_doc["_id"]
+                self._scheduler.plan_updated(plan)
                 self.info("Plan saved successfully")
             else:
                 self.info("Updating plan: \n%s" % plan)
@@ -552,7 +707,9 @@ class BackupSystem(Thread):
     ###########################################################################
     def update_existing_plan(self, plan):
         # TODO XXX remove the pymongo collection save call because it is deprecated
-        return get_mbs().plan_collection.collection.save(plan.to_document())
+        result = get_mbs().plan_collection.collection.save(plan.to_document())
+        self._scheduler.plan_updated(plan)
+        return result
 
     ###########################################################################
     def remove_plan(self, plan_id):
@@ -563,6 +720,7 @@ class BackupSystem(Thread):
             get_mbs().deleted_plan_collection.save_document(plan.to_document())
             logger.info("Removing plan '%s' from plans" % plan_id)
             get_mbs().plan_collection.remove_by_id(plan_id)
+            self._scheduler.plan_removed(plan.id)
             return True
         else:
             logger.info("No such plan '%s'" % plan_id)
@@ -574,6 +732,15 @@ class BackupSystem(Thread):
         if self.backup_expiration_manager:
             self.backup_expiration_manager.request_plan_retention(plan)
 
+    ###########################################################################
+    def get_plan_load_curve(self):
+        """
+            Returns the projected number of plan occurrences per minute (next
+            occurrences of all plans) and the spread window needed to keep it
+            within the configured capacity
+        """
+        return projected_plan_load_curve()
+
     ###########################################################################
     def get_backup_database_names(self, backup_id):
         """
@@ -581,6 +748,11 @@ class BackupSystem(Thread):
         """
         backup = persistence.get_backup(backup_id)
 
+        # indexed archives record the databases they contain
+        if backup and isinstance(backup.target_reference, IndexedArchiveReference) and \
+                backup.target_reference.database_names is not None:
+            return backup.target_reference.database_names
+
         if backup and backup.source_stats:
             if "databaseName" in backup.source_stats:
                 return [backup.source_stats["databaseName"]]
@@ -590,7 +762,10 @@ class BackupSystem(Thread):
     ###########################################################################
     def schedule_backup_restore(self, backup_id, destination_uri,tags=None,
                                 no_index_restore=None, no_users_restore=None, no_roles_restore=None,
-                                source_database_name=None):
+                                source_database_name=None, source_collection_names=None):
+        if source_collection_names and not source_database_name:
+            raise ConfigurationError("sourceCollectionNames requires sourceDatabaseName")
+
         backup = get_mbs().backup_collection.get_by_id(backup_id)
         destination = build_backup_source(destination_uri)
         logger.info("Scheduling a restore for backup '%s'" % backup.id)
@@ -599,6 +774,7 @@ class BackupSystem(Thread):
         restore.state = State.SCHEDULED
         restore.source_backup = backup
         restore.source_database_name = source_database_name
+        restore.source_collection_names = source_collection_names
         restore.strategy = backup.strategy
         restore.strategy.no_index_restore = no_index_restore
         restore.strategy.no_users_restore = no_users_restore
@@ -621,8 +797,29 @@ class BackupSystem(Thread):
         rc.save_document(restore_doc)
         restore.id = restore_doc["_id"]
 
+        self._signal_task_wakeup("restores", restore)
+
         return restore
 
+    ###########################################################################
+    def _signal_task_wakeup(self, task_collection_name, task):
+        """
+            Wakes up engines waiting on the task wakeup channel (if
+            configured) so that newly scheduled tasks get picked up right away
+            instead of on the next poll
+        """
+        self._signal_tasks_wakeup(task_collection_name, [task])
+
+    ###########################################################################
+    def _signal_tasks_wakeup(self, task_collection_name, tasks):
+        """
+            Batch version of _signal_task_wakeup(). Signals once for all tasks
+        """
+        channel = get_mbs().task_wakeup_channel
+        scheduled_tasks = [task for task in tasks if task.state == State.SCHEDULED]
+        if channel and scheduled_tasks:
+            channel.signal_tasks(task_collection_name, scheduled_tasks)
+
     ###########################################################################
     def get_current_restore_by_destination(self, destination_uri):
         destination = build_backup_source(destination_uri)
@@ -0,0 +1,376 @@
+__author__ = 'abdul'
+
+import os
+import time
+import errno
+import heapq
+import socket
+import logging
+import itertools
+import threading
+
+from threading import Thread, Condition
+
+from base import MBSObject
+from utils import resolve_path, ensure_dir
+from errors import ConfigurationError
+
+###############################################################################
+# LOGGER
+###############################################################################
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+###############################################################################
+# CONSTANTS
+###############################################################################
+DEFAULT_SOCKET_PATH = "~/.mbs/bandwidth-governor.sock"
+
+# bytes drawn from the engine per request. Smaller transfers are accounted
+# locally so that they do not cost a round-trip each
+DEFAULT_GRANT_SIZE = 1024 * 1024
+
+# task type name => priority. Lower priorities are served first so restores
+# preempt backups
+DEFAULT_PRIORITIES = {
+    "Restore": 0,
+    "Backup": 10
+}
+
+DEFAULT_PRIORITY = 10
+
+# how long workers go unthrottled after failing to reach the engine
+RECONNECT_INTERVAL = 30
+
+###############################################################################
+# TokenBucket
+###############################################################################
+class TokenBucket(object):
+    """
+        Token bucket filled at rate bytes per second up to burst bytes.
+        Waiting acquirers are served by priority (lowest first) then in
+        arrival order so higher priority transfers get the bandwidth as soon
+        as the current grant is done
+    """
+    ###########################################################################
+    def __init__(self, rate, burst=None):
+        self._rate = float(rate)
+        self._burst = burst or rate
+        self._tokens = float(self._burst)
+        self._last_refill = time.time()
+        self._waiters = []
+        self._counter = itertools.count()
+        self._condition = Condition()
+
+    ###########################################################################
+    def acquire(self, nbytes, priority=DEFAULT_PRIORITY):
+        """
+            Blocks until nbytes (capped at burst) can be transferred
+        """
+        nbytes = min(nbytes, self._burst)
+        with self._condition:
+            waiter = (priority, next(self._counter))
+            heapq.heappush(self._waiters, waiter)
+            try:
+                while True:
+                    self._refill()
+                    if self._waiters[0] == waiter:
+                        if self._tokens >= nbytes:
+                            self._tokens -= nbytes
+                            return
+                        timeout = (nbytes - self._tokens) / self._rate
+                    else:
+                        timeout = None
+                    self._condition.wait(timeout)
+            finally:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+    ###########################################################################
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self._burst, self._tokens +
+                           (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+###############################################################################
+# BandwidthGovernor
+###############################################################################
+class BandwidthGovernor(MBSObject):
+    """
+        Engine wide upload/download bandwidth budget shared by all task
+        workers of the engine. The engine serves a token bucket over a local
+        unix socket (see BandwidthGovernorServer) and workers draw the bytes
+        they transfer from it, restores before backups by default (see
+        priorities)
+    """
+    ###########################################################################
+    def __init__(self):
+        MBSObject.__init__(self)
+        self._max_bytes_per_second = None
+        self._burst_bytes = None
+        self._socket_path = DEFAULT_SOCKET_PATH
+        self._grant_size = DEFAULT_GRANT_SIZE
+        self._priorities = None
+        self._priority = DEFAULT_PRIORITY
+        self._client = None
+
+    ###########################################################################
+    @property
+    def max_bytes_per_second(self):
+        return self._max_bytes_per_second
+
+    @max_bytes_per_second.setter
+    def max_bytes_per_second(self, val):
+        self._max_bytes_per_second = val
+
+    ###########################################################################
+    @property
+    def burst_bytes(self):
+        """
+            Max bytes transferred at once after an idle period. Defaults to
+            one second worth of bandwidth
+        """
+        return self._burst_bytes or max(self.max_bytes_per_second,
+                                        self.grant_size)
+
+    @burst_bytes.setter
+    def burst_bytes(self, val):
+        self._burst_bytes = val
+
+    ###########################################################################
+    @property
+    def socket_path(self):
+        return self._socket_path
+
+    @socket_path.setter
+    def socket_path(self, val):
+        self._socket_path = val
+
+    ###########################################################################
+    @property
+    def grant_size(self):
+        return self._grant_size
+
+    @grant_size.setter
+    def grant_size(self, val):
+        self._grant_size = val
+
+    ###########################################################################
+    @property
+    def priorities(self):
+        """
+            Task type name => priority. Lower priorities are served first
+        """
+        return self._priorities or DEFAULT_PRIORITIES
+
+    @priorities.setter
+    def priorities(self, val):
+        self._priorities = val
+
+    ###########################################################################
+    def set_task(self, task):
+        """
+            Sets the priority of the transfers of this (worker) process to the
+            priority of task
+        """
+        self._priority = self.priorities.get(task.type_name,
+                                             DEFAULT_PRIORITY)
+
+    ###########################################################################
+    def throttle(self, nbytes):
+        """
+            Blocks until nbytes can be transferred within the engine budget
+        """
+        if not self.max_bytes_per_second:
+            return
+
+        if self._client is None:
+            self._client = BandwidthClient(resolve_path(self.socket_path),
+                                           self.grant_size)
+        self._client.throttle(nbytes, self._priority)
+
+    ###########################################################################
+    def start_server(self):
+        server = BandwidthGovernorServer(self)
+        server.listen()
+        server.start()
+        return server
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        doc = {
+            "_type": "BandwidthGovernor",
+            "maxBytesPerSecond": self.max_bytes_per_second,
+            "socketPath": self.socket_path,
+            "grantSize": self.grant_size
+        }
+
+        if self._burst_bytes:
+            doc["burstBytes"] = self._burst_bytes
+
+        if self._priorities:
+            doc["priorities"] = self._priorities
+
+        return doc
+
+###############################################################################
+# BandwidthGovernorServer
+###############################################################################
+class BandwidthGovernorServer(Thread):
+    """
+        Serves the governor token bucket to the workers of the engine. Each
+        request is a "<bytes> <priority>" line answered with an empty line
+        once the bytes have been granted
+    """
+    ###########################################################################
+    def __init__(self, governor):
+        Thread.__init__(self)
+        self.daemon = True
+        self._socket_path = resolve_path(governor.socket_path)
+        self._bucket = TokenBucket(governor.max_bytes_per_second,
+                                   governor.burst_bytes)
+        self._socket = None
+        self._stopped = False
+
+    ###########################################################################
+    def listen(self):
+        ensure_dir(os.path.dirname(self._socket_path))
+        if os.path.exists(self._socket_path):
+            if _is_socket_served(self._socket_path):
+                raise ConfigurationError(
+                    "Another bandwidth governor is already listening at '%s'"
+                    % self._socket_path)
+            # left behind by an engine that did not shut down cleanly
+            logger.info("Removing stale bandwidth governor socket '%s'" %
+                        self._socket_path)
+            os.remove(self._socket_path)
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self._socket_path)
+        self._socket.listen(128)
+        # so that stop() is noticed
+        self._socket.settimeout(1)
+        logger.info("Bandwidth governor listening at '%s'" %
+                    self._socket_path)
+
+    ###########################################################################
+    def run(self):
+        while not self._stopped:
+            try:
+                conn, _ = self._socket.accept()
+            except socket.timeout:
+                continue
+            except Exception, e:
+                if not self._stopped:
+                    logger.error("Bandwidth governor: error while accepting "
+                                 "connection: %s" % e)
+                continue
+
+            conn.settimeout(None)
+            handler = Thread(target=self._serve, args=(conn,))
+            handler.daemon = True
+            handler.start()
+
+    ###########################################################################
+    def _serve(self, conn):
+        try:
+            for line in conn.makefile("rb"):
+                nbytes, priority = map(int, line.split())
+                self._bucket.acquire(nbytes, priority)
+                conn.sendall("\n")
+        except Exception, e:
+            logger.info("Bandwidth governor: worker connection closed: %s" %
+                        e)
+        finally:
+            conn.close()
+
+    ###########################################################################
+    def stop(self):
+        self._stopped = True
+        try:
+            if self._socket:
+                self._socket.close()
+            if os.path.exists(self._socket_path):
+                os.remove(self._socket_path)
+        except Exception, e:
+            logger.error("Bandwidth governor: error while stopping: %s" % e)
+
+###############################################################################
+def _is_socket_served(socket_path):
+    """
+        True if a server accepts connections at the unix socket socket_path
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(1)
+    try:
+        conn.connect(socket_path)
+        return True
+    except socket.error, e:
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            return False
+        raise
+    finally:
+        conn.close()
+
+###############################################################################
+# BandwidthClient
+###############################################################################
+class BandwidthClient(object):
+    """
+        Draws bytes from the engine governor server. Each thread has its own
+        connection and accounts its transfers locally, requesting grant_size
+        bytes at a time. Never fails a transfer: when the engine cannot be
+        reached, transfers are not throttled for RECONNECT_INTERVAL seconds
+    """
+    ###########################################################################
+    def __init__(self, socket_path, grant_size):
+        self._socket_path = socket_path
+        self._grant_size = grant_size
+        self._local = threading.local()
+        self._unavailable_until = 0
+
+    ###########################################################################
+    def throttle(self, nbytes, priority):
+        local = self._local
+        local.pending = getattr(local, "pending", 0) + nbytes
+        while local.pending >= self._grant_size:
+            local.pending -= self._grant_size
+            self._request(self._grant_size, priority)
+
+    ###########################################################################
+    def _request(self, nbytes, priority):
+        if time.time() < self._unavailable_until:
+            return
+
+        try:
+            conn = self._get_connection()
+            conn.sendall("%d %d\n" % (nbytes, priority))
+            if not conn.recv(1):
+                raise socket.error("Connection closed by engine")
+        except (socket.error, IOError), e:
+            logger.warning("Bandwidth governor at '%s' is unavailable. Not "
+                           "throttling for %s seconds: %s" %
+                           (self._socket_path, RECONNECT_INTERVAL, e))
+            self._close_connection()
+            self._unavailable_until = time.time() + RECONNECT_INTERVAL
+
+    ###########################################################################
+    def _get_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(self._socket_path)
+            self._local.conn = conn
+        return conn
+
+    ###########################################################################
+    def _close_connection(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
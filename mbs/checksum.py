@@ -0,0 +1,238 @@
+__author__ = 'abdul'
+
+import os
+import re
+import base64
+import hashlib
+import logging
+import binascii
+
+from threading import Condition
+
+import errors
+
+###############################################################################
+# LOGGER
+###############################################################################
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+###############################################################################
+# CONSTANTS
+###############################################################################
+READ_SIZE = 1024 * 1024
+
+###############################################################################
+# FileChecksum
+###############################################################################
+class FileChecksum(object):
+    """
+        MD5 and SHA-256 of a file computed incrementally over the bytes as
+        they are uploaded (or downloaded) so that the file is not read again
+        to checksum it. Parts read by concurrent uploaders are passed to
+        update_at() which hashes them in file order
+    """
+    ###########################################################################
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256()
+        self._size = 0
+        self._etag = None
+        self._aborted = False
+        self._condition = Condition()
+
+    ###########################################################################
+    @property
+    def size(self):
+        """
+            Number of bytes hashed so far
+        """
+        return self._size
+
+    ###########################################################################
+    @property
+    def md5(self):
+        return self._md5.hexdigest()
+
+    ###########################################################################
+    @property
+    def md5_base64(self):
+        """
+            Base64 md5 digest (Content-MD5 header value)
+        """
+        return base64.b64encode(self._md5.digest())
+
+    ###########################################################################
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+    ###########################################################################
+    @property
+    def etag(self):
+        """
+            Provider etag of the upload verified by verify_upload_etag()
+        """
+        return self._etag
+
+    ###########################################################################
+    def update(self, data):
+        self._md5.update(data)
+        self._sha256.update(data)
+        self._size += len(data)
+
+    ###########################################################################
+    def update_at(self, offset, data):
+        """
+            Hashes data (the bytes of the file at offset) once all bytes
+            before offset have been hashed
+        """
+        with self._condition:
+            while self._size < offset and not self._aborted:
+                self._condition.wait()
+
+            if self._aborted:
+                raise errors.MBSError("Checksum computation was aborted")
+            if self._size != offset:
+                raise errors.MBSError("Bytes at offset %s have already been "
+                                      "hashed" % offset)
+
+            self.update(data)
+            self._condition.notify_all()
+
+    ###########################################################################
+    def abort(self):
+        """
+            Wakes up update_at() callers waiting for bytes that will never be
+            hashed (e.g. the uploader reading them failed)
+        """
+        with self._condition:
+            self._aborted = True
+            self._condition.notify_all()
+
+    ###########################################################################
+    def update_from_file(self, file_path, end):
+        """
+            Hashes the bytes of file_path between the bytes hashed so far and
+            end. Used for parts that do not have to be uploaded again (e.g.
+            parts of a resumed upload)
+        """
+        with self._condition:
+            with open(file_path, "rb") as file_obj:
+                file_obj.seek(self._size)
+                remaining = end - self._size
+                while remaining > 0:
+                    data = file_obj.read(min(READ_SIZE, remaining))
+                    if not data:
+                        break
+                    self.update(data)
+                    remaining -= len(data)
+            self._condition.notify_all()
+
+    ###########################################################################
+    def verify_upload_etag(self, etag, destination_path, container_name,
+                           expected_etag=None):
+        """
+            Raises UploadedFileChecksumMismatchError if the etag returned by
+            the provider for the upload does not match expected_etag (the md5
+            of the bytes hashed by default)
+        """
+        expected_etag = expected_etag or self.md5
+        if not same_etag(etag, expected_etag):
+            raise errors.UploadedFileChecksumMismatchError(
+                destination_path=destination_path,
+                container_name=container_name,
+                dest_etag=etag, expected_etag=expected_etag)
+
+        self._etag = etag
+
+    ###########################################################################
+    def verify(self, file_reference, container_name=None):
+        """
+            Raises DownloadedFileChecksumMismatchError if the bytes hashed do
+            not match the checksums recorded in file_reference. References
+            without checksums (uploaded before checksums were recorded) are
+            not verified
+        """
+        for name, expected, actual in [("sha256", file_reference.sha256,
+                                        self.sha256),
+                                       ("md5", file_reference.md5,
+                                        self.md5)]:
+            if expected and expected != actual:
+                raise errors.DownloadedFileChecksumMismatchError(
+                    file_path=file_reference.file_path,
+                    container_name=container_name,
+                    checksum_name=name, expected=expected, actual=actual)
+
+###############################################################################
+def checksum_file(file_path):
+    checksum = FileChecksum()
+    checksum.update_from_file(file_path, os.path.getsize(file_path))
+    return checksum
+
+###############################################################################
+def iter_checksummed(file_obj, checksum, read_size=READ_SIZE):
+    """
+        Yields the data of file_obj hashing it with checksum
+    """
+    data = file_obj.read(read_size)
+    while data:
+        checksum.update(data)
+        yield data
+        data = file_obj.read(read_size)
+
+###############################################################################
+# ChecksumWriter
+###############################################################################
+class ChecksumWriter(object):
+    """
+        File object wrapper that checksums the bytes written through it
+    """
+    ###########################################################################
+    def __init__(self, file_obj, checksum=None):
+        self._file_obj = file_obj
+        self._checksum = checksum or FileChecksum()
+
+    ###########################################################################
+    @property
+    def checksum(self):
+        return self._checksum
+
+    ###########################################################################
+    def write(self, data):
+        self._checksum.update(data)
+        self._file_obj.write(data)
+
+    ###########################################################################
+    def __getattr__(self, name):
+        return getattr(self._file_obj, name)
+
+###############################################################################
+# ETags
+###############################################################################
+def normalize_etag(etag):
+    return etag and etag.strip('"').lower()
+
+###############################################################################
+def same_etag(etag1, etag2):
+    return etag1 is not None and etag2 is not None and \
+           normalize_etag(etag1) == normalize_etag(etag2)
+
+###############################################################################
+def is_md5_etag(etag):
+    """
+        True for etags that are the md5 of the whole file (single part
+        uploads)
+    """
+    return bool(etag and re.match('^"?[a-fA-F0-9]{32}"?$', etag))
+
+###############################################################################
+def s3_multipart_etag(part_etags):
+    """
+        ETag S3 gives to a multi-part upload of parts with part_etags (the
+        md5 of each part, in part order): the md5 of the concatenated binary
+        part md5s followed by the number of parts
+    """
+    digests = "".join(binascii.unhexlify(normalize_etag(etag))
+                      for etag in part_etags)
+    return '"%s-%d"' % (hashlib.md5(digests).hexdigest(), len(part_etags))
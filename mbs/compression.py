@@ -0,0 +1,344 @@
+__author__ = 'abdul'
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+
+from base import MBSObject
+from errors import MBSError
+from utils import which, execute_command
+
+###############################################################################
+# LOGGER
+###############################################################################
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+###############################################################################
+# CompressionCodec
+###############################################################################
+class CompressionCodec(MBSObject):
+    """
+        Compression used for backup archives. Codecs plug an external
+        compressor into tar through --use-compress-program. On extract, tar
+        runs the decompress program with "-d"
+    """
+    ###########################################################################
+    def __init__(self):
+        MBSObject.__init__(self)
+        self._level = None
+
+    ###########################################################################
+    @property
+    def name(self):
+        """
+            Codec name stored in file references. Must be overridden
+        """
+
+    ###########################################################################
+    @property
+    def file_extension(self):
+        return "tgz"
+
+    ###########################################################################
+    @property
+    def level(self):
+        return self._level
+
+    @level.setter
+    def level(self, val):
+        self._level = val
+
+    ###########################################################################
+    def compress_program(self):
+        """
+            Compress command (with args) passed to tar. None means tar's
+            builtin gzip (-z)
+        """
+        return None
+
+    ###########################################################################
+    def decompress_program(self):
+        """
+            Decompress program passed to tar. None lets tar detect
+            the compression
+        """
+        return None
+
+    ###########################################################################
+    def tar_create_options(self):
+        program = self.compress_program()
+        if program:
+            return ["--use-compress-program=%s" % program]
+        else:
+            return ["-z"]
+
+    ###########################################################################
+    def tar_extract_options(self):
+        program = self.decompress_program()
+        if program:
+            return ["--use-compress-program=%s" % program]
+        else:
+            return []
+
+    ###########################################################################
+    def tar_stream_extract_options(self):
+        """
+            Extract options for archives read from a pipe. tar cannot detect
+            the compression of a pipe so gzip is assumed when the codec has
+            no decompress program
+        """
+        return self.tar_extract_options() or ["-z"]
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        doc = {
+            "_type": self.type_name
+        }
+
+        if self.level is not None:
+            doc["level"] = self.level
+
+        return doc
+
+###############################################################################
+# GzipCodec
+###############################################################################
+class GzipCodec(CompressionCodec):
+    """
+        Single threaded gzip. Default codec
+    """
+    ###########################################################################
+    @property
+    def name(self):
+        return "gzip"
+
+    ###########################################################################
+    def compress_program(self):
+        if self.level is not None:
+            return "gzip -%s" % self.level
+
+###############################################################################
+# PigzCodec
+###############################################################################
+class PigzCodec(CompressionCodec):
+    """
+        Multi-threaded gzip. Produces regular gzip archives
+    """
+    ###########################################################################
+    def __init__(self):
+        CompressionCodec.__init__(self)
+        self._threads = None
+
+    ###########################################################################
+    @property
+    def name(self):
+        return "pigz"
+
+    ###########################################################################
+    @property
+    def threads(self):
+        return self._threads
+
+    @threads.setter
+    def threads(self, val):
+        self._threads = val
+
+    ###########################################################################
+    def compress_program(self):
+        program = "pigz"
+        if self.threads:
+            program += " -p %s" % self.threads
+        if self.level is not None:
+            program += " -%s" % self.level
+        return program
+
+    ###########################################################################
+    def decompress_program(self):
+        # archives are plain gzip so any box can extract them
+        if which("pigz"):
+            return "pigz"
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        doc = CompressionCodec.to_document(self, display_only=display_only)
+        if self.threads is not None:
+            doc["threads"] = self.threads
+        return doc
+
+###############################################################################
+# ZstdCodec
+###############################################################################
+class ZstdCodec(CompressionCodec):
+    """
+        Zstandard. Multi-threaded (all cores by default)
+    """
+    ###########################################################################
+    def __init__(self):
+        CompressionCodec.__init__(self)
+        self._level = 3
+        self._threads = 0
+
+    ###########################################################################
+    @property
+    def name(self):
+        return "zstd"
+
+    ###########################################################################
+    @property
+    def file_extension(self):
+        return "tar.zst"
+
+    ###########################################################################
+    @property
+    def threads(self):
+        return self._threads
+
+    @threads.setter
+    def threads(self, val):
+        self._threads = val
+
+    ###########################################################################
+    def compress_program(self):
+        return "zstd -T%s -%s" % (self.threads or 0, self.level)
+
+    ###########################################################################
+    def decompress_program(self):
+        return "zstd"
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        doc = CompressionCodec.to_document(self, display_only=display_only)
+        doc["threads"] = self.threads
+        return doc
+
+###############################################################################
+# Lz4Codec
+###############################################################################
+class Lz4Codec(CompressionCodec):
+    """
+        LZ4. Fastest, lowest ratio
+    """
+    ###########################################################################
+    def __init__(self):
+        CompressionCodec.__init__(self)
+        self._level = 1
+
+    ###########################################################################
+    @property
+    def name(self):
+        return "lz4"
+
+    ###########################################################################
+    @property
+    def file_extension(self):
+        return "tar.lz4"
+
+    ###########################################################################
+    def compress_program(self):
+        return "lz4 -%s" % self.level
+
+    ###########################################################################
+    def decompress_program(self):
+        return "lz4"
+
+###############################################################################
+CODECS = {
+    "gzip": GzipCodec,
+    "pigz": PigzCodec,
+    "zstd": ZstdCodec,
+    "lz4": Lz4Codec
+}
+
+###############################################################################
+def get_codec(name):
+    """
+        Returns a codec instance for the codec name stored in file
+        references. None (archives created before codecs) means gzip
+    """
+    if not name:
+        return GzipCodec()
+
+    if name not in CODECS:
+        raise MBSError("Unknown compression codec '%s'" % name)
+
+    return CODECS[name]()
+
+###############################################################################
+def tar_create_command(codec, file_name, source_dir, verbose=True):
+    codec = codec or GzipCodec()
+    cmd = [which("tar"), "-cv" if verbose else "-c"]
+    cmd.extend(codec.tar_create_options())
+    cmd.extend(["-f", file_name, source_dir])
+    return cmd
+
+###############################################################################
+def tar_extract_command(codec, file_name, members=None):
+    """
+        file_name "-" extracts the archive piped to tar's stdin. members
+        limits the extract to these archive paths (and their contents)
+    """
+    codec = codec or GzipCodec()
+    cmd = [which("tar")]
+    if file_name == "-":
+        cmd.extend(codec.tar_stream_extract_options())
+    else:
+        cmd.extend(codec.tar_extract_options())
+    cmd.extend(["-xf", file_name])
+    if members:
+        cmd.extend(members)
+    return cmd
+
+###############################################################################
+def benchmark_codecs(source_dir, codecs, work_dir=None):
+    """
+        Archives source_dir (e.g. a sample dump) with each of the codecs and
+        extracts it back. Returns a list of result documents with the
+        compress/extract times and the compression ratio of each codec
+    """
+    source_dir = os.path.abspath(source_dir)
+    source_size = _dir_size(source_dir)
+    work_dir = tempfile.mkdtemp(dir=work_dir)
+    results = []
+    try:
+        for codec in codecs:
+            file_name = os.path.join(work_dir, "benchmark.%s" %
+                                     codec.file_extension)
+            start = time.time()
+            execute_command(tar_create_command(codec, file_name,
+                                               os.path.basename(source_dir),
+                                               verbose=False),
+                            cwd=os.path.dirname(source_dir))
+            compress_seconds = time.time() - start
+            archive_size = os.path.getsize(file_name)
+
+            extract_dir = tempfile.mkdtemp(dir=work_dir)
+            start = time.time()
+            execute_command(tar_extract_command(codec, file_name),
+                            cwd=extract_dir)
+            extract_seconds = time.time() - start
+
+            results.append({
+                "codec": codec.to_document(),
+                "sourceSize": source_size,
+                "archiveSize": archive_size,
+                "ratio": round(float(source_size) / (archive_size or 1), 2),
+                "compressSeconds": round(compress_seconds, 2),
+                "extractSeconds": round(extract_seconds, 2)
+            })
+            os.remove(file_name)
+            shutil.rmtree(extract_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+###############################################################################
+def _dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
@@ -0,0 +1,523 @@
+__author__ = 'abdul'
+
+import os
+import json
+import time
+import zlib
+import struct
+import hashlib
+import logging
+
+from pymongo.errors import DuplicateKeyError
+
+from mbs import get_mbs
+from date_utils import date_now, date_minus_seconds
+from target import FileReference, ChunkManifestReference
+from errors import MBSError
+
+###############################################################################
+# LOGGER
+###############################################################################
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+###############################################################################
+# CONSTANTS
+###############################################################################
+CHUNK_INDEX_COLLECTION_NAME = "dedup-chunks"
+CHUNKS_DIR = "dedup-chunks"
+
+MANIFEST_VERSION = 2
+
+# chunks are compressed after they are digested. Manifests record the codec
+# (version 1 manifests have uncompressed chunks)
+CHUNK_CODEC_ZLIB = "zlib"
+CHUNK_CODECS = [None, CHUNK_CODEC_ZLIB]
+
+MIN_CHUNK_SIZE = 1024 * 1024
+AVG_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+# anything bigger is not a bson document (max document size is 16MB)
+MAX_BSON_DOCUMENT_SIZE = 32 * 1024 * 1024
+
+# chunk index states
+STATE_UPLOADING = "UPLOADING"
+STATE_STORED = "STORED"
+STATE_DELETING = "DELETING"
+
+# time to wait for a chunk that is being garbage collected
+DELETING_CHUNK_WAIT = 1
+
+# chunks referenced within that period may belong to backups in flight and
+# are left alone by the garbage collector
+DEFAULT_GC_GRACE_SECONDS = 24 * 60 * 60
+
+###############################################################################
+def dedup_manifest_path(backup_name):
+    return "%s.manifest.json" % backup_name
+
+###############################################################################
+# Content defined chunking
+###############################################################################
+def iter_file_chunks(file_path):
+    """
+        Yields the chunks of file_path. BSON files are cut at document
+        boundaries that are picked by document content, so inserting or
+        removing documents only changes the chunks around them. Other files
+        are cut into fixed size chunks
+    """
+    with open(file_path, "rb") as file_obj:
+        if file_path.endswith(".bson"):
+            for chunk in _iter_bson_chunks(file_obj):
+                yield chunk
+        else:
+            for chunk in _iter_fixed_chunks(file_obj):
+                yield chunk
+
+###############################################################################
+def _iter_bson_chunks(file_obj):
+    chunk = []
+    chunk_size = 0
+    while True:
+        header = file_obj.read(4)
+        if not header:
+            break
+        if len(header) < 4:
+            chunk.append(header)
+            chunk_size += len(header)
+            break
+
+        doc_size = struct.unpack("<i", header)[0]
+        if doc_size < 5 or doc_size > MAX_BSON_DOCUMENT_SIZE:
+            # not a valid bson document. chunk the rest as is
+            chunk.append(header)
+            chunk_size += len(header)
+            break
+
+        doc = header + file_obj.read(doc_size - 4)
+        chunk.append(doc)
+        chunk_size += len(doc)
+
+        if _is_chunk_boundary(doc, chunk_size):
+            yield "".join(chunk)
+            chunk = []
+            chunk_size = 0
+
+        if len(doc) < doc_size:
+            # truncated file
+            break
+
+    if chunk:
+        for data in _iter_fixed_chunks_from(chunk, file_obj):
+            yield data
+
+###############################################################################
+def _is_chunk_boundary(doc, chunk_size):
+    if chunk_size >= MAX_CHUNK_SIZE:
+        return True
+    if chunk_size < MIN_CHUNK_SIZE:
+        return False
+    # each document ends a chunk with probability len(doc)/AVG_CHUNK_SIZE
+    # so chunks average AVG_CHUNK_SIZE whatever the document sizes are
+    return (zlib.crc32(doc) & 0xffffffff) % AVG_CHUNK_SIZE < len(doc)
+
+###############################################################################
+def _iter_fixed_chunks_from(head_parts, file_obj):
+    data = "".join(head_parts)
+    while data:
+        # top up the head to a full chunk without reading the whole file
+        if len(data) < MAX_CHUNK_SIZE:
+            data += file_obj.read(MAX_CHUNK_SIZE - len(data))
+        yield data[:MAX_CHUNK_SIZE]
+        data = data[MAX_CHUNK_SIZE:]
+
+    for chunk in _iter_fixed_chunks(file_obj):
+        yield chunk
+
+###############################################################################
+def _iter_fixed_chunks(file_obj):
+    while True:
+        data = file_obj.read(MAX_CHUNK_SIZE)
+        if not data:
+            break
+        yield data
+
+###############################################################################
+def chunk_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+###############################################################################
+def compress_chunk(data, codec):
+    if codec == CHUNK_CODEC_ZLIB:
+        return zlib.compress(data)
+    elif codec is None:
+        return data
+    else:
+        raise MBSError("Unknown chunk codec '%s'" % codec)
+
+###############################################################################
+def decompress_chunk(data, codec):
+    if codec == CHUNK_CODEC_ZLIB:
+        return zlib.decompress(data)
+    elif codec is None:
+        return data
+    else:
+        raise MBSError("Unknown chunk codec '%s'" % codec)
+
+###############################################################################
+# ChunkStore
+###############################################################################
+class ChunkStore(object):
+    """
+        Content addressed chunks stored in a target under CHUNKS_DIR. Each
+        chunk has a document in the chunk index collection with the list of
+        manifests that reference it. A chunk is deleted from the target once
+        no manifest references it anymore. Chunks of each codec are stored
+        separately.
+    """
+    ###########################################################################
+    def __init__(self, target, workspace, codec=CHUNK_CODEC_ZLIB):
+        self._target = target
+        self._workspace = workspace
+        self._codec = codec
+
+    ###########################################################################
+    @property
+    def target(self):
+        return self._target
+
+    ###########################################################################
+    @property
+    def codec(self):
+        return self._codec
+
+    ###########################################################################
+    @property
+    def store_key(self):
+        return "%s/%s" % (self._target.target_type,
+                          self._target.container_name)
+
+    ###########################################################################
+    @property
+    def index(self):
+        return get_mbs().database[CHUNK_INDEX_COLLECTION_NAME]
+
+    ###########################################################################
+    def chunk_path(self, digest):
+        return "%s/%s/%s" % (CHUNKS_DIR, digest[:2], self._chunk_name(digest))
+
+    ###########################################################################
+    def _chunk_name(self, digest):
+        if self._codec:
+            return "%s.%s" % (digest, self._codec)
+        else:
+            return digest
+
+    ###########################################################################
+    def _chunk_id(self, digest):
+        return "%s|%s" % (self.store_key, self._chunk_name(digest))
+
+    ###########################################################################
+    def _store_query(self):
+        return {"store": self.store_key, "codec": self._codec}
+
+    ###########################################################################
+    def add_chunk(self, digest, data, manifest_path):
+        """
+            References the chunk from manifest_path, uploading it only if the
+            target does not have it yet. Returns True if it was uploaded
+        """
+        chunk_id = self._chunk_id(digest)
+        stored_data = None
+        while True:
+            if self.index.find_one_and_update(
+                    {"_id": chunk_id, "state": STATE_STORED},
+                    {"$addToSet": {"refs": manifest_path},
+                     "$set": {"lastRefDate": date_now()}}):
+                return False
+
+            if stored_data is None:
+                stored_data = compress_chunk(data, self._codec)
+            try:
+                self.index.update_one(
+                    {"_id": chunk_id, "state": {"$ne": STATE_DELETING}},
+                    {
+                        "$addToSet": {"refs": manifest_path},
+                        "$set": {
+                            "state": STATE_UPLOADING,
+                            "lastRefDate": date_now()
+                        },
+                        "$setOnInsert": {
+                            "store": self.store_key,
+                            "codec": self._codec,
+                            "digest": digest,
+                            "size": len(data),
+                            "storedSize": len(stored_data),
+                            "createdDate": date_now()
+                        }
+                    },
+                    upsert=True)
+                break
+            except DuplicateKeyError:
+                # chunk is being garbage collected. wait then upload it again
+                time.sleep(DELETING_CHUNK_WAIT)
+
+        self._upload_chunk(digest, stored_data)
+        self.index.update_one({"_id": chunk_id},
+                              {"$set": {"state": STATE_STORED}})
+        return True
+
+    ###########################################################################
+    def _upload_chunk(self, digest, data):
+        chunk_file_path = os.path.join(self._workspace,
+                                       self._chunk_name(digest))
+        with open(chunk_file_path, "wb") as chunk_file:
+            chunk_file.write(data)
+        try:
+            self._target.put_file(chunk_file_path,
+                                  destination_path=self.chunk_path(digest))
+        finally:
+            os.remove(chunk_file_path)
+
+    ###########################################################################
+    def get_chunk(self, digest):
+        self._target.get_file(FileReference(file_path=self.chunk_path(digest)),
+                              self._workspace)
+        chunk_file_path = os.path.join(self._workspace,
+                                       self._chunk_name(digest))
+        try:
+            with open(chunk_file_path, "rb") as chunk_file:
+                data = decompress_chunk(chunk_file.read(), self._codec)
+        except zlib.error, e:
+            raise MBSError("Corrupted chunk '%s' in container '%s'" %
+                           (digest, self._target.container_name), cause=e)
+        finally:
+            os.remove(chunk_file_path)
+
+        if chunk_digest(data) != digest:
+            raise Exception("Corrupted chunk '%s' in container '%s'" %
+                            (digest, self._target.container_name))
+        return data
+
+    ###########################################################################
+    def release_chunk(self, digest, manifest_path):
+        """
+            Removes the manifest reference from the chunk and deletes the
+            chunk if it is not referenced anymore. Safe to call repeatedly
+        """
+        chunk_id = self._chunk_id(digest)
+        self.index.update_one({"_id": chunk_id},
+                              {"$pull": {"refs": manifest_path}})
+        self._collect_chunk(digest)
+
+    ###########################################################################
+    def _collect_chunk(self, digest, cutoff_date=None):
+        chunk_id = self._chunk_id(digest)
+        q = {
+            "_id": chunk_id,
+            "refs": {"$size": 0},
+            "state": {"$ne": STATE_DELETING}
+        }
+        if cutoff_date:
+            q["$or"] = _collectable_query(cutoff_date)
+        # mark it first so that no one references it while it is deleted
+        doc = self.index.find_one_and_update(
+            q, {"$set": {"state": STATE_DELETING}})
+        if not doc:
+            return False
+
+        logger.info("Deleting unreferenced chunk '%s' from container '%s'" %
+                    (digest, self._target.container_name))
+        self._target.delete_file(
+            FileReference(file_path=self.chunk_path(digest)))
+        self.index.delete_one({"_id": chunk_id, "state": STATE_DELETING})
+        return True
+
+    ###########################################################################
+    def collect_garbage(self, live_manifest_paths=None,
+                        grace_seconds=DEFAULT_GC_GRACE_SECONDS):
+        """
+            Deletes all unreferenced chunks of the store. If
+            live_manifest_paths is specified then references from any other
+            manifest (e.g. of crashed or canceled backups) are dropped first.
+            Chunks referenced or uploading within the last grace_seconds are
+            kept. Returns the number of deleted chunks
+        """
+        cutoff_date = date_minus_seconds(date_now(), grace_seconds)
+        if live_manifest_paths is not None:
+            self._drop_dead_refs(live_manifest_paths, cutoff_date)
+
+        total = 0
+        q = self._store_query()
+        q.update({
+            "refs": {"$size": 0},
+            "$or": _collectable_query(cutoff_date)
+        })
+        for doc in self.index.find(q, projection=["digest"]):
+            if self._collect_chunk(doc["digest"], cutoff_date=cutoff_date):
+                total += 1
+        return total
+
+    ###########################################################################
+    def _drop_dead_refs(self, live_manifest_paths, cutoff_date):
+        q = self._store_query()
+        q.update({
+            "refs": {"$ne": []},
+            "lastRefDate": {"$lt": cutoff_date}
+        })
+        for doc in self.index.find(q, projection=["refs"]):
+            dead_refs = [ref for ref in doc["refs"]
+                         if ref not in live_manifest_paths]
+            if not dead_refs:
+                continue
+            logger.info("Dropping dead references %s from chunk '%s'" %
+                        (dead_refs, doc["_id"]))
+            # re-check the date so that chunks referenced since are skipped
+            self.index.update_one(
+                {"_id": doc["_id"], "lastRefDate": {"$lt": cutoff_date}},
+                {"$pull": {"refs": {"$in": dead_refs}}})
+
+###############################################################################
+def _collectable_query(cutoff_date):
+    # chunks still uploading may be in flight unless they are stale
+    return [
+        {"state": STATE_STORED},
+        {"lastRefDate": {"$lt": cutoff_date}}
+    ]
+
+###############################################################################
+# Upload/Download
+###############################################################################
+def dedup_upload_dump(dump_dir_path, targets, destination_path, workspace):
+    """
+        Uploads the dump dir to all targets as content addressed chunks plus
+        a manifest at destination_path. Only chunks missing from each target
+        are uploaded. Returns a ChunkManifestReference per target
+    """
+    # never upload an empty manifest for a dump that is gone
+    if not os.path.isdir(dump_dir_path):
+        raise MBSError("Dump dir '%s' does not exist" % dump_dir_path)
+
+    stores = [ChunkStore(target, workspace, codec=CHUNK_CODEC_ZLIB)
+              for target in targets]
+    uploaded_counts = [0] * len(stores)
+    added_digests = set()
+    files = []
+    logical_size = 0
+    chunk_count = 0
+
+    try:
+        for root, dirs, file_names in os.walk(dump_dir_path):
+            dirs.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(root, file_name)
+                file_doc = {
+                    "path": os.path.relpath(file_path,
+                                            os.path.dirname(dump_dir_path)),
+                    "size": os.path.getsize(file_path),
+                    "chunks": []
+                }
+                for data in iter_file_chunks(file_path):
+                    digest = chunk_digest(data)
+                    file_doc["chunks"].append(digest)
+                    chunk_count += 1
+                    if digest in added_digests:
+                        continue
+                    for i, store in enumerate(stores):
+                        if store.add_chunk(digest, data, destination_path):
+                            uploaded_counts[i] += 1
+                    added_digests.add(digest)
+
+                logical_size += file_doc["size"]
+                files.append(file_doc)
+
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "chunkCodec": CHUNK_CODEC_ZLIB,
+            "files": files
+        }
+        manifest_file_path = os.path.join(workspace,
+                                          os.path.basename(destination_path))
+        with open(manifest_file_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+        references = []
+        for store, uploaded_count in zip(stores, uploaded_counts):
+            file_ref = store.target.put_file(manifest_file_path,
+                                             destination_path=destination_path)
+            ref = ChunkManifestReference(
+                file_path=file_ref.file_path, file_size=file_ref.file_size,
+                preserve=file_ref.preserve,
+                cloud_storage_encryption=file_ref.cloud_storage_encryption)
+            ref.logical_size = logical_size
+            ref.chunk_count = chunk_count
+            ref.unique_chunk_count = len(added_digests)
+            ref.uploaded_chunk_count = uploaded_count
+            references.append(ref)
+
+        logger.info("Dedup upload of '%s' completed: %s chunks, %s unique,"
+                    " uploaded %s" % (dump_dir_path, chunk_count,
+                                      len(added_digests), uploaded_counts))
+        return references
+    except Exception:
+        # drop references of this upload so that chunks can be collected
+        for store in stores:
+            for digest in added_digests:
+                try:
+                    store.release_chunk(digest, destination_path)
+                except Exception, e:
+                    logger.error("Error while releasing chunk '%s': %s" %
+                                 (digest, e))
+        raise
+
+###############################################################################
+def read_manifest(target, manifest_reference, workspace):
+    target.get_file(manifest_reference, workspace)
+    manifest_file_path = os.path.join(workspace, manifest_reference.file_name)
+    try:
+        with open(manifest_file_path) as manifest_file:
+            return json.load(manifest_file)
+    finally:
+        os.remove(manifest_file_path)
+
+###############################################################################
+def dedup_download_dump(target, manifest_reference, workspace):
+    """
+        Rebuilds the dump dir described by the manifest under workspace
+    """
+    manifest = read_manifest(target, manifest_reference, workspace)
+    store = _manifest_chunk_store(target, manifest, workspace)
+    for file_doc in manifest["files"]:
+        file_path = os.path.join(workspace, file_doc["path"])
+        file_dir = os.path.dirname(file_path)
+        if not os.path.exists(file_dir):
+            os.makedirs(file_dir)
+        with open(file_path, "wb") as file_obj:
+            for digest in file_doc["chunks"]:
+                file_obj.write(store.get_chunk(digest))
+
+        if os.path.getsize(file_path) != file_doc["size"]:
+            raise Exception("Size mismatch for rebuilt dump file '%s'" %
+                            file_doc["path"])
+
+###############################################################################
+def dedup_delete_manifest(target, manifest_reference, workspace):
+    """
+        Releases all chunks referenced by the manifest (deleting chunks that
+        are no longer referenced) then deletes the manifest
+    """
+    manifest = read_manifest(target, manifest_reference, workspace)
+    store = _manifest_chunk_store(target, manifest, workspace)
+    digests = set()
+    for file_doc in manifest["files"]:
+        digests.update(file_doc["chunks"])
+
+    for digest in digests:
+        store.release_chunk(digest, manifest_reference.file_path)
+
+    return target.delete_file(manifest_reference)
+
+###############################################################################
+def _manifest_chunk_store(target, manifest, workspace):
+    return ChunkStore(target, workspace, codec=manifest.get("chunkCodec"))
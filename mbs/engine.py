@@ -3,6 +3,7 @@ __author__ = 'abdul'
 
 import traceback
 import os
+import sys
 
 import time
 import datetime
@@ -16,7 +17,7 @@ import persistence
 from flask import Flask
 from flask.globals import request
 from globals import State, EventType
-from threading import Thread
+from threading import Thread, Event, Lock
 
 
 from errors import (
@@ -38,6 +39,7 @@ from task import (
 
 from backup import Backup
 from restore import Restore
+from task_wakeup import TaskWakeupListener
 from mbs_client.client import BackupEngineClient
 
 from task_utils import set_task_retry_info, trigger_task_finished_event
@@ -64,6 +66,17 @@ STATUS_STOPPED = "stopped"
 # Failed one-off max due time (2 hours)
 MAX_FAIL_DUE_TIME = 2 * 60 * 60
 
+# How often task processors check for finished workers between ticks
+WORKER_POLL_INTERVAL = 1
+
+# Task processors cancel a past due failed task every
+# FAILED_TASK_CLEANUP_SLEEP_TIMES sleep times
+FAILED_TASK_CLEANUP_SLEEP_TIMES = 40
+
+# Every STARVATION_CLAIM_INTERVAL-th task claimed is the oldest scheduled task
+# instead of the highest priority one
+STARVATION_CLAIM_INTERVAL = 5
+
 ###############################################################################
 # LOGGER
 ###############################################################################
@@ -95,6 +108,10 @@ class BackupEngine(Thread):
         self._stopped = False
         self._backup_processor = None
         self._restore_processor = None
+        self._wakeup_listener = None
+        self._bandwidth_governor_server = None
+        self._warm_workers = 0
+        self._warm_worker_pool = None
         self._client = None
 
 
@@ -158,6 +175,28 @@ class BackupEngine(Thread):
     def sleep_time(self, val):
         self._sleep_time = val
 
+    ###########################################################################
+    @property
+    def warm_workers(self):
+        """
+            Number of idle pre-initialized worker processes to keep around.
+            0 (default) spawns a new process per task
+        """
+        return self._warm_workers
+
+    @warm_workers.setter
+    def warm_workers(self, val):
+        self._warm_workers = int(val or 0)
+
+    ###########################################################################
+    @property
+    def warm_worker_pool(self):
+        """
+            Started by run() before the task processors. None if warm workers
+            are disabled
+        """
+        return self._warm_worker_pool
+
     ###########################################################################
     @property
     def client(self):
@@ -184,6 +223,10 @@ class BackupEngine(Thread):
         # Start the command server
         self._start_command_server()
 
+        self._start_bandwidth_governor()
+
+        self._start_warm_worker_pool()
+
         self.start_task_processors()
 
         self.wait_task_processors()
@@ -199,6 +242,53 @@ class BackupEngine(Thread):
         # start the restore processor
         self.restore_processor.start()
 
+        self._start_wakeup_listener()
+
+    ###########################################################################
+    def _start_wakeup_listener(self):
+        """
+            Starts listening for task wakeups if a wakeup channel is
+            configured. Task processors keep polling as a fallback
+        """
+        channel = get_mbs().task_wakeup_channel
+        if not channel:
+            return
+
+        self.info("Starting task wakeup listener")
+        self._wakeup_listener = TaskWakeupListener(channel, {
+            "backups": self.backup_processor,
+            "restores": self.restore_processor
+        })
+        self._wakeup_listener.start()
+
+    ###########################################################################
+    def _start_bandwidth_governor(self):
+        """
+            Starts serving the bandwidth budget shared by the workers if a
+            bandwidth governor is configured
+        """
+        governor = get_mbs().bandwidth_governor
+        if not governor or not governor.max_bytes_per_second:
+            return
+
+        self.info("Starting bandwidth governor (%s bytes/sec)" %
+                  governor.max_bytes_per_second)
+        self._bandwidth_governor_server = governor.start_server()
+
+    ###########################################################################
+    def _start_warm_worker_pool(self):
+        """
+            Spawns the warm workers ahead of the first task if warm workers
+            are configured
+        """
+        if self.warm_workers <= 0:
+            return
+
+        self.info("Starting %s warm workers" % self.warm_workers)
+        self._warm_worker_pool = WarmWorkerPool(
+            self.warm_workers, env_vars=self.get_task_worker_env_vars())
+        self._warm_worker_pool.start()
+
     ###########################################################################
     @property
     def backup_processor(self):
@@ -310,6 +400,8 @@ class BackupEngine(Thread):
 
         self.backup_processor._stopped = True
         self.restore_processor._stopped = True
+        if self._wakeup_listener:
+            self._wakeup_listener.stop()
         return self.worker_count == 0
 
     ###########################################################################
@@ -334,6 +426,10 @@ class BackupEngine(Thread):
     ###########################################################################
     def _pre_shutdown(self):
         self._stop_command_server()
+        if self._warm_worker_pool:
+            self._warm_worker_pool.shutdown()
+        if self._bandwidth_governor_server:
+            self._bandwidth_governor_server.stop()
 
     ###########################################################################
     # Command Server
@@ -379,9 +475,11 @@ class TaskQueueProcessor(Thread):
         self._sleep_time = sleep_time
         self._stopped = False
         self._max_workers = int(max_workers)
-        self._tick_count = 0
+        self._claim_count = 0
+        self._failed_task_cleanup_date = date_now()
         self._workers = {}
         self._log_file_sweeper = TaskLogFileSweeper(task_type_name)
+        self._wakeup_event = Event()
 
     ###########################################################################
     def run(self):
@@ -395,7 +493,7 @@ class TaskQueueProcessor(Thread):
                 self.error("Caught an error: '%s'.\nStack Trace:\n%s" %
                            (e, traceback.format_exc()))
             finally:
-                time.sleep(self._sleep_time)
+                self._wait_for_next_tick()
 
         ## wait for all workers to finish (if any)
         self._wait_for_running_workers()
@@ -404,24 +502,60 @@ class TaskQueueProcessor(Thread):
 
     ###########################################################################
     def _tick(self):
-        # increase tick_counter
-        self._tick_count += 1
-
-        # try to start the next task if there are available workers
-        if self._has_available_workers():
-            self._start_next_task()
-
-        # monitor workers
+        # monitor workers first so that finished workers free up their slots
         self._monitor_workers()
 
+        # fill all available worker slots
+        self._start_next_tasks()
+
         # Check for canceled tasks every minute
         self._monitor_cancel_requests()
 
-        # Cancel a failed task every 40 ticks and there are available
-        # workers
-        if self._tick_count % 40 == 0 and self._has_available_workers():
+        # Cancel a failed task every FAILED_TASK_CLEANUP_SLEEP_TIMES sleep
+        # times if there are available workers. Ticks are not counted since
+        # workers finishing and wakeups trigger extra ticks
+        if self._is_failed_task_cleanup_due() and self._has_available_workers():
+            self._failed_task_cleanup_date = date_now()
             self._clean_next_past_due_failed_task()
 
+    ###########################################################################
+    def _is_failed_task_cleanup_due(self):
+        elapsed = timedelta_total_seconds(date_now() - self._failed_task_cleanup_date)
+        return elapsed >= FAILED_TASK_CLEANUP_SLEEP_TIMES * self._sleep_time
+
+    ###########################################################################
+    def _wait_for_next_tick(self):
+        """
+            Sleeps until the next tick is due. Wakes up early if a worker
+            finished (i.e. a slot is about to be freed) or wake_up() is called
+        """
+        deadline = time.time() + self._sleep_time
+        while not self._stopped:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if self._wakeup_event.wait(min(remaining, WORKER_POLL_INTERVAL)):
+                break
+            if self._has_finished_workers():
+                break
+
+        self._wakeup_event.clear()
+
+    ###########################################################################
+    def wake_up(self):
+        """
+            Triggers the next tick immediately
+        """
+        self._wakeup_event.set()
+
+    ###########################################################################
+    def _has_finished_workers(self):
+        for worker in self._workers.values():
+            if not worker.is_alive():
+                return True
+
+        return False
+
     ###########################################################################
     def _wait_for_running_workers(self):
         self.info("Waiting for %s workers to finish" % self.worker_count)
@@ -444,10 +578,23 @@ class TaskQueueProcessor(Thread):
         return self._engine.get_task_collection_by_name(self._task_collection_name)
 
     ###########################################################################
-    def _start_next_task(self):
-        task = self.read_next_task()
-        if task:
+    def _start_next_tasks(self):
+        """
+            Claims and starts as many tasks as there are available workers.
+            Each task is claimed atomically (in priority order) by
+            read_next_task()
+        """
+        started = 0
+        while not self._stopped and self._has_available_workers():
+            task = self.read_next_task()
+            if not task:
+                break
             self._start_task(task)
+            started += 1
+
+        if started > 1:
+            self.info("Started %s tasks (%s/%s workers busy)" %
+                      (started, self.worker_count, self._max_workers))
 
     ###########################################################################
     def _monitor_workers(self):
@@ -523,7 +670,7 @@ class TaskQueueProcessor(Thread):
         else:
             worker = TaskCleanWorker(task, env_vars=self._engine.get_task_worker_env_vars())
 
-        worker.start()
+        worker.start(warm_pool=self._engine.warm_worker_pool)
         self._workers[worker.id] = worker
 
         return worker
@@ -611,28 +758,21 @@ class TaskQueueProcessor(Thread):
             }
         }
 
-        # Ensure that engines will not pickup tasks that were already processed by other engines
-        if self._tick_count % 2 == 0:
-            q["engineGuid"] = self._engine.engine_guid
-        else:
-            q["engineGuid"] = None
+        # Ensure that engines will not pickup tasks that were already processed by other engines.
+        # Tasks of this engine and unclaimed tasks are claimed in one go so that every tick (and every early wake up
+        # when a worker finishes) can fill a free worker slot
+        q["engineGuid"] = {"$in": [self._engine.engine_guid, None]}
 
-        # sort by priority except every third tick, we sort by created date to
-        # avoid starvation
-        if self._tick_count % 5 == 0:
+        # sort by priority except every fifth claimed task, we sort by created
+        # date to avoid starvation
+        if (self._claim_count + 1) % STARVATION_CLAIM_INTERVAL == 0:
             s = [("createdDate", 1)]
         else:
-            s = [("priority", 1)]
+            s = [("priority", 1), ("createdDate", 1)]
 
-        c = self.task_collection
-
-        task = c.find_one(query=q, sort=s)
+        task = self.task_collection.find_and_modify(query=q, sort=s, update=u, new=True)
         if task:
-            if task.engine_guid and task.engine_guid != self._engine.engine_guid:
-                raise Exception("Unexpected error")
-            else:
-                task = c.find_and_modify(query=q, sort=s, update=u, new=True)
-
+            self._claim_count += 1
         return task
 
     ###########################################################################
@@ -750,7 +890,18 @@ class TaskWorker(object):
         return "run-%s" % self._task.type_name.lower()
 
     ###########################################################################
-    def start(self):
+    def start(self, warm_pool=None):
+        log_file_path = self.get_log_path()
+        ensure_dir(os.path.dirname(log_file_path))
+
+        # hand the task over to a warm worker process if one is available
+        if warm_pool:
+            self._popen = warm_pool.run_task(self.get_cmd(), self._task.id,
+                                             log_file_path)
+            if self._popen:
+                self._id = str(self._popen.pid)
+                return
+
         cmd = self.get_cmd()
         run_task_command = [
             which("mbs"),
@@ -760,9 +911,6 @@ class TaskWorker(object):
             str(self._task.id)
         ]
 
-        log_file_path = self.get_log_path()
-        ensure_dir(os.path.dirname(log_file_path))
-
         log_file = open(log_file_path, "a")
         child_env_var = os.environ.copy()
         if self._env_vars:
@@ -826,6 +974,11 @@ class TaskWorker(object):
             self.get_task_collection().update_task(
                 task, properties=["tryCount", "startDate", "endDate", "queueLatencyInMinutes", "workerInfo"])
 
+            # transfers of the task draw from the engine bandwidth budget
+            # with the priority of the task type
+            if get_mbs().bandwidth_governor:
+                get_mbs().bandwidth_governor.set_task(task)
+
             # run the task
             task.execute()
 
@@ -934,6 +1087,138 @@ class TaskCleanWorker(TaskWorker):
     def cleaner_finished(self):
         self.worker_finished(State.CANCELED)
 
+###############################################################################
+# WarmWorkerPool
+###############################################################################
+class WarmWorkerPool(object):
+    """
+        Keeps a number of idle `mbs task-worker` processes that have already
+        imported all mbs modules and loaded config. Each process is handed
+        exactly one task over its stdin pipe and exits when the task is done,
+        so tasks keep running in their own processes and logging to their own
+        log files.
+    """
+    ###########################################################################
+    def __init__(self, size, env_vars=None):
+        self._size = size
+        self._env_vars = env_vars
+        self._idle = []
+        self._lock = Lock()
+        self._stopped = False
+
+    ###########################################################################
+    def start(self):
+        with self._lock:
+            self._replenish()
+
+    ###########################################################################
+    def run_task(self, cmd, task_id, log_file_path):
+        """
+            Sends the task to an idle warm worker and returns its Popen, or
+            None if no warm worker is ready (caller should spawn a new process)
+        """
+        with self._lock:
+            if self._stopped:
+                return None
+            popen = self._pop_idle_worker()
+            self._replenish()
+
+        if not popen:
+            return None
+
+        try:
+            popen.stdin.write("%s %s %s\n" % (cmd, task_id, log_file_path))
+            popen.stdin.close()
+            return popen
+        except Exception, e:
+            logger.error("Failed to hand %s '%s' to warm worker %s: %s" %
+                         (cmd, task_id, popen.pid, e))
+            force_kill_process_and_children(popen.pid)
+            return None
+
+    ###########################################################################
+    def _pop_idle_worker(self):
+        while self._idle:
+            popen = self._idle.pop(0)
+            if popen.poll() is None:
+                return popen
+            logger.warning("Warm worker %s exited with code %s while idle" %
+                           (popen.pid, popen.returncode))
+
+    ###########################################################################
+    def _replenish(self):
+        while len(self._idle) < self._size:
+            self._idle.append(self._spawn_worker())
+
+    ###########################################################################
+    def _spawn_worker(self):
+        worker_command = [
+            which("mbs"),
+            "--config-path",
+            mbs_config.MBS_CONF_PATH,
+            "task-worker"
+        ]
+        child_env_var = os.environ.copy()
+        if self._env_vars:
+            child_env_var.update(self._env_vars)
+
+        # output is redirected to the task log once the task is received
+        devnull = open(os.devnull, "w")
+        return subprocess.Popen(worker_command, stdin=subprocess.PIPE,
+                                stdout=devnull, stderr=subprocess.STDOUT,
+                                env=child_env_var)
+
+    ###########################################################################
+    def shutdown(self):
+        with self._lock:
+            self._stopped = True
+            for popen in self._idle:
+                try:
+                    # closing stdin makes idle workers exit
+                    popen.stdin.close()
+                except Exception, e:
+                    logger.error("Error while stopping warm worker %s: %s" %
+                                 (popen.pid, e))
+            self._idle = []
+
+###############################################################################
+def run_warm_task_worker():
+    """
+        Entry point of `mbs task-worker` processes. Pre-loads mbs then waits
+        for a single "<cmd> <task id> <log path>" line on stdin and runs it
+    """
+    # pay for heavy imports and config loading before a task arrives
+    import strategy
+    import target
+    import backup_assistant
+    get_mbs().backup_collection
+    get_mbs().restore_collection
+
+    line = sys.stdin.readline().strip()
+    if not line:
+        # pool shut down
+        return
+
+    cmd, task_id, log_file_path = line.split(" ", 2)
+
+    # send all output to the task log file, same as a freshly spawned worker
+    sys.stdout.flush()
+    sys.stderr.flush()
+    log_file = open(log_file_path, "a")
+    os.dup2(log_file.fileno(), sys.stdout.fileno())
+    os.dup2(log_file.fileno(), sys.stderr.fileno())
+
+    action, task_type = cmd.split("-", 1)
+    if task_type == "backup":
+        task = persistence.get_backup(task_id)
+    else:
+        task = persistence.get_restore(task_id)
+
+    if action == "clean":
+        TaskCleanWorker(task).run()
+    else:
+        TaskWorker(task).run()
+
 ###############################################################################
 def task_log_path(task):
     log_dir = task_log_dir(task.type_name.lower())
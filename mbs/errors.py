@@ -621,6 +621,20 @@ class UploadedFileSizeMatchError(TargetUploadError, RetriableError):
                          (destination_path, container_name, dest_size,
                           file_size))
 
+###############################################################################
+class UploadedFileChecksumMismatchError(TargetUploadError, RetriableError):
+
+    ###########################################################################
+    def __init__(self, destination_path=None, container_name=None,
+                 dest_etag=None, expected_etag=None):
+        TargetUploadError.__init__(self, destination_path=destination_path,
+                                   container_name=container_name)
+        self._details = ("Failure during upload verification: File '%s' etag"
+                         " in container '%s' (%s) does not match checksum of"
+                         " the uploaded bytes (%s)" %
+                         (destination_path, container_name, dest_etag,
+                          expected_etag))
+
 ###############################################################################
 class TargetDeleteError(TargetError, RetriableError):
     pass
@@ -629,6 +643,33 @@ class TargetDeleteError(TargetError, RetriableError):
 class TargetFileNotFoundError(TargetError):
     pass
 
+###############################################################################
+class DownloadedFileSizeMatchError(TargetError, RetriableError):
+
+    ###########################################################################
+    def __init__(self, file_path=None, container_name=None, size=None,
+                 expected_size=None):
+        msg = ("Incomplete download of file '%s' from cloud storage "
+               "container '%s'" % (file_path, container_name))
+        details = ("Downloaded %s bytes instead of %s" % (size,
+                                                          expected_size))
+        super(DownloadedFileSizeMatchError, self).__init__(msg=msg,
+                                                           details=details)
+
+###############################################################################
+class DownloadedFileChecksumMismatchError(TargetError, RetriableError):
+
+    ###########################################################################
+    def __init__(self, file_path=None, container_name=None, checksum_name=None,
+                 expected=None, actual=None):
+        msg = ("Downloaded file '%s' from cloud storage container '%s' is "
+               "corrupted" % (file_path, container_name))
+        details = ("%s of downloaded bytes (%s) does not match %s recorded at"
+                   " upload (%s)" % (checksum_name, actual, checksum_name,
+                                     expected))
+        super(DownloadedFileChecksumMismatchError, self).__init__(
+            msg=msg, details=details)
+
 
 ###############################################################################
 class RetentionPolicyError(MBSError):
@@ -882,6 +923,22 @@ class RestoreError(MBSError):
                    "%s" % (return_code, last_log_line))
         super(RestoreError, self).__init__(msg=msg, details=details)
 
+###############################################################################
+class BrokenIncrementalChainError(MBSError):
+    """
+        Raised when restoring an incremental backup whose base or one of its
+        previous incrementals is no longer available or does not connect to
+        the rest of the chain
+    """
+    ###########################################################################
+    def __init__(self, backup_id, missing_backup_id, reason=None):
+        msg = "Incremental backup chain is broken"
+        reason = reason or "is missing, expired or deleted"
+        details = ("Cannot restore incremental backup '%s'. Backup '%s' of "
+                   "its chain %s" % (backup_id, missing_backup_id, reason))
+        super(BrokenIncrementalChainError, self).__init__(msg=msg,
+                                                          details=details)
+
 ###############################################################################
 class ExtractError(MBSError):
     """
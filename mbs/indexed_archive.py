@@ -0,0 +1,402 @@
+__author__ = 'abdul'
+
+import os
+import json
+import zlib
+import struct
+import logging
+
+from cStringIO import StringIO
+
+import errors
+
+from robustify.robustify import robustify
+from target import IndexedArchiveReference
+
+###############################################################################
+# LOGGER
+###############################################################################
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+###############################################################################
+# CONSTANTS
+###############################################################################
+# Indexed archive layout:
+#   <member>...<member><index><footer>
+# Each member is a dump file compressed as a standalone gzip stream. The index
+# is the gzipped json list of members (path, offset, size, fileSize). The
+# footer locates the index: "<QQ8s" (index offset, index size, FOOTER_MAGIC)
+FILE_EXTENSION = "mbsa"
+
+# pre-3.0 dumps keep the indexes of all collections of a database in this file
+SYSTEM_INDEXES_FILE_NAME = "system.indexes.bson"
+
+INDEX_VERSION = 1
+FOOTER_MAGIC = "MBSIDX01"
+FOOTER_FORMAT = "<QQ8s"
+FOOTER_SIZE = struct.calcsize(FOOTER_FORMAT)
+
+DEFAULT_LEVEL = 6
+READ_SIZE = 1024 * 1024
+
+# zlib wbits for gzip streams
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# consecutive members are fetched with a single range request up to this
+# size. Also bounds what is fetched again when a request fails
+MAX_RUN_SIZE = 256 * 1024 * 1024
+
+###############################################################################
+# Archive creation
+###############################################################################
+def create_indexed_archive(dump_dir_path, archive_path, level=DEFAULT_LEVEL):
+    """
+        Archives the dump dir into archive_path, compressing each file
+        independently. Member paths are relative to the parent of the dump
+        dir (like tar). Returns the index
+    """
+    members = []
+    with open(archive_path, "wb") as archive:
+        for root, dirs, file_names in os.walk(dump_dir_path):
+            dirs.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(root, file_name)
+                offset = archive.tell()
+                file_size = _write_member(file_path, archive, level)
+                members.append({
+                    "path": os.path.relpath(file_path,
+                                            os.path.dirname(dump_dir_path)),
+                    "offset": offset,
+                    "size": archive.tell() - offset,
+                    "fileSize": file_size
+                })
+
+        index = {
+            "version": INDEX_VERSION,
+            "members": members
+        }
+        index_offset = archive.tell()
+        archive.write(_gzip(json.dumps(index)))
+        index_size = archive.tell() - index_offset
+        archive.write(struct.pack(FOOTER_FORMAT, index_offset, index_size,
+                                  FOOTER_MAGIC))
+
+    index["indexOffset"] = index_offset
+    index["indexSize"] = index_size
+    return index
+
+###############################################################################
+def _write_member(file_path, archive, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    file_size = 0
+    with open(file_path, "rb") as file_obj:
+        data = file_obj.read(READ_SIZE)
+        while data:
+            file_size += len(data)
+            archive.write(compressor.compress(data))
+            data = file_obj.read(READ_SIZE)
+    archive.write(compressor.flush())
+    return file_size
+
+###############################################################################
+def _gzip(data):
+    compressor = zlib.compressobj(DEFAULT_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+###############################################################################
+# Index
+###############################################################################
+def read_archive_index(archive_path):
+    """
+        Returns the index of a local archive
+    """
+    archive_size = os.path.getsize(archive_path)
+    return _read_index(_local_range_reader(archive_path), archive_size)
+
+###############################################################################
+def read_index(target, archive_reference):
+    """
+        Returns the index of an archive in target. Only the index (and the
+        footer if the reference does not locate the index) is downloaded
+    """
+    return _read_index(_target_range_reader(target, archive_reference),
+                       archive_reference.file_size,
+                       index_offset=archive_reference.index_offset,
+                       index_size=archive_reference.index_size)
+
+###############################################################################
+def _read_index(read_range, archive_size, index_offset=None, index_size=None):
+    if index_offset is None:
+        buf = StringIO()
+        read_range(archive_size - FOOTER_SIZE, FOOTER_SIZE, buf)
+        index_offset, index_size, magic = struct.unpack(FOOTER_FORMAT,
+                                                        buf.getvalue())
+        if magic != FOOTER_MAGIC:
+            raise errors.MBSError("Not an indexed archive (bad footer)")
+
+    buf = StringIO()
+    read_range(index_offset, index_size, buf)
+    index = json.loads(zlib.decompress(buf.getvalue(), GZIP_WBITS))
+    index["indexOffset"] = index_offset
+    index["indexSize"] = index_size
+    return index
+
+###############################################################################
+def index_database_names(index):
+    """
+        Databases with files in the archive (members under <dump dir>/<db>/)
+    """
+    names = set()
+    for member in index["members"]:
+        parts = member["path"].split("/")
+        if len(parts) > 2:
+            names.add(parts[1])
+    return sorted(names)
+
+###############################################################################
+def indexed_archive_reference(file_reference, index):
+    """
+        Returns an IndexedArchiveReference for the uploaded archive of
+        file_reference
+    """
+    ref = IndexedArchiveReference(
+        file_path=file_reference.file_path,
+        file_size=file_reference.file_size,
+        preserve=file_reference.preserve,
+        cloud_storage_encryption=file_reference.cloud_storage_encryption,
+        upload_plan=file_reference.upload_plan,
+        md5=file_reference.md5, sha256=file_reference.sha256,
+        etag=file_reference.etag)
+    ref.index_offset = index["indexOffset"]
+    ref.index_size = index["indexSize"]
+    ref.database_names = index_database_names(index)
+    ref.member_count = len(index["members"])
+    ref.logical_size = sum(m["fileSize"] for m in index["members"])
+    return ref
+
+###############################################################################
+def select_members(index, database_names=None, collection_names=None):
+    """
+        Members of the specified databases (all by default). collection_names
+        further limits them to the files of these collections
+        (<collection>.bson and <collection>.metadata.json) plus the
+        system.indexes.bson of pre-3.0 dumps
+    """
+    selected = []
+    for member in index["members"]:
+        parts = member["path"].split("/")
+        if database_names:
+            if len(parts) < 3 or parts[1] not in database_names:
+                continue
+        if collection_names and len(parts) > 2:
+            file_name = parts[-1]
+            if file_name == SYSTEM_INDEXES_FILE_NAME:
+                selected.append(member)
+                continue
+            if not any(file_name in ("%s.bson" % c, "%s.metadata.json" % c)
+                       for c in collection_names):
+                continue
+        selected.append(member)
+
+    return selected
+
+###############################################################################
+# Extraction
+###############################################################################
+def extract_indexed_archive(target, archive_reference, workspace,
+                            database_names=None, collection_names=None):
+    """
+        Extracts the members of the archive in target selected by
+        database_names/collection_names (see select_members()) under
+        workspace. Only the byte ranges of these members are downloaded when
+        the target supports range downloads. Otherwise the whole archive is
+        downloaded first
+    """
+    if not target.supports_range_download:
+        logger.info("%s does not support range downloads. Downloading the "
+                    "whole archive '%s'" % (target.target_type,
+                                            archive_reference.file_name))
+        target.get_file(archive_reference, workspace)
+        archive_path = os.path.join(workspace, archive_reference.file_name)
+        try:
+            return extract_local_archive(archive_path, workspace,
+                                         database_names=database_names,
+                                         collection_names=collection_names)
+        finally:
+            os.remove(archive_path)
+
+    index = read_index(target, archive_reference)
+    members = select_members(index, database_names=database_names,
+                             collection_names=collection_names)
+    return _extract_members(_target_range_reader(target, archive_reference),
+                            members, workspace)
+
+###############################################################################
+def extract_local_archive(archive_path, workspace, database_names=None,
+                          collection_names=None):
+    index = read_archive_index(archive_path)
+    members = select_members(index, database_names=database_names,
+                             collection_names=collection_names)
+    return _extract_members(_local_range_reader(archive_path), members,
+                            workspace)
+
+###############################################################################
+def _extract_members(read_range, members, workspace):
+    if not members:
+        raise errors.MBSError("No archive members match the requested "
+                              "databases/collections")
+
+    runs = _member_runs(members)
+    logger.info("Extracting %s archive members (%s bytes) in %s range "
+                "requests" % (len(members), sum(m["size"] for m in members),
+                              len(runs)))
+    for run in runs:
+        _robustified_extract_run(read_range, run, workspace)
+
+    return members
+
+###############################################################################
+def _member_runs(members):
+    """
+        Groups members that are next to each other in the archive
+    """
+    runs = []
+    run = []
+    run_end = run_size = 0
+    for member in members:
+        if (run and (member["offset"] != run_end or
+                     run_size + member["size"] > MAX_RUN_SIZE)):
+            runs.append(run)
+            run = []
+            run_size = 0
+        run.append(member)
+        run_end = member["offset"] + member["size"]
+        run_size += member["size"]
+
+    if run:
+        runs.append(run)
+
+    return runs
+
+###############################################################################
+@robustify(max_attempts=5, retry_interval=5, backoff=2,
+           do_on_exception=errors.raise_if_not_retriable,
+           do_on_failure=errors.raise_exception)
+def _robustified_extract_run(read_range, run, workspace):
+    writer = MemberRunWriter(run, workspace)
+    try:
+        offset = run[0]["offset"]
+        size = run[-1]["offset"] + run[-1]["size"] - offset
+        read_range(offset, size, writer)
+        writer.complete()
+    finally:
+        writer.close()
+
+###############################################################################
+# MemberRunWriter
+###############################################################################
+class MemberRunWriter(object):
+    """
+        File object that the bytes of consecutive archive members are written
+        to. Decompresses each member into its file under workspace
+    """
+    ###########################################################################
+    def __init__(self, members, workspace):
+        self._members = members
+        self._workspace = workspace
+        self._member_index = -1
+        self._remaining = 0
+        self._file_obj = None
+        self._decompressor = None
+        self._file_size = 0
+
+    ###########################################################################
+    def write(self, data):
+        while data:
+            if not self._remaining:
+                self._open_next_member()
+
+            piece = data[:self._remaining]
+            data = data[len(piece):]
+            self._remaining -= len(piece)
+            self._write_file(self._decompressor.decompress(piece))
+
+            if not self._remaining:
+                self._close_member()
+
+    ###########################################################################
+    def _open_next_member(self):
+        self._member_index += 1
+        if self._member_index >= len(self._members):
+            raise errors.MBSError("Got more bytes than the requested archive"
+                                  " members")
+
+        member = self._members[self._member_index]
+        file_path = os.path.join(self._workspace, member["path"])
+        file_dir = os.path.dirname(file_path)
+        if not os.path.exists(file_dir):
+            os.makedirs(file_dir)
+
+        self._file_obj = open(file_path, "wb")
+        self._decompressor = zlib.decompressobj(GZIP_WBITS)
+        self._remaining = member["size"]
+        self._file_size = 0
+
+    ###########################################################################
+    def _write_file(self, data):
+        self._file_size += len(data)
+        self._file_obj.write(data)
+
+    ###########################################################################
+    def _close_member(self):
+        self._write_file(self._decompressor.flush())
+        self._file_obj.close()
+        self._file_obj = None
+
+        member = self._members[self._member_index]
+        if self._file_size != member["fileSize"]:
+            raise errors.DownloadedFileSizeMatchError(
+                file_path=member["path"], size=self._file_size,
+                expected_size=member["fileSize"])
+
+    ###########################################################################
+    def complete(self):
+        """
+            Raises DownloadedFileSizeMatchError if not all members were
+            written
+        """
+        if self._member_index != len(self._members) - 1 or self._remaining:
+            member = self._members[max(0, self._member_index)]
+            raise errors.DownloadedFileSizeMatchError(
+                file_path=member["path"], size=self._file_size,
+                expected_size=member["fileSize"])
+
+    ###########################################################################
+    def close(self):
+        if self._file_obj:
+            self._file_obj.close()
+            self._file_obj = None
+
+###############################################################################
+# Range readers
+###############################################################################
+def _target_range_reader(target, archive_reference):
+    def read_range(offset, size, stream):
+        target.read_range(archive_reference, offset, size, stream)
+
+    return read_range
+
+###############################################################################
+def _local_range_reader(archive_path):
+    def read_range(offset, size, stream):
+        with open(archive_path, "rb") as archive:
+            archive.seek(offset)
+            while size > 0:
+                data = archive.read(min(READ_SIZE, size))
+                if not data:
+                    break
+                stream.write(data)
+                size -= len(data)
+
+    return read_range
@@ -89,6 +89,10 @@ class MBS(object):
         self._event_listener_collection = None
         self._event_queue = None
 
+        self._task_wakeup_channel = None
+
+        self._bandwidth_governor = None
+
         # allow boto debug to be configuable
         if config.get("enableBotoDebug"):
             import boto
@@ -296,6 +300,54 @@ class MBS(object):
 
         return self._backup_event_listener
 
+    ###########################################################################
+    @property
+    def task_wakeup_channel(self):
+        """
+            Optional channel for waking up engines when tasks are scheduled.
+            None when not configured; engines then rely on polling only
+        """
+        if not self._task_wakeup_channel:
+            channel_conf = self._get_config_value("taskWakeupChannel")
+            if channel_conf:
+                self._task_wakeup_channel = self._maker.make(channel_conf)
+
+        return self._task_wakeup_channel
+
+    ###########################################################################
+    @property
+    def plan_spread_window_in_seconds(self):
+        """
+            Default spread window of plans (see
+            BackupPlan.spread_window_in_seconds). Changing it moves the
+            occurrences of existing plans
+        """
+        return self._get_config_value("planSpreadWindowInSeconds") or 0
+
+    ###########################################################################
+    @property
+    def plan_capacity_per_minute(self):
+        """
+            Number of plan occurrences per minute that the engines can take.
+            Used to report the projected plan load (see
+            scheduler.projected_plan_load_curve())
+        """
+        return self._get_config_value("planCapacityPerMinute")
+
+    ###########################################################################
+    @property
+    def bandwidth_governor(self):
+        """
+            Optional engine wide upload/download bandwidth budget. None when
+            not configured; transfers then run at full speed
+        """
+        if not self._bandwidth_governor:
+            governor_conf = self._get_config_value("bandwidthGovernor")
+            if governor_conf:
+                self._bandwidth_governor = self._maker.make(governor_conf)
+
+        return self._bandwidth_governor
+
     ###########################################################################
     @property
     def notifications(self):
@@ -174,6 +174,19 @@ class MongoConnector(object):
             else:
                 raise
 
+    ###########################################################################
+    def get_num_cores(self):
+        """
+            Number of cores of the host (hostInfo). None when hostInfo is not
+            available (e.g. database level credentials)
+        """
+        try:
+            return self.admin_db.command("hostInfo")["system"]["numCores"]
+        except Exception, e:
+            logger.info("Could not determine number of cores of '%s': %s" %
+                        (self, e))
+            return None
+
     ###########################################################################
     def version_greater_than_3_2(self):
         return self.get_mongo_version() >= MongoNormalizedVersion("3.2.0")
@@ -3,6 +3,7 @@ __author__ = 'abdul'
 from base import MBSObject
 
 from globals import Priority
+from schedule import spread_offset
 
 ###############################################################################
 # BackupPlan
@@ -24,6 +25,7 @@ class BackupPlan(MBSObject):
         self._generator = None
         self._tags = None
         self._priority = Priority.LOW
+        self._spread_window_in_seconds = None
 
     ###########################################################################
     @property
@@ -83,6 +85,11 @@ class BackupPlan(MBSObject):
     ###########################################################################
     @property
     def schedule(self):
+        """
+            The plan schedule, shifted by the plan spread offset
+        """
+        if self._schedule is not None:
+            self._schedule.spread_seconds = self.spread_seconds
         return self._schedule
 
     @schedule.setter
@@ -160,6 +167,30 @@ class BackupPlan(MBSObject):
     def priority(self, val):
         self._priority = val
 
+    ###########################################################################
+    @property
+    def spread_window_in_seconds(self):
+        """
+            Occurrences of the plan are shifted by an offset within this
+            window derived from the plan id (see schedule.spread_offset()) so
+            that plans with the same schedule do not all fire at once.
+            Defaults to the system wide 'planSpreadWindowInSeconds'
+        """
+        return self._spread_window_in_seconds
+
+    @spread_window_in_seconds.setter
+    def spread_window_in_seconds(self, val):
+        self._spread_window_in_seconds = val
+
+    ###########################################################################
+    @property
+    def spread_seconds(self):
+        window = self.spread_window_in_seconds
+        if window is None:
+            from mbs import get_mbs
+            window = get_mbs().plan_spread_window_in_seconds
+        return spread_offset(self.id, window)
+
     ###########################################################################
     def to_document(self, display_only=False):
         doc = super(BackupPlan, self).to_document(display_only=display_only)
@@ -184,6 +215,9 @@ class BackupPlan(MBSObject):
         if self.tags:
             doc["tags"] = self._export_tags()
 
+        if self.spread_window_in_seconds is not None:
+            doc["spreadWindowInSeconds"] = self.spread_window_in_seconds
+
         if self.secondary_targets:
             doc["secondaryTargets"] = \
                 map(lambda t: t.to_document(display_only=display_only),
@@ -238,5 +272,12 @@ class BackupPlan(MBSObject):
         if not self.strategy:
             errors.append("Missing plan 'strategy'")
 
+        if (self.spread_window_in_seconds is not None and
+                (not isinstance(self.spread_window_in_seconds, (int, long)) or
+                 self.spread_window_in_seconds < 0)):
+            errors.append("Invalid plan 'spreadWindowInSeconds' '%s'. Has to "
+                          "be a positive integer" %
+                          self.spread_window_in_seconds)
+
         return errors
 
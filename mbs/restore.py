@@ -12,11 +12,13 @@ class Restore(MBSTask):
         MBSTask.__init__(self)
         self._source_backup = None
         self._source_database_name = None
+        self._source_collection_names = None
         self._destination = None
         self._destination_stats = None
 
         self._data_stats = {}
         self._valid = None
+        self._restore_parallelism = None
 
     ###########################################################################
     def execute(self):
@@ -50,6 +52,18 @@ class Restore(MBSTask):
     def source_database_name(self, source_database_name):
         self._source_database_name = source_database_name
 
+    ###########################################################################
+    @property
+    def source_collection_names(self):
+        """
+            Collections of source_database_name to restore (all if not set)
+        """
+        return self._source_collection_names
+
+    @source_collection_names.setter
+    def source_collection_names(self, val):
+        self._source_collection_names = val
+
     ###########################################################################
     @property
     def destination(self):
@@ -86,6 +100,18 @@ class Restore(MBSTask):
     def valid(self, valid):
         self._valid = valid
 
+    ###########################################################################
+    @property
+    def restore_parallelism(self):
+        """
+            How the restore parallelism (numParallelCollections) was chosen
+        """
+        return self._restore_parallelism
+
+    @restore_parallelism.setter
+    def restore_parallelism(self, val):
+        self._restore_parallelism = val
+
     ###########################################################################
     def to_document(self, display_only=False):
         doc = MBSTask.to_document(self, display_only=display_only)
@@ -98,4 +124,10 @@ class Restore(MBSTask):
             "valid": self.valid
         })
 
+        if self.source_collection_names:
+            doc["sourceCollectionNames"] = self.source_collection_names
+
+        if self.restore_parallelism:
+            doc["restoreParallelism"] = self.restore_parallelism
+
         return doc
@@ -280,7 +280,9 @@ class BackupExpirationManager(ScheduleRunner):
     def get_plan_backups_due_for_expiration(self, plan, plan_backups):
         rp = plan.retention_policy
         if rp and self.is_plan_backups_expirable(plan):
-            return rp.filter_backups_due_for_expiration(plan_backups)
+            plan_backups = list(plan_backups)
+            dues = rp.filter_backups_due_for_expiration(plan_backups)
+            return dues and exclude_incremental_chain_dependencies(plan_backups, dues)
 
     ###########################################################################
     def is_plan_backups_expirable(self, plan):
@@ -459,3 +461,32 @@ class BackupRetentionRequestWorker(ScheduleRunner):
             self._expiration_manager.process_plan_retention(plan)
 
     ###########################################################################
+
+###############################################################################
+def exclude_incremental_chain_dependencies(plan_backups, dues):
+    """
+        Removes from dues the backups that a retained oplog incremental backup
+        (see OplogIncrementalStrategy) still needs for restore
+    """
+    dues = list(dues)
+    due_ids = set(backup.id for backup in dues)
+    needed_ids = set()
+    for backup in plan_backups:
+        if backup.id not in due_ids:
+            needed_ids.add(_previous_chain_backup_id(backup))
+
+    # needing a backup means needing its whole chain
+    while True:
+        kept = [backup for backup in dues if backup.id in needed_ids]
+        if not kept:
+            return dues
+        for backup in kept:
+            logger.info("Not expiring backup '%s'. A retained incremental "
+                        "backup depends on it" % backup.id)
+            dues.remove(backup)
+            needed_ids.add(_previous_chain_backup_id(backup))
+
+###############################################################################
+def _previous_chain_backup_id(backup):
+    info = (backup.data_stats or {}).get("oplogIncremental")
+    return info.get("previousBackupId") if info else None
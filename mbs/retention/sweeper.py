@@ -1,5 +1,6 @@
 __author__ = 'abdul'
 
+import os
 import traceback
 import multiprocessing
 import logging
@@ -15,14 +16,17 @@ from mbs.date_utils import date_now, date_minus_seconds
 from mbs.schedule import Schedule
 from mbs.globals import State, EventType
 
-from mbs.target import CloudBlockStorageSnapshotReference
+from mbs.target import CloudBlockStorageSnapshotReference, ChunkManifestReference
+from mbs.dedup import (
+    dedup_delete_manifest, dedup_manifest_path, ChunkStore, CHUNK_CODECS,
+    DEFAULT_GC_GRACE_SECONDS)
 
 
 from robustify.robustify import robustify
 from mbs.errors import (
     raise_if_not_retriable, raise_exception, BackupSweepError)
 
-from mbs.utils import document_pretty_string
+from mbs.utils import document_pretty_string, ensure_dir
 
 from mbs.notification.handler import NotificationPriority, NotificationType
 
@@ -52,6 +56,7 @@ class BackupSweeper(multiprocessing.Process):
         multiprocessing.Process.__init__(self)
         self._test_mode = False
         self._delete_delay_in_seconds = DEFAULT_DELETE_DELAY_IN_SECONDS
+        self._dedup_grace_period_in_seconds = DEFAULT_GC_GRACE_SECONDS
         self._schedule = DEFAULT_SWEEP_SCHEDULE
 
         self._worker_count = 0
@@ -107,6 +112,15 @@ class BackupSweeper(multiprocessing.Process):
     def delete_delay_in_seconds(self, val):
         self._delete_delay_in_seconds = val
 
+    ###########################################################################
+    @property
+    def dedup_grace_period_in_seconds(self):
+        return self._dedup_grace_period_in_seconds
+
+    @dedup_grace_period_in_seconds.setter
+    def dedup_grace_period_in_seconds(self, val):
+        self._dedup_grace_period_in_seconds = val
+
     ###########################################################################
     def tick(self):
         try:
@@ -162,6 +176,9 @@ class BackupSweeper(multiprocessing.Process):
 
         self._finish_cycle()
 
+        # chunks released by the deleted backups (and chunks leaked by failed
+        # backups) are collected after the manifests are gone
+        self._collect_dedup_garbage()
 
         logger.info("BackupSweeper: Finished sweep cycle. "
                     "Total Deleted=%s, Total Errored=%s, "
@@ -170,6 +187,86 @@ class BackupSweeper(multiprocessing.Process):
                      self._cycle_total_errored,
                      self._cycle_total_processed))
 
+    ###########################################################################
+    def _collect_dedup_garbage(self):
+        """
+            Deletes the unreferenced chunks of all dedup chunk stores. Chunk
+            references from manifests of canceled or deleted backups (e.g.
+            left behind by crashed uploads) are dropped
+        """
+        logger.info("BackupSweeper: Collecting dedup garbage...")
+        stores, live_manifest_paths = self._get_dedup_stores()
+
+        for store in stores:
+            if self.test_mode:
+                logger.info("NOOP. Running in test mode. Not collecting "
+                            "chunks of store '%s'" % store.store_key)
+                continue
+            try:
+                total = store.collect_garbage(
+                    live_manifest_paths=live_manifest_paths,
+                    grace_seconds=self.dedup_grace_period_in_seconds)
+                logger.info("BackupSweeper: Deleted %s chunks from store '%s'"
+                            % (total, store.store_key))
+            except Exception, e:
+                logger.exception("BackupSweeper: Error while collecting "
+                                 "chunks of store '%s': %s" %
+                                 (store.store_key, e))
+
+    ###########################################################################
+    def _get_dedup_stores(self):
+        """
+            Returns the chunk stores of all dedup targets and the paths of
+            manifests that are in use or may still be uploaded by a retry
+        """
+        stores = {}
+        workspace = self._get_dedup_workspace()
+        collection = get_mbs().backup_collection.collection
+        target_docs = (
+            collection.distinct("target", {"target.dedup": True}) +
+            collection.distinct("secondaryTargets",
+                                {"secondaryTargets.dedup": True}))
+
+        for target_doc in target_docs:
+            # distinct returns all secondary targets of matching backups
+            if not target_doc.get("dedup"):
+                continue
+            target = get_mbs().maker.make(target_doc)
+            for codec in CHUNK_CODECS:
+                store = ChunkStore(target, workspace, codec=codec)
+                stores.setdefault((store.store_key, codec), store)
+
+        return stores.values(), self._get_live_dedup_manifest_paths()
+
+    ###########################################################################
+    def _get_live_dedup_manifest_paths(self):
+        """
+            Manifest paths of dedup backups that are not deleted or canceled
+        """
+        live_manifest_paths = set()
+        q = {
+            "$or": [
+                {"target.dedup": True},
+                {"secondaryTargets.dedup": True}
+            ],
+            "deletedDate": None,
+            "state": {"$ne": State.CANCELED}
+        }
+        projection = ["name", "targetReference.filePath",
+                      "secondaryTargetReferences.filePath"]
+        backup_docs = get_mbs().backup_collection.collection.find(
+            q, projection=projection)
+
+        for backup_doc in backup_docs:
+            live_manifest_paths.add(dedup_manifest_path(backup_doc["name"]))
+            ref_docs = ([backup_doc.get("targetReference")] +
+                        (backup_doc.get("secondaryTargetReferences") or []))
+            for ref_doc in ref_docs:
+                if ref_doc and ref_doc.get("filePath"):
+                    live_manifest_paths.add(ref_doc["filePath"])
+
+        return live_manifest_paths
+
     ###########################################################################
     def _start_workers(self):
         for i in xrange(self._worker_count):
@@ -327,6 +424,12 @@ class BackupSweeper(multiprocessing.Process):
             if isinstance(target_ref, CloudBlockStorageSnapshotReference):
                 logger.info("Deleting backup '%s' snapshot " % backup.id)
                 return target_ref.cloud_block_storage.delete_snapshot(target_ref)
+            elif isinstance(target_ref, ChunkManifestReference):
+                # release the chunks of the manifest. chunks that are not
+                # referenced by other backups anymore get deleted
+                logger.info("Deleting backup '%s' dedup manifest" % backup.id)
+                return dedup_delete_manifest(target, target_ref,
+                                             self._get_dedup_workspace())
             else:
                 logger.info("Deleting backup '%s file" % backup.id)
                 return target.delete_file(target_ref)
@@ -344,6 +447,12 @@ class BackupSweeper(multiprocessing.Process):
                 # raise error
                 raise
 
+    ###############################################################################
+    def _get_dedup_workspace(self):
+        workspace = os.path.join(get_mbs().temp_dir, "sweeper")
+        ensure_dir(workspace)
+        return workspace
+
     ###############################################################################
     def is_whitelisted_target_delete_error(self, backup, target, target_ref, e):
         return False
@@ -1,8 +1,13 @@
 import abc
+import heapq
+import hashlib
 
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
+from threading import Lock
 
 from croniter import croniter
+from repoze.lru import LRUCache
 
 from base import MBSObject
 from date_utils import (seconds_to_date, date_to_seconds, date_plus_seconds,
@@ -16,6 +21,31 @@ from date_utils import (seconds_to_date, date_to_seconds, date_plus_seconds,
 class AbstractSchedule(object):
     __metaclass__ = abc.ABCMeta
 
+    # seconds that all occurrences are shifted by (see spread_offset()). Set
+    # by the plan that owns the schedule; not persisted
+    _spread_seconds = 0
+
+    ###########################################################################
+    @property
+    def spread_seconds(self):
+        return self._spread_seconds
+
+    @spread_seconds.setter
+    def spread_seconds(self, val):
+        self._spread_seconds = val or 0
+
+    ###########################################################################
+    def _spread(self, dt):
+        if self._spread_seconds:
+            return dt + timedelta(seconds=self._spread_seconds)
+        return dt
+
+    ###########################################################################
+    def _unspread(self, dt):
+        if self._spread_seconds:
+            return dt - timedelta(seconds=self._spread_seconds)
+        return dt
+
     ###########################################################################
     @abc.abstractmethod
     def validate(self):
@@ -129,6 +159,17 @@ class AbstractSchedule(object):
     ###########################################################################
     def min_time_delta(self):
         return timedelta(seconds=1)
+###############################################################################
+def spread_offset(key, window_in_seconds):
+    """ Deterministic offset in [0, window_in_seconds) for key (e.g. a plan
+    id). Spreads the occurrences of schedules that share the same expression
+    or offset across the window, always the same way for the same key.
+
+    """
+    if not window_in_seconds or key is None:
+        return 0
+    digest = hashlib.md5(str(key)).hexdigest()
+    return int(digest[:8], 16) % int(window_in_seconds)
 
 ###############################################################################
 # Schedule
@@ -189,7 +230,7 @@ class Schedule(AbstractSchedule, MBSObject):
         dt = date_now() if dt is None else dt
         date_seconds = date_to_seconds(dt)
         offset = self.offset if self.offset else epoch_date()
-        offset_seconds = date_to_seconds(offset)
+        offset_seconds = date_to_seconds(offset) + self.spread_seconds
 
         return seconds_to_date(date_seconds -
                                ((date_seconds - offset_seconds) %
@@ -197,21 +238,39 @@ class Schedule(AbstractSchedule, MBSObject):
 
     ###########################################################################
     def natural_occurrences_between(self, start_dt, end_dt=None):
+        """ Returns an OccurrenceRange (computed, not walked)
+
+        """
         super(Schedule, self).natural_occurrences_between(start_dt, end_dt)
 
         end_dt = date_now() if end_dt is None else end_dt
-        occurrences = []
-        last_occurrence = self.last_natural_occurrence(start_dt)
+        first_occurrence = self.last_natural_occurrence(start_dt)
+        if first_occurrence < start_dt:
+            first_occurrence = date_plus_seconds(first_occurrence,
+                                                 self.frequency_in_seconds)
 
-        delta = timedelta(seconds=self.frequency_in_seconds)
+        step = _microseconds(timedelta(seconds=self.frequency_in_seconds))
+        span = _microseconds(end_dt - first_occurrence)
+        count = max(0, (span + step - 1) // step)
 
-        while last_occurrence < end_dt:
-            if last_occurrence >= start_dt:
-                occurrences.append(last_occurrence)
+        return OccurrenceRange(first_occurrence, self.frequency_in_seconds,
+                               count)
 
-            last_occurrence = last_occurrence + delta
+    ###########################################################################
+    def last_n_occurrences(self, n, dt=None):
+        """ Returns an OccurrenceRange (most recent first)
 
-        return occurrences
+        """
+        return OccurrenceRange(self.last_natural_occurrence(dt),
+                               -self.frequency_in_seconds, n)
+
+    ###########################################################################
+    def next_n_occurrences(self, n, dt=None):
+        """ Returns an OccurrenceRange
+
+        """
+        return OccurrenceRange(self.next_natural_occurrence(dt),
+                               self.frequency_in_seconds, n)
 
     ###########################################################################
     def to_document(self, display_only=False):
@@ -238,12 +297,30 @@ class CronSchedule(AbstractSchedule, MBSObject):
     def expression(self, expression):
         self._expression = expression
 
+    ###########################################################################
+    @property
+    def spread_seconds(self):
+        return self._spread_seconds
+
+    @spread_seconds.setter
+    def spread_seconds(self, val):
+        """ NOTE: cron is a minute level resolution. spread is rounded down to
+                  whole minutes
+
+        """
+        val = val or 0
+        self._spread_seconds = val - val % 60
+
     ###########################################################################
     def _is_occurrence(self, dt):
-        occurrence = croniter(self._expression, dt).get_prev(datetime)
-        if dt == croniter(self._expression, occurrence).get_next(datetime):
-            return True
-        return False
+        return self._is_cron_occurrence(self._unspread(dt))
+
+    ###########################################################################
+    def _is_cron_occurrence(self, dt):
+        """ Whether dt is an occurrence of the expression (ignoring spread)
+
+        """
+        return cron_is_occurrence(self._expression, dt)
 
     ###########################################################################
     def validate(self):
@@ -275,7 +352,8 @@ class CronSchedule(AbstractSchedule, MBSObject):
     ###########################################################################
     def next_natural_occurrence(self, dt=None):
         dt = date_now() if dt is None else dt
-        return croniter(self._expression, dt).get_next(datetime)
+        return self._spread(cron_next_occurrence(self._expression,
+                                                 self._unspread(dt)))
 
     ###########################################################################
     def last_natural_occurrence(self, dt=None):
@@ -283,25 +361,21 @@ class CronSchedule(AbstractSchedule, MBSObject):
                   seconds/microseconds
 
         """
-        dt = date_now() if dt is None else dt
+        dt = self._unspread(date_now() if dt is None else dt)
         if dt.second > 0 or dt.microsecond > 0:
             dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
-        if self._is_occurrence(dt):
-            return dt
-        return croniter(self._expression, dt).get_prev(datetime)
+        if self._is_cron_occurrence(dt):
+            return self._spread(dt)
+        return self._spread(cron_previous_occurrence(self._expression, dt))
 
     ###########################################################################
     def natural_occurrences_between(self, start_dt, end_dt=None):
         super(CronSchedule, self).natural_occurrences_between(start_dt, end_dt)
-        end_dt = date_now() if end_dt is None else end_dt
-        occurrences = []
-        if self._is_occurrence(start_dt):
-            occurrences.append(start_dt)
-        iter_ = croniter(self._expression, start_dt)
-        occurrences.append(iter_.get_next(datetime))
-        while occurrences[-1] < end_dt:
-            occurrences.append(iter_.get_next(datetime))
-        return occurrences[:-1]
+        end_dt = self._unspread(date_now() if end_dt is None else end_dt)
+        start_dt = self._unspread(start_dt)
+        return map(self._spread,
+                   cron_occurrences_between(self._expression, start_dt,
+                                            end_dt))
 
     ###########################################################################
     def min_time_delta(self):
@@ -334,6 +408,20 @@ class CompositeSchedule(AbstractSchedule, MBSObject):
     def schedules(self, schedules):
         self._schedules = schedules
 
+    ####################################################################################################################
+    @property
+    def spread_seconds(self):
+        return self._spread_seconds
+
+    @spread_seconds.setter
+    def spread_seconds(self, val):
+        """
+            Schedules are all shifted by the same spread
+        """
+        self._spread_seconds = val or 0
+        for schedule in self.schedules or []:
+            schedule.spread_seconds = val
+
     ####################################################################################################################
     def max_acceptable_lag(self, dt=None):
         """
@@ -366,9 +454,13 @@ class CompositeSchedule(AbstractSchedule, MBSObject):
         """
             :returns all occurrences across all schedules
         """
+        schedule_ocs = [s.natural_occurrences_between(start_dt, end_dt=end_dt) for s in self.schedules]
+        if all(isinstance(ocs, OccurrenceRange) for ocs in schedule_ocs):
+            return OccurrenceRangeUnion(schedule_ocs)
+
         all_ocs = []
-        for s in self.schedules:
-            all_ocs.extend(s.natural_occurrences_between(start_dt, end_dt=end_dt))
+        for ocs in schedule_ocs:
+            all_ocs.extend(ocs)
 
         # eliminate duplicates
         all_ocs = list(set(all_ocs))
@@ -382,3 +474,437 @@ class CompositeSchedule(AbstractSchedule, MBSObject):
             errors.append("CompositeSchedule missing schedules")
         return errors
 
+
+###############################################################################
+# OccurrenceRange
+###############################################################################
+class OccurrenceRange(object):
+    """ Lazy sequence of count occurrences, step_seconds apart, starting at
+    start (like xrange for dates). len, indexing, slicing, membership and
+    bisection are O(1) so that occurrences of high frequency schedules over
+    long periods are never materialized
+
+    """
+    ###########################################################################
+    def __init__(self, start, step_seconds, count):
+        if not step_seconds:
+            raise ValueError("OccurrenceRange step cannot be zero")
+        self._start = start
+        self._step_seconds = step_seconds
+        self._step = _microseconds(timedelta(seconds=step_seconds))
+        self._count = max(0, count)
+
+    ###########################################################################
+    @property
+    def start(self):
+        return self._start
+
+    ###########################################################################
+    @property
+    def step_seconds(self):
+        return self._step_seconds
+
+    ###########################################################################
+    def __len__(self):
+        return self._count
+
+    ###########################################################################
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._count)
+            return OccurrenceRange(self._occurrence(start),
+                                   self._step_seconds * step,
+                                   len(xrange(start, stop, step)))
+
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("OccurrenceRange index out of range")
+        return self._occurrence(index)
+
+    ###########################################################################
+    def _occurrence(self, index):
+        return self._start + timedelta(seconds=self._step_seconds * index)
+
+    ###########################################################################
+    def __iter__(self):
+        for index in xrange(self._count):
+            yield self._occurrence(index)
+
+    ###########################################################################
+    def __contains__(self, dt):
+        return self._index_of(dt) is not None
+
+    ###########################################################################
+    def index(self, dt):
+        index = self._index_of(dt)
+        if index is None:
+            raise ValueError("%s is not an occurrence of the range" % dt)
+        return index
+
+    ###########################################################################
+    def _index_of(self, dt):
+        if not isinstance(dt, datetime):
+            return None
+        index, remainder = divmod(_microseconds(dt - self._start), self._step)
+        if remainder or not 0 <= index < self._count:
+            return None
+        return index
+
+    ###########################################################################
+    def bisect_left(self, dt):
+        """ Index where dt would be inserted before any equal occurrence (see
+        bisect.bisect_left). Ascending ranges only
+
+        """
+        self._check_ascending()
+        index = -(-_microseconds(dt - self._start) // self._step)
+        return min(max(index, 0), self._count)
+
+    ###########################################################################
+    def bisect_right(self, dt):
+        """ Index where dt would be inserted after any equal occurrence (see
+        bisect.bisect_right). Ascending ranges only
+
+        """
+        self._check_ascending()
+        index = _microseconds(dt - self._start) // self._step + 1
+        return min(max(index, 0), self._count)
+
+    ###########################################################################
+    def occurrence_of(self, dt):
+        """ The occurrence that dt belongs to: the last occurrence at or
+        before dt. None if dt is before the range
+
+        """
+        index = self.bisect_right(dt)
+        return self._occurrence(index - 1) if index else None
+
+    ###########################################################################
+    def _check_ascending(self):
+        if self._step < 0:
+            raise ValueError("OccurrenceRange is not ascending")
+
+    ###########################################################################
+    def __eq__(self, other):
+        if isinstance(other, OccurrenceRange):
+            return (self._count == other._count and
+                    (not self._count or
+                     (self._start == other._start and
+                      (self._count == 1 or self._step == other._step))))
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    ###########################################################################
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    ###########################################################################
+    def __repr__(self):
+        return "OccurrenceRange(%r, %r, %r)" % (self._start,
+                                                self._step_seconds,
+                                                self._count)
+
+###############################################################################
+# OccurrenceRangeUnion
+###############################################################################
+class OccurrenceRangeUnion(object):
+    """ Sorted distinct occurrences of several ascending OccurrenceRanges
+    (e.g. of a CompositeSchedule). Membership and occurrence_of() are answered
+    by the ranges. len and indexing materialize the occurrences (once)
+
+    """
+    ###########################################################################
+    def __init__(self, ranges):
+        self._ranges = ranges
+        self._occurrences = None
+
+    ###########################################################################
+    def __iter__(self):
+        last = None
+        for occurrence in heapq.merge(*self._ranges):
+            if occurrence != last:
+                yield occurrence
+            last = occurrence
+
+    ###########################################################################
+    def _get_occurrences(self):
+        if self._occurrences is None:
+            # not list(self) which would ask __len__ for a size hint
+            self._occurrences = list(iter(self))
+        return self._occurrences
+
+    ###########################################################################
+    def __len__(self):
+        return len(self._get_occurrences())
+
+    ###########################################################################
+    def __getitem__(self, index):
+        return self._get_occurrences()[index]
+
+    ###########################################################################
+    def __contains__(self, dt):
+        return any(dt in occurrence_range for occurrence_range in self._ranges)
+
+    ###########################################################################
+    def occurrence_of(self, dt):
+        """ The last occurrence at or before dt across ranges
+
+        """
+        occurrences = filter(None, [occurrence_range.occurrence_of(dt)
+                                    for occurrence_range in self._ranges])
+        return max(occurrences) if occurrences else None
+
+    ###########################################################################
+    def __eq__(self, other):
+        try:
+            return self._get_occurrences() == list(other)
+        except TypeError:
+            return NotImplemented
+
+    ###########################################################################
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+###############################################################################
+def _microseconds(td):
+    return (td.days * 86400 + td.seconds) * 1000000 + td.microseconds
+
+###############################################################################
+# Cron occurrences
+###############################################################################
+# Occurrences of cron expressions are computed a window at a time and cached.
+# Windows are a day long, or an hour/a minute long for expressions that would
+# have more than CRON_WINDOW_MAX_OCCURRENCES occurrences in a day/an hour. The
+# cache holds at most CRON_CACHE_MAX_OCCURRENCES occurrences (least recently
+# used windows are evicted). Plans share a handful of expressions so
+# auditors, retention and the scheduler mostly hit the cache instead of
+# walking croniter occurrence by occurrence
+CRON_WINDOW_SIZES = [24 * 60 * 60, 60 * 60, 60]
+CRON_WINDOW_MAX_OCCURRENCES = 24 * 60
+CRON_CACHE_MAX_OCCURRENCES = 200000
+
+# parsed expressions are cached too
+CRON_EXPRESSION_CACHE_SIZE = 1000
+
+# number of occurrences sampled to measure how dense an expression is
+CRON_DENSITY_SAMPLE_SIZE = 100
+
+ONE_DAY = timedelta(days=1)
+
+###############################################################################
+# CronWindowCache
+###############################################################################
+class CronWindowCache(object):
+    """ Cache of (previous, occurrences, following) cron windows bounded by
+    the total number of occurrences held. When full, the least recently used
+    windows are evicted down to three quarters of the bound
+
+    """
+    ###########################################################################
+    def __init__(self, max_occurrences):
+        self._max_occurrences = max_occurrences
+        # key => [window, last use]
+        self._windows = {}
+        self._size = 0
+        self._clock = 0
+        self._lock = Lock()
+
+    ###########################################################################
+    @property
+    def size(self):
+        """ Number of occurrences held
+
+        """
+        return self._size
+
+    ###########################################################################
+    def get(self, key):
+        entry = self._windows.get(key)
+        if entry is None:
+            return None
+        # hits are not locked. A racing hit at worst records a stale use
+        self._clock += 1
+        entry[1] = self._clock
+        return entry[0]
+
+    ###########################################################################
+    def put(self, key, window):
+        size = _window_size(window)
+        with self._lock:
+            old_entry = self._windows.pop(key, None)
+            if old_entry is not None:
+                self._size -= _window_size(old_entry[0])
+
+            if size > self._max_occurrences:
+                return
+
+            self._clock += 1
+            self._windows[key] = [window, self._clock]
+            self._size += size
+            if self._size > self._max_occurrences:
+                self._evict(self._max_occurrences * 3 / 4)
+
+    ###########################################################################
+    def _evict(self, max_size):
+        entries = sorted(self._windows.items(), key=lambda item: item[1][1])
+        for key, entry in entries:
+            if self._size <= max_size:
+                break
+            del self._windows[key]
+            self._size -= _window_size(entry[0])
+
+    ###########################################################################
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+            self._size = 0
+
+###############################################################################
+def _window_size(window):
+    # previous and following count too
+    return len(window[1]) + 2
+
+_cron_window_cache = CronWindowCache(CRON_CACHE_MAX_OCCURRENCES)
+
+###############################################################################
+# ParsedCronExpression
+###############################################################################
+class ParsedCronExpression(object):
+    """ A croniter parsed once and reused for all windows of the expression
+
+    """
+    ###########################################################################
+    def __init__(self, expression):
+        self._expression = expression
+        self._iter = croniter(expression, epoch_date())
+        # croniter iterators are stateful
+        self._lock = Lock()
+        self._window_seconds = self._measure_window_seconds()
+
+    ###########################################################################
+    @property
+    def window_seconds(self):
+        return self._window_seconds
+
+    ###########################################################################
+    def _measure_window_seconds(self):
+        """ The longest window size that would hold at most
+        CRON_WINDOW_MAX_OCCURRENCES occurrences (at the sampled density)
+
+        """
+        start = epoch_date()
+        count = 0
+        occurrence = self._iter.get_next(datetime)
+        while occurrence < start + ONE_DAY and count < CRON_DENSITY_SAMPLE_SIZE:
+            count += 1
+            occurrence = self._iter.get_next(datetime)
+
+        if count < CRON_DENSITY_SAMPLE_SIZE:
+            return CRON_WINDOW_SIZES[0]
+
+        span = timedelta_total_seconds(occurrence - start)
+        for window_seconds in CRON_WINDOW_SIZES:
+            if count * window_seconds <= CRON_WINDOW_MAX_OCCURRENCES * span:
+                return window_seconds
+
+        return CRON_WINDOW_SIZES[-1]
+
+    ###########################################################################
+    def window_start(self, dt):
+        if self._window_seconds == CRON_WINDOW_SIZES[0]:
+            return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        elif self._window_seconds == CRON_WINDOW_SIZES[1]:
+            return dt.replace(minute=0, second=0, microsecond=0)
+        else:
+            return dt.replace(second=0, microsecond=0)
+
+    ###########################################################################
+    def compute_window(self, start):
+        """ Returns (last occurrence before start, occurrences within the
+        window that starts at start, first occurrence after the window)
+
+        """
+        end = start + timedelta(seconds=self._window_seconds)
+        with self._lock:
+            self._iter.set_current(start)
+            previous = self._iter.get_prev(datetime)
+            # one second back so that an occurrence at start is included
+            self._iter.set_current(start - timedelta(seconds=1))
+            occurrences = []
+            occurrence = self._iter.get_next(datetime)
+            while occurrence < end:
+                occurrences.append(occurrence)
+                occurrence = self._iter.get_next(datetime)
+
+        return previous, tuple(occurrences), occurrence
+
+_cron_expression_cache = LRUCache(CRON_EXPRESSION_CACHE_SIZE)
+
+###############################################################################
+def _parsed_cron_expression(expression):
+    parsed = _cron_expression_cache.get(expression)
+    if parsed is None:
+        parsed = ParsedCronExpression(expression)
+        _cron_expression_cache.put(expression, parsed)
+    return parsed
+
+###############################################################################
+def _cron_window_at(expression, start):
+    key = (expression, start)
+    window = _cron_window_cache.get(key)
+    if window is None:
+        window = _parsed_cron_expression(expression).compute_window(start)
+        _cron_window_cache.put(key, window)
+    return window
+
+###############################################################################
+def _cron_window(expression, dt):
+    start = _parsed_cron_expression(expression).window_start(dt)
+    return _cron_window_at(expression, start)
+
+###############################################################################
+def cron_is_occurrence(expression, dt):
+    occurrences = _cron_window(expression, dt)[1]
+    i = bisect_left(occurrences, dt)
+    return i < len(occurrences) and occurrences[i] == dt
+
+###############################################################################
+def cron_next_occurrence(expression, dt):
+    """ First occurrence after dt (exclusive)
+
+    """
+    _, occurrences, following = _cron_window(expression, dt)
+    i = bisect_right(occurrences, dt)
+    return occurrences[i] if i < len(occurrences) else following
+
+###############################################################################
+def cron_previous_occurrence(expression, dt):
+    """ Last occurrence before dt (exclusive)
+
+    """
+    previous, occurrences, _ = _cron_window(expression, dt)
+    i = bisect_left(occurrences, dt)
+    return occurrences[i - 1] if i else previous
+
+###############################################################################
+def cron_occurrences_between(expression, start_dt, end_dt):
+    """ Occurrences within [start_dt, end_dt)
+
+    """
+    parsed = _parsed_cron_expression(expression)
+    window_length = timedelta(seconds=parsed.window_seconds)
+    occurrences = []
+    start = parsed.window_start(start_dt)
+    while start < end_dt:
+        _, window_occurrences, following = _cron_window_at(expression, start)
+        occurrences.extend(o for o in window_occurrences
+                           if start_dt <= o < end_dt)
+        # skip windows without occurrences
+        start = max(start + window_length, parsed.window_start(following))
+
+    return occurrences
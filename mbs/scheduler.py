@@ -4,10 +4,14 @@ from schedule_runner import ScheduleRunner
 from schedule import Schedule
 from globals import State
 from mbs import get_mbs
-from date_utils import date_now, timedelta_total_seconds
+from date_utils import date_now, timedelta_total_seconds, date_plus_seconds
 from task import EVENT_STATE_CHANGE
 import traceback
 import logging
+import heapq
+import math
+from datetime import datetime
+from threading import Lock
 from errors import InvalidPlanError
 
 import Queue
@@ -18,23 +22,66 @@ logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 PLAN_WORKER_COUNT = 5
+
+# plans are dispatched from the plan timeline every second. Failed backups and past cycle backups are still checked
+# every MAINTENANCE_INTERVAL seconds
+TICK_INTERVAL = 1
+MAINTENANCE_INTERVAL = 10
+
+# max number of plans loaded at once
+PLAN_BATCH_SIZE = 100
+
+# plans that are due in the plans collection are merged into the timeline every tick so that plans added or moved
+# earlier by other processes fire right away. The whole timeline is also reloaded every PLAN_TIMELINE_RELOAD_INTERVAL
+# seconds to drop plans that were moved later or removed by other processes
+PLAN_TIMELINE_RELOAD_INTERVAL = 10 * 60
+
+# plans whose processing failed are retried after PLAN_RETRY_DELAY seconds
+PLAN_RETRY_DELAY = 10
+
 ########################################################################################################################
 class BackupScheduler(ScheduleRunner):
     """
-        Backup monitoring thread
+        Backup monitoring thread.
+        Plans are dispatched from an in memory timeline of (nextOccurrence, planId) that is loaded at startup so that
+        plans are only loaded in full when they fire. Plan changes made by this process are applied to the timeline
+        directly. Changes made by other processes (e.g. the api server) are picked up from the plans that are due in the
+        plans collection every tick
     """
     ####################################################################################################################
     def __init__(self, backup_system):
         self._backup_system = backup_system
-        ScheduleRunner.__init__(self, schedule=Schedule(frequency_in_seconds=10))
+        ScheduleRunner.__init__(self, schedule=Schedule(frequency_in_seconds=TICK_INTERVAL))
         self._plans_queue = Queue.Queue()
         self._plan_workers = None
+        self._plan_timeline = PlanTimeline()
+        self._timeline_reload_date = None
+        self._maintenance_date = None
+        # plan id => date until which a failed plan is not picked up again from the due plans in the collection
+        self._plan_retry_dates = {}
+
+    ####################################################################################################################
+    @property
+    def plan_timeline(self):
+        return self._plan_timeline
 
     ####################################################################################################################
     def run(self):
         self._init_workers()
+        self._reload_plan_timeline()
         super(BackupScheduler,self).run()
 
+    ####################################################################################################################
+    def plan_updated(self, plan):
+        """
+            Must be called when a plan is saved or its next occurrence changes
+        """
+        self._plan_timeline.set(plan.id, plan.next_occurrence, priority=plan.priority)
+
+    ####################################################################################################################
+    def plan_removed(self, plan_id):
+        self._plan_timeline.remove(plan_id)
+
     ####################################################################################################################
     def _init_workers(self):
         self._plan_workers = []
@@ -47,7 +94,11 @@ class BackupScheduler(ScheduleRunner):
     def tick(self):
 
         try:
-            self._process_plans_considered_now(process_max_count=100)
+            if not self._timeline_reload_date or date_now() >= self._timeline_reload_date:
+                self._reload_plan_timeline()
+            else:
+                self._sync_due_plans()
+            self._process_plans_considered_now()
         except Exception, e:
             logger.error("Caught an error: '%s'.\nStack Trace:\n%s" %
                          (e, traceback.format_exc()))
@@ -55,6 +106,11 @@ class BackupScheduler(ScheduleRunner):
             message = ("%s.\n\nStack Trace:\n%s" % (e, traceback.format_exc()))
             get_mbs().notifications.send_error_notification(subject, message)
 
+        if self._maintenance_date and date_now() < self._maintenance_date:
+            return
+
+        self._maintenance_date = date_plus_seconds(date_now(), MAINTENANCE_INTERVAL)
+
         try:
             self._process_failed_backups()
         except Exception, e:
@@ -75,21 +131,108 @@ class BackupScheduler(ScheduleRunner):
 
 
     ####################################################################################################################
-    def _process_plans_considered_now(self, process_max_count=None):
+    def _process_plans_considered_now(self):
+        """
+            Dispatches all plans that are due in the timeline, PLAN_BATCH_SIZE plans at a time
+        """
         count = 0
         start_date = date_now()
-        for plan in self._get_plans_to_consider_now(limit=process_max_count):
-            self._plans_queue.put(plan)
-            if process_max_count:
-                count += 1
-                if count >= process_max_count:
-                    break
-        # wait for workers to finish
-        self._plans_queue.join()
+        while True:
+            plan_ids = self._plan_timeline.pop_due(date_now(), limit=PLAN_BATCH_SIZE)
+            if not plan_ids:
+                break
+
+            plans = self._get_plans_to_consider_now(plan_ids)
+            self._dispatch_plans(plans)
+            count += len(plans)
 
         if count:
             time_elapsed = timedelta_total_seconds(date_now() - start_date)
-            logger.info("Finished processing %s plans in %s seconds" % ((count or "all"), time_elapsed))
+            logger.info("Finished processing %s plans in %s seconds" % (count, time_elapsed))
+
+    ####################################################################################################################
+    def _dispatch_plans(self, plans):
+        """
+            Backups of valid plans that are due are scheduled in one batch. Other plans are processed by the plan workers
+        """
+        now = date_now()
+        due_plans = []
+        for plan in plans:
+            if plan.next_occurrence and plan.next_occurrence <= now and not plan.validate():
+                due_plans.append(plan)
+            else:
+                self._plans_queue.put(plan)
+
+        if due_plans:
+            try:
+                backups, failed_plans = self._backup_system.schedule_plan_backups(due_plans)
+            except Exception, e:
+                logger.exception("Error while scheduling backups of %s plans. Cause: %s" % (len(due_plans), e))
+                failed_plans = [(plan, e) for plan in due_plans]
+
+            for plan, e in failed_plans:
+                self._plan_failed(plan)
+
+        # wait for workers to finish
+        self._plans_queue.join()
+
+    ####################################################################################################################
+    def _reload_plan_timeline(self):
+        """
+            Loads the next occurrence of all plans (not the plans)
+        """
+        start_date = date_now()
+        # failed plans keep their retry date
+        self._plan_retry_dates = dict((plan_id, retry_date) for plan_id, retry_date in self._plan_retry_dates.items()
+                                      if retry_date > start_date)
+        cursor = get_mbs().plan_collection.collection.find({}, {"nextOccurrence": 1, "priority": 1})
+        self._plan_timeline.reset((doc["_id"], self._plan_retry_dates.get(doc["_id"], doc.get("nextOccurrence")),
+                                   doc.get("priority")) for doc in cursor)
+        self._timeline_reload_date = date_plus_seconds(date_now(), PLAN_TIMELINE_RELOAD_INTERVAL)
+
+        logger.info("Loaded plan timeline of %s plans in %s seconds" %
+                    (len(self._plan_timeline), timedelta_total_seconds(date_now() - start_date)))
+
+        if not get_mbs().plan_capacity_per_minute:
+            return
+
+        load_curve = projected_plan_load_curve()
+        if load_curve["recommendedSpreadWindowInSeconds"]:
+            logger.warning("Projected plan load peaks at %s occurrences per minute (%s) which exceeds the capacity of "
+                           "%s per minute. Consider a plan spread window of %s seconds" %
+                           (load_curve["peak"], load_curve["peakMinute"], load_curve["capacityPerMinute"],
+                            load_curve["recommendedSpreadWindowInSeconds"]))
+
+    ####################################################################################################################
+    def _sync_due_plans(self):
+        """
+            Merges the plans that are due in the plans collection (including plans with no next occurrence yet) into
+            the timeline. Those are plans that were added or moved earlier by another process
+        """
+        now = date_now()
+        q = {
+            "$or": [
+                {"nextOccurrence": None},
+                {"nextOccurrence": {"$lte": now}}
+            ]
+        }
+
+        cursor = get_mbs().plan_collection.collection.find(q, {"nextOccurrence": 1, "priority": 1})
+        for doc in cursor:
+            plan_id = doc["_id"]
+            retry_date = self._plan_retry_dates.get(plan_id)
+            if retry_date:
+                if retry_date > now:
+                    continue
+                del self._plan_retry_dates[plan_id]
+
+            self._plan_timeline.merge(plan_id, doc.get("nextOccurrence"), priority=doc.get("priority"))
+
+    ####################################################################################################################
+    def _plan_failed(self, plan):
+        retry_date = date_plus_seconds(date_now(), PLAN_RETRY_DELAY)
+        self._plan_retry_dates[plan.id] = retry_date
+        self._plan_timeline.set(plan.id, retry_date, priority=plan.priority)
 
     ####################################################################################################################
     def _process_plan(self, plan):
@@ -138,29 +281,42 @@ class BackupScheduler(ScheduleRunner):
         else:
             logger.info("Wooow. How did you get here!!!! Plan '%s' does not to be scheduled yet. next natural "
                         "occurrence %s " % (plan.id, next_natural_occurrence))
+            self.plan_updated(plan)
 
     ####################################################################################################################
-    def _get_plans_to_consider_now(self, limit=None):
+    def _get_plans_to_consider_now(self, plan_ids):
         """
-        Returns list of plans that the scheduler should process at this time.
+        Returns list of plans (of plan_ids) that the scheduler should process at this time.
         Those are:
             1- Plans with no backups scheduled yet (next occurrence has not
             been calculated yet)
 
             2- Plans whose next occurrence is now or in the past
 
+        Plans of plan_ids that are not returned (changed or removed by another process) are synced back to the timeline
         """
         now = date_now()
-        q = {"$or": [
-            {"nextOccurrence": None},
-            {"nextOccurrence": {"$lte": now}}
-        ]
+        q = {
+            "_id": {"$in": plan_ids},
+            "$or": [
+                {"nextOccurrence": None},
+                {"nextOccurrence": {"$lte": now}}
+            ]
         }
 
         # sort by priority
         s = [("priority", 1)]
 
-        return get_mbs().plan_collection.find_iter(q, sort=s, limit=limit)
+        plans = list(get_mbs().plan_collection.find_iter(q, sort=s))
+
+        not_due_ids = set(plan_ids) - set(plan.id for plan in plans)
+        if not_due_ids:
+            cursor = get_mbs().plan_collection.collection.find({"_id": {"$in": list(not_due_ids)}},
+                                                               {"nextOccurrence": 1, "priority": 1})
+            for doc in cursor:
+                self._plan_timeline.set(doc["_id"], doc.get("nextOccurrence"), priority=doc.get("priority"))
+
+        return plans
 
     ####################################################################################################################
     def _set_update_plan_next_occurrence(self, plan):
@@ -176,6 +332,7 @@ class BackupScheduler(ScheduleRunner):
             }
         }
         get_mbs().plan_collection.update(spec=q, document=u)
+        self.plan_updated(plan)
 
     ####################################################################################################################
     def _cancel_past_cycle_backups(self):
@@ -274,6 +431,7 @@ class PlanWorker(ScheduleRunner):
             except Exception, e:
                 logger.exception("Error while processing plan '%s'. "
                                  "Cause: %s" % (plan.id, e))
+                self._scheduler._plan_failed(plan)
 
                 subject = "Plan Scheduler Error"
                 message = ("Error while processing plan '%s'. Cause: %s.\n\nStack Trace:\n%s" %
@@ -281,3 +439,148 @@ class PlanWorker(ScheduleRunner):
                 get_mbs().notifications.send_error_notification(subject, message)
             finally:
                 self._plan_queue.task_done()
+
+
+########################################################################################################################
+# PlanTimeline
+########################################################################################################################
+# plans without a next occurrence are due right away
+NO_OCCURRENCE_DATE = datetime(1970, 1, 1)
+
+class PlanTimeline(object):
+    """
+        Heap of (nextOccurrence, priority, planId). A plan's previous heap entry becomes stale when the plan is set again
+        or removed and is dropped when it reaches the top of the heap
+    """
+    ####################################################################################################################
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._lock = Lock()
+
+    ####################################################################################################################
+    def set(self, plan_id, next_occurrence, priority=None):
+        with self._lock:
+            self._push(plan_id, next_occurrence, priority)
+
+    ####################################################################################################################
+    def _push(self, plan_id, next_occurrence, priority):
+        entry = (_timeline_date(next_occurrence), priority or 0, plan_id)
+        self._entries[plan_id] = entry
+        heapq.heappush(self._heap, entry)
+
+    ####################################################################################################################
+    def merge(self, plan_id, next_occurrence, priority=None):
+        """
+            Same as set() but does not add a new heap entry when the plan is already set to next_occurrence
+        """
+        entry = (_timeline_date(next_occurrence), priority or 0, plan_id)
+        with self._lock:
+            if self._entries.get(plan_id) != entry:
+                self._push(plan_id, next_occurrence, priority)
+
+    ####################################################################################################################
+    def remove(self, plan_id):
+        with self._lock:
+            self._entries.pop(plan_id, None)
+
+    ####################################################################################################################
+    def reset(self, plans):
+        """
+            Replaces the timeline with plans: (plan_id, next_occurrence, priority) tuples
+        """
+        with self._lock:
+            self._heap = []
+            self._entries = {}
+            for plan_id, next_occurrence, priority in plans:
+                self._push(plan_id, next_occurrence, priority)
+
+    ####################################################################################################################
+    def pop_due(self, now, limit=None):
+        """
+            Removes and returns the ids of the plans due at now (earliest then highest priority first)
+        """
+        plan_ids = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now and (not limit or len(plan_ids) < limit):
+                entry = heapq.heappop(heap)
+                plan_id = entry[2]
+                if self._entries.get(plan_id) == entry:
+                    del self._entries[plan_id]
+                    plan_ids.append(plan_id)
+
+            # do not let stale entries pile up
+            if len(heap) > 2 * len(self._entries) + 1000:
+                self._heap = sorted(self._entries.values())
+
+        return plan_ids
+
+    ####################################################################################################################
+    def next_occurrence(self):
+        """
+            Date of the next due plan (None if no plans)
+        """
+        with self._lock:
+            while self._heap and self._entries.get(self._heap[0][2]) != self._heap[0]:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    ####################################################################################################################
+    def __contains__(self, plan_id):
+        return plan_id in self._entries
+
+    ####################################################################################################################
+    def __len__(self):
+        return len(self._entries)
+
+########################################################################################################################
+def projected_plan_load_curve():
+    """
+        Projected number of plan occurrences per minute (from the next occurrence of each plan in the plans
+        collection). When planCapacityPerMinute is configured and the peak exceeds it, also recommends the plan spread
+        window that brings the peak within capacity (assuming occurrences spread evenly over the window)
+    """
+    # plans that have no next occurrence yet are left out
+    pipeline = [
+        {"$match": {"nextOccurrence": {"$ne": None}}},
+        {
+            "$group": {
+                "_id": {
+                    "$subtract": [
+                        "$nextOccurrence",
+                        {"$mod": [{"$subtract": ["$nextOccurrence", NO_OCCURRENCE_DATE]}, 60 * 1000]}
+                    ]
+                },
+                "count": {"$sum": 1}
+            }
+        },
+        {"$sort": {"_id": 1}}
+    ]
+
+    curve = [(_timeline_date(doc["_id"]), doc["count"])
+             for doc in get_mbs().plan_collection.collection.aggregate(pipeline)]
+    peak_minute, peak = max(curve, key=lambda point: point[1]) if curve else (None, 0)
+    capacity = get_mbs().plan_capacity_per_minute
+
+    recommended_window = None
+    if capacity and peak > capacity:
+        current_window = get_mbs().plan_spread_window_in_seconds
+        recommended_window = int(math.ceil(float(peak) * max(current_window, 60) / capacity))
+
+    return {
+        "capacityPerMinute": capacity,
+        "peak": peak,
+        "peakMinute": peak_minute,
+        "recommendedSpreadWindowInSeconds": recommended_window,
+        "curve": [{"minute": minute, "count": count} for minute, count in curve]
+    }
+
+########################################################################################################################
+def _timeline_date(next_occurrence):
+    if next_occurrence is None:
+        return NO_OCCURRENCE_DATE
+    # dates read back from mongo are timezone aware
+    if next_occurrence.tzinfo is not None:
+        next_occurrence = next_occurrence.replace(tzinfo=None) - next_occurrence.utcoffset()
+    return next_occurrence
@@ -27,18 +27,24 @@ from source import CompositeBlockStorage, is_snapshot_volume_encrypted
 
 from target import (
     SnapshotStatus, multi_target_upload_file,
-    EbsSnapshotReference, CompositeBlockStorageSnapshotReference
+    EbsSnapshotReference, CompositeBlockStorageSnapshotReference,
+    ChunkManifestReference, IndexedArchiveReference, UploadLedger
 )
 
 
-from globals import EventType
+from globals import EventType, State
 from robustify.robustify import robustify
 from naming_scheme import *
-from threading import Thread
+from threading import Thread, Lock
 
 from bson.son import SON
+from bson import json_util
 
 import backup_assistant
+from compression import get_codec
+from dedup import dedup_manifest_path
+from indexed_archive import indexed_archive_reference
+from indexed_archive import FILE_EXTENSION as INDEXED_ARCHIVE_EXTENSION
 from backup import Backup
 
 ###############################################################################
@@ -57,12 +63,29 @@ EVENT_END_ARCHIVE = "END_ARCHIVE"
 EVENT_START_UPLOAD = "START_UPLOAD"
 EVENT_END_UPLOAD = "END_UPLOAD"
 
+# DumpStrategy archive formats
+ARCHIVE_FORMAT_TAR = "tar"
+ARCHIVE_FORMAT_INDEXED = "indexed"
+
 # max time to wait for balancer to stop (10 minutes)
 MAX_BALANCER_STOP_WAIT = 30 * 60
 
 # default max lag
 DEFAULT_MAX_LAG = 5 * 60
 
+# incremental backups between two full dumps of OplogIncrementalStrategy
+DEFAULT_MAX_INCREMENTALS = 24
+
+# restore parallelism (mongorestore --numParallelCollections). Collections
+# smaller than PARALLEL_COLLECTION_MIN_SIZE do not keep a restore worker busy
+PARALLEL_COLLECTION_MIN_SIZE = 64 * 1024 * 1024
+MAX_PARALLEL_COLLECTIONS = 8
+# used when the destination core count is not available
+DEFAULT_DESTINATION_CORES = 2
+
+# data stats key of the incremental chain info of oplog incremental backups
+OPLOG_INCREMENTAL_KEY = "oplogIncremental"
+
 ###############################################################################
 VERSION_2_6 = MongoNormalizedVersion("2.6.0")
 VERSION_3_0 = MongoNormalizedVersion("3.0.0")
@@ -803,6 +826,11 @@ class BackupStrategy(MBSObject):
         if backup.is_event_logged("CREATE_WORKSPACE"):
             self.backup_assistant.delete_task_workspace(backup)
 
+        # the backup will not be retried. abort its partial uploads
+        if backup.upload_ledgers:
+            self._discard_upload_ledgers(backup)
+            update_backup(backup, properties="uploadLedgers")
+
     ###########################################################################
     def run_restore(self, restore):
         self._do_run_restore(restore)
@@ -1152,6 +1180,13 @@ class DumpStrategy(BackupStrategy):
         self._dump_users = None
         self._dump_options_overrides = None
         self._restore_options_overrides = None
+        self._streaming_upload = None
+        self._streaming_restore = None
+        self._parallel_dump_workers = None
+        self._parallel_dump_without_oplog = None
+        self._compression = None
+        self._archive_format = None
+        self._restore_parallel_collections = None
 
     ###########################################################################
     @property
@@ -1190,6 +1225,119 @@ class DumpStrategy(BackupStrategy):
     def restore_options_overrides(self, val):
         self._restore_options_overrides = val
 
+    ###########################################################################
+    @property
+    def streaming_upload(self):
+        """
+            When true, the dump is archived and uploaded in one pipe
+            without writing an intermediate tar file to disk
+        """
+        return self._streaming_upload
+
+    @streaming_upload.setter
+    def streaming_upload(self, val):
+        self._streaming_upload = val
+
+    ###########################################################################
+    @property
+    def streaming_restore(self):
+        """
+            When true, the source backup archive is downloaded straight into
+            tar without writing it to disk. Database restores only extract
+            the restored database
+        """
+        return self._streaming_restore
+
+    @streaming_restore.setter
+    def streaming_restore(self, val):
+        self._streaming_restore = val
+
+    ###########################################################################
+    @property
+    def parallel_dump_workers(self):
+        """
+            When greater than 1, server level dumps are split by database
+            across that many concurrent dump processes writing into the same
+            dump directory (largest databases first).
+            Since --oplog only applies to full server dumps, parallel dumps
+            are NOT point-in-time. Servers that would have been dumped with
+            --oplog (replica members) are therefore still dumped with a single
+            dump process unless parallel_dump_without_oplog is true
+        """
+        return self._parallel_dump_workers
+
+    @parallel_dump_workers.setter
+    def parallel_dump_workers(self, val):
+        self._parallel_dump_workers = val
+
+    ###########################################################################
+    @property
+    def parallel_dump_without_oplog(self):
+        """
+            When true, replica members are dumped in parallel without --oplog
+        """
+        return self._parallel_dump_without_oplog
+
+    @parallel_dump_without_oplog.setter
+    def parallel_dump_without_oplog(self, val):
+        self._parallel_dump_without_oplog = val
+
+    ###########################################################################
+    @property
+    def compression(self):
+        """
+            Compression codec (see compression.py) used to archive dumps.
+            gzip when not set
+        """
+        return self._compression
+
+    @compression.setter
+    def compression(self, val):
+        self._compression = val
+
+    ###########################################################################
+    @property
+    def archive_format(self):
+        """
+            "tar" (default) or "indexed": dump files compressed independently
+            with an offset index so that database/collection restores only
+            download the files they need (see indexed_archive.py). Indexed
+            archives do not use the compression codec
+        """
+        return self._archive_format
+
+    @archive_format.setter
+    def archive_format(self, val):
+        self._archive_format = val
+
+    ###########################################################################
+    @property
+    def restore_parallel_collections(self):
+        """
+            mongorestore --numParallelCollections for 3.0+ destinations. When
+            not set, it is chosen from the dumped collection sizes and the
+            destination core count
+        """
+        return self._restore_parallel_collections
+
+    @restore_parallel_collections.setter
+    def restore_parallel_collections(self, val):
+        self._restore_parallel_collections = val
+
+    ###########################################################################
+    def _indexed_archive(self):
+        if self.archive_format not in (None, ARCHIVE_FORMAT_TAR,
+                                       ARCHIVE_FORMAT_INDEXED):
+            raise ConfigurationError("Unknown archive format '%s'" %
+                                     self.archive_format)
+        return self.archive_format == ARCHIVE_FORMAT_INDEXED
+
+    ###########################################################################
+    def _archive_file_extension(self):
+        if self._indexed_archive():
+            return INDEXED_ARCHIVE_EXTENSION
+        return _archive_extension(self.compression)
+
     ###########################################################################
     def to_document(self, display_only=False):
         doc = BackupStrategy.to_document(self, display_only=display_only)
@@ -1203,6 +1351,28 @@ class DumpStrategy(BackupStrategy):
         if self.dump_users is not None:
             doc["dumpUsers"] = self.dump_users
 
+        if self.streaming_upload is not None:
+            doc["streamingUpload"] = self.streaming_upload
+
+        if self.streaming_restore is not None:
+            doc["streamingRestore"] = self.streaming_restore
+
+        if self.parallel_dump_workers is not None:
+            doc["parallelDumpWorkers"] = self.parallel_dump_workers
+
+        if self.parallel_dump_without_oplog is not None:
+            doc["parallelDumpWithoutOplog"] = self.parallel_dump_without_oplog
+
+        if self.compression:
+            doc["compression"] = self.compression.to_document(display_only=display_only)
+
+        if self.archive_format is not None:
+            doc["archiveFormat"] = self.archive_format
+
+        if self.restore_parallel_collections is not None:
+            doc["restoreParallelCollections"] = \
+                self.restore_parallel_collections
+
         return doc
 
     ###########################################################################
@@ -1234,24 +1404,148 @@ class DumpStrategy(BackupStrategy):
                 self._tar_and_upload_failed_dump(backup)
                 raise
 
+        # upload the dump as dedup chunks
+        if self._should_dedup_dump(backup):
+            self._dedup_dump(backup)
+
+        # tar and upload the dump in one pipe
+        if self._should_stream_dump(backup):
+            self._stream_dump(backup)
+
         # tar the dump
-        if not backup.is_event_logged(EVENT_END_ARCHIVE):
+        if (not backup.is_event_logged(EVENT_END_ARCHIVE) and
+                not backup.is_event_logged(EVENT_END_UPLOAD)):
             self._archive_dump(backup)
 
         # upload back file to the target
         if not backup.is_event_logged(EVENT_END_UPLOAD):
             self._upload_dump(backup)
 
+    ###########################################################################
+    def _should_dedup_dump(self, backup):
+        """
+            Dedup is used when all targets are in dedup mode and the dump has
+            not been archived already
+        """
+        if (backup.is_event_logged(EVENT_END_ARCHIVE) or
+                backup.is_event_logged(EVENT_END_UPLOAD)):
+            return False
+
+        all_targets = _backup_all_targets(backup)
+        dedup_targets = filter(lambda t: t.dedup, all_targets)
+        if not dedup_targets:
+            return False
+        elif len(dedup_targets) != len(all_targets):
+            logger.info("Backup '%s' has targets that are not in dedup mode."
+                        " Falling back to tar then upload" % backup.id)
+            return False
+
+        return True
+
+    ###########################################################################
+    def _dedup_dump(self, backup):
+        dump_dir = _backup_dump_dir_name(backup)
+        upload_dest_path = _dedup_manifest_dest(backup)
+        logger.info("Uploading dump %s as dedup chunks with manifest %s" %
+                    (dump_dir, upload_dest_path))
+
+        # chunks do not resume partial uploads of a previous attempt
+        self._discard_upload_ledgers(backup)
+        update_backup(backup, properties="uploadLedgers",
+                      event_name=EVENT_START_UPLOAD,
+                      message="Upload dedup chunks to target")
+
+        all_targets = _backup_all_targets(backup)
+        target_references = self.backup_assistant.dedup_upload_backup(
+            backup, dump_dir, all_targets, destination_path=upload_dest_path)
+
+        self._set_upload_target_references(backup, all_targets,
+                                           target_references)
+
+        # only delete the dump once END_UPLOAD is recorded. A task resumed
+        # before that has to upload the dump again
+        self.backup_assistant.delete_dump_dir(backup, dump_dir)
+
+    ###########################################################################
+    def _should_stream_dump(self, backup):
+        """
+            Streaming is only used if the dump has not been archived already
+            (i.e. a non-streaming attempt that left a tar file behind) and
+            all targets support stream uploads
+        """
+        if not self.streaming_upload:
+            return False
+
+        # indexed archives are written with their index then uploaded
+        if self._indexed_archive():
+            return False
+
+        if (backup.is_event_logged(EVENT_END_ARCHIVE) or
+                backup.is_event_logged(EVENT_END_UPLOAD)):
+            return False
+
+        non_streaming_targets = filter(
+            lambda t: not t.supports_stream_upload, _backup_all_targets(backup))
+        if non_streaming_targets:
+            logger.info("Backup '%s' has targets that do not support stream "
+                        "uploads (%s). Falling back to tar then upload" %
+                        (backup.id, non_streaming_targets[0].target_type))
+            return False
+
+        return True
+
+    ###########################################################################
+    def _stream_dump(self, backup):
+        dump_dir = _backup_dump_dir_name(backup)
+        upload_dest_path = _upload_file_dest(backup,
+                                             self._archive_file_extension())
+        logger.info("Streaming dump %s to target(s) as %s" %
+                    (dump_dir, upload_dest_path))
+
+        # streams do not resume partial uploads of a previous attempt
+        self._discard_upload_ledgers(backup)
+        update_backup(backup, properties="uploadLedgers",
+                      event_name=EVENT_START_ARCHIVE,
+                      message="Taring dump (streaming to target)")
+        update_backup(backup,
+                      event_name=EVENT_START_UPLOAD,
+                      message="Upload tar stream to target")
+
+        all_targets = _backup_all_targets(backup)
+        target_references = self.backup_assistant.stream_backup(
+            backup, dump_dir, all_targets, destination_path=upload_dest_path,
+            codec=self.compression)
+
+        # END_UPLOAD is recorded before END_ARCHIVE so that a resumed backup
+        # never attempts to tar the dump again
+        self._set_upload_target_references(backup, all_targets,
+                                           target_references)
+
+        # only delete the dump once END_UPLOAD is recorded. A task resumed
+        # before that has to stream the dump again
+        self.backup_assistant.delete_dump_dir(backup, dump_dir)
+
+        update_backup(backup,
+                      event_name=EVENT_END_ARCHIVE,
+                      message="Taring completed")
+
     ###########################################################################
     def _archive_dump(self, backup):
         dump_dir = _backup_dump_dir_name(backup)
-        tar_filename = _tar_file_name(backup)
+        tar_filename = _tar_file_name(backup, self._archive_file_extension())
         logger.info("Taring dump %s to %s" % (dump_dir, tar_filename))
-        update_backup(backup,
+        # a new tar can not resume uploads of a previous one
+        self._discard_upload_ledgers(backup)
+        update_backup(backup, properties="uploadLedgers",
                       event_name=EVENT_START_ARCHIVE,
                       message="Taring dump")
 
-        self.backup_assistant.tar_backup(backup, dump_dir, tar_filename)
+        if self._indexed_archive():
+            self.backup_assistant.indexed_archive_backup(backup, dump_dir,
+                                                         tar_filename)
+        else:
+            self.backup_assistant.tar_backup(backup, dump_dir, tar_filename,
+                                             codec=self.compression)
 
         update_backup(backup,
                       event_name=EVENT_END_ARCHIVE,
@@ -1259,28 +1553,139 @@ class DumpStrategy(BackupStrategy):
 
     ###########################################################################
     def _upload_dump(self, backup):
-        tar_file_name = _tar_file_name(backup)
+        tar_file_name = _tar_file_name(backup, self._archive_file_extension())
         logger.info("Uploading %s to target" % tar_file_name)
 
         update_backup(backup,
                       event_name=EVENT_START_UPLOAD,
                       message="Upload tar to target")
-        upload_dest_path = _upload_file_dest(backup)
+        upload_dest_path = _upload_file_dest(backup,
+                                             self._archive_file_extension())
+
+        all_targets = _backup_all_targets(backup)
+
+        # secondary targets that the provider can fill by copying the file of
+        # the primary target are not uploaded to
+        copy_indexes = self._get_server_side_copy_indexes(all_targets)
+        upload_indexes = [i for i in range(len(all_targets)) if i not in copy_indexes]
+
+        # Upload to all targets simultaneously. Multi-part puts save their
+        # progress in the backup's upload ledgers to resume after a restart
+        upload_ledgers = self._get_upload_ledgers(backup, all_targets)
+        uploaded_references = self.backup_assistant.upload_backup(
+            backup, tar_file_name, [all_targets[i] for i in upload_indexes],
+            destination_path=upload_dest_path,
+            upload_ledgers=[upload_ledgers[i] for i in upload_indexes])
+
+        target_references = [None] * len(all_targets)
+        for i, reference in zip(upload_indexes, uploaded_references):
+            target_references[i] = reference
+
+        for i in copy_indexes:
+            target_references[i] = self._copy_to_secondary_target(
+                backup, all_targets[0], target_references[0], all_targets[i],
+                tar_file_name, upload_dest_path, upload_ledgers[i])
+
+        # record where the index is so that restores do not read the footer
+        if self._indexed_archive():
+            index = self.backup_assistant.read_indexed_archive_index(
+                backup, tar_file_name)
+            target_references = [indexed_archive_reference(reference, index)
+                                 for reference in target_references]
+
+        self._set_upload_target_references(backup, all_targets,
+                                           target_references)
+
+    ###########################################################################
+    def _get_server_side_copy_indexes(self, all_targets):
+        copy_indexes = []
+        for i, target in enumerate(all_targets[1:], 1):
+            try:
+                if target.can_copy_from(all_targets[0]):
+                    copy_indexes.append(i)
+            except Exception, e:
+                logger.error("Error while checking if target '%s' can copy from"
+                             " the primary target: %s" % (target.container_name, e))
 
-        all_targets = [backup.target]
+        return copy_indexes
 
-        if backup.secondary_targets:
-            all_targets.extend(backup.secondary_targets)
+    ###########################################################################
+    def _copy_to_secondary_target(self, backup, primary_target, primary_reference, target,
+                                  tar_file_name, upload_dest_path, upload_ledger):
+        """
+            Copies the uploaded file of the primary target to target provider
+            side. Falls back to uploading it when the copy fails
+        """
+        try:
+            target_reference = target.copy_file_from(primary_target, primary_reference, upload_dest_path)
+            update_backup(backup, message="Copied backup file to secondary target '%s' server side" %
+                                          target.container_name)
+            # drop the partial upload of an attempt whose copy failed
+            _cancel_ledger_upload(target, upload_ledger)
+            return target_reference
+        except Exception:
+            msg = ("Server side copy to secondary target '%s' failed. Uploading instead" %
+                   target.container_name)
+            logger.exception("%s (backup '%s')" % (msg, backup.id))
+            update_backup(backup, event_type=EventType.WARNING, message=msg)
+
+        return self.backup_assistant.upload_backup(backup, tar_file_name, target,
+                                                   destination_path=upload_dest_path,
+                                                   upload_ledgers=[upload_ledger])
+
+    ###########################################################################
+    def _get_upload_ledgers(self, backup, all_targets):
+        """
+            Returns the upload ledger of each target (the persisted ones of a
+            previous attempt if any). Ledger changes are saved right away
+        """
+        existing = dict((ledger.target_index, ledger)
+                        for ledger in (backup.upload_ledgers or []))
+        ledgers = [existing.get(i) or UploadLedger(target_index=i)
+                   for i in range(len(all_targets))]
+        backup.upload_ledgers = ledgers
+
+        save_lock = Lock()
 
-        # Upload to all targets simultaneously
+        def save_ledgers(ledger):
+            with save_lock:
+                update_backup(backup, properties="uploadLedgers")
+
+        for ledger in ledgers:
+            ledger.on_change = save_ledgers
+
+        return ledgers
+
+    ###########################################################################
+    def _discard_upload_ledgers(self, backup):
+        """
+            Cancels the partial uploads recorded in the backup's upload
+            ledgers so that they do not linger in the targets then drops the
+            ledgers. Callers save the backup
+        """
+        if backup.upload_ledgers:
+            all_targets = _backup_all_targets(backup)
+            for ledger in backup.upload_ledgers:
+                if ledger.target_index < len(all_targets):
+                    _cancel_ledger_upload(all_targets[ledger.target_index],
+                                          ledger)
 
-        target_references = self.backup_assistant.upload_backup(backup, tar_file_name, all_targets,
-                                                                destination_path=upload_dest_path)
+        backup.upload_ledgers = None
 
+    ###########################################################################
+    def _set_upload_target_references(self, backup, all_targets,
+                                      target_references):
         if len(target_references) != len(all_targets):
             raise TargetUploadError("Upload target mismatch! requested to upload to %s targets and got %s target"
                                     " references back" % (len(all_targets), len(target_references)))
 
+        # record the codec so that restores pick the right decompressor
+        if self.compression:
+            for reference in target_references:
+                if not isinstance(reference, (ChunkManifestReference,
+                                              IndexedArchiveReference)):
+                    reference.compression = self.compression.name
+
         # set the target reference
         target_reference = target_references[0]
 
@@ -1293,8 +1698,12 @@ class DumpStrategy(BackupStrategy):
         if backup.secondary_targets:
             backup.secondary_target_references = target_references[1:]
 
+        # upload is complete. nothing to resume
+        backup.upload_ledgers = None
+
         update_backup(backup, properties=["targetReference",
-                                          "secondaryTargetReferences"],
+                                          "secondaryTargetReferences",
+                                          "uploadLedgers"],
                       event_name=EVENT_END_UPLOAD,
                       message="Upload completed!")
 
@@ -1416,7 +1825,12 @@ class DumpStrategy(BackupStrategy):
 
         log_file_name = _log_file_name(backup)
         # execute dump command
-        dump_info = self.backup_assistant.dump_backup(backup, uri, destination, log_file_name, options=dump_options)
+        if self._should_parallel_dump(uri_wrapper, dump_options):
+            dump_info = self._parallel_dump_backup(backup, mongo_connector, uri, destination, log_file_name,
+                                                   dump_options)
+        else:
+            dump_info = self.backup_assistant.dump_backup(backup, uri, destination, log_file_name,
+                                                          options=dump_options)
         if dump_info and "dumpCollectionCounts" in dump_info:
             backup.data_stats["dumpCollectionCounts"] = dump_info["dumpCollectionCounts"]
 
@@ -1424,6 +1838,82 @@ class DumpStrategy(BackupStrategy):
                       event_name=EVENT_END_EXTRACT,
                       message="Dump completed")
 
+    ###########################################################################
+    def _should_parallel_dump(self, uri_wrapper, dump_options):
+        if not self.parallel_dump_workers or int(self.parallel_dump_workers) < 2:
+            return False
+
+        # only server level dumps are split
+        if uri_wrapper.database:
+            return False
+
+        if "--oplog" in dump_options and not self.parallel_dump_without_oplog:
+            logger.info("Not using parallel dump because --oplog is needed and "
+                        "parallelDumpWithoutOplog is not set")
+            return False
+
+        return True
+
+    ###########################################################################
+    def _parallel_dump_backup(self, backup, mongo_connector, uri, destination, log_file_name, dump_options):
+        """
+            Dumps each database with its own dump process (at most
+            parallel_dump_workers at a time) into destination then merges the
+            dump logs into log_file_name
+        """
+        # --oplog can't be used for database level dumps
+        db_dump_options = filter(lambda option: option != "--oplog", dump_options)
+        if len(db_dump_options) != len(dump_options):
+            logger.warning("Parallel dump for backup '%s' will not be point-in-time (no --oplog)" % backup.id)
+
+        # largest databases first so that they do not end up running last
+        db_list = mongo_connector.admin_db.command("listDatabases")["databases"]
+        db_list = sorted(db_list, key=lambda db: db.get("sizeOnDisk") or 0, reverse=True)
+        database_names = [db["name"] for db in db_list if db["name"] != "local"]
+
+        if not uri.endswith("/"):
+            uri += "/"
+
+        dump_jobs = []
+        for database_name in database_names:
+            dump_jobs.append({
+                "uri": uri + database_name,
+                "logFileName": "%s.%s" % (log_file_name, database_name)
+            })
+
+        worker_count = min(int(self.parallel_dump_workers), len(dump_jobs))
+        logger.info("Dumping %s databases of backup '%s' using %s parallel dump processes" %
+                    (len(dump_jobs), backup.id, worker_count))
+
+        state = {
+            "jobs": list(dump_jobs),
+            "dumpInfos": [],
+            "error": None,
+            "lock": Lock()
+        }
+
+        def dump_database(job):
+            return self.backup_assistant.dump_backup(backup, job["uri"], destination, job["logFileName"],
+                                                     options=list(db_dump_options))
+
+        workers = []
+        for i in range(worker_count):
+            worker = ParallelDumpWorker(dump_database, state)
+            workers.append(worker)
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+        # merge logs even on failure so that the uploaded dump log is complete
+        self.backup_assistant.merge_dump_log_files(backup, destination,
+                                                   [job["logFileName"] for job in dump_jobs], log_file_name)
+
+        if state["error"]:
+            raise state["error"]
+
+        return _merge_dump_infos(state["dumpInfos"])
+
     ###########################################################################
     def _needs_new_member_selection(self, backup):
         """
@@ -1449,13 +1939,8 @@ class DumpStrategy(BackupStrategy):
 
         logger.info("Running dump restore '%s'" % restore.id)
         self.backup_assistant.create_task_workspace(restore)
-        # download source backup tar
-        if not restore.is_event_logged("END_DOWNLOAD_BACKUP"):
-            self._download_source_backup(restore)
-
-        if not restore.is_event_logged("END_EXTRACT_BACKUP"):
-            # extract tar
-            self._extract_source_backup(restore)
+        # download and extract source backup tar
+        self._download_and_extract_source_backup(restore)
 
         try:
 
@@ -1470,37 +1955,88 @@ class DumpStrategy(BackupStrategy):
 
 
     ###########################################################################
-    def _download_source_backup(self, restore):
+    def _download_and_extract_source_backup(self, restore, backup=None):
+        # restores that already downloaded the tar (e.g. resumed restores
+        # that did not stream) extract it from disk
+        if (not restore.is_event_logged("END_DOWNLOAD_BACKUP") and
+                self._can_stream_restore(restore, backup=backup)):
+            self._stream_source_backup(restore, backup=backup)
+            return
+
+        if not restore.is_event_logged("END_DOWNLOAD_BACKUP"):
+            self._download_source_backup(restore, backup=backup)
+
+        if not restore.is_event_logged("END_EXTRACT_BACKUP"):
+            self._extract_source_backup(restore, backup=backup)
+
+    ###########################################################################
+    def _can_stream_restore(self, restore, backup=None):
+        backup = backup or restore.source_backup
+        return (self.streaming_restore and
+                not isinstance(backup.target_reference,
+                               (ChunkManifestReference,
+                                IndexedArchiveReference)) and
+                backup.target.supports_stream_download)
+
+    ###########################################################################
+    def _stream_source_backup(self, restore, backup=None):
+        """
+            Downloads and extracts the source backup in one pipe. Logs the
+            download and extract events of the two step restore so that
+            restores can be resumed by either path
+        """
+        backup = backup or restore.source_backup
+        members = None
+        if restore.source_database_name:
+            dump_dir = _archive_dump_dir_name(backup.target_reference)
+            members = ["%s/%s" % (dump_dir, restore.source_database_name)]
+
         update_restore(restore, event_name="START_DOWNLOAD_BACKUP",
                        message="Download source backup file...")
+        update_restore(restore, event_name="START_EXTRACT_BACKUP",
+                       message="Extract backup file while downloading...")
 
-        self.backup_assistant.download_restore_source_backup(restore)
+        self.backup_assistant.stream_restore_source_backup(
+            restore, backup=backup, members=members)
+
+        update_restore(restore, event_name="END_DOWNLOAD_BACKUP",
+                       message="Source backup file download complete!")
+        update_restore(restore, event_name="END_EXTRACT_BACKUP",
+                       message="Extract backup file completed!")
+
+    ###########################################################################
+    def _download_source_backup(self, restore, backup=None):
+        update_restore(restore, event_name="START_DOWNLOAD_BACKUP",
+                       message="Download source backup file...")
+
+        self.backup_assistant.download_restore_source_backup(restore, backup=backup)
 
         update_restore(restore, event_name="END_DOWNLOAD_BACKUP",
                        message="Source backup file download complete!")
 
 
     ###########################################################################
-    def _extract_source_backup(self, restore):
+    def _extract_source_backup(self, restore, backup=None):
         update_restore(restore, event_name="START_EXTRACT_BACKUP",
                        message="Extract backup file...")
 
-        self.backup_assistant.extract_restore_source_backup(restore)
+        self.backup_assistant.extract_restore_source_backup(restore, backup=backup)
 
         update_restore(restore, event_name="END_EXTRACT_BACKUP",
                        message="Extract backup file completed!")
 
     ###########################################################################
-    def _restore_dump(self, restore):
+    def _restore_dump(self, restore, source_backup=None):
 
-        file_reference = restore.source_backup.target_reference
+        source_backup = source_backup or restore.source_backup
+        file_reference = source_backup.target_reference
 
         update_restore(restore, event_name="START_RESTORE_DUMP",
                        message="Running mongorestore...")
 
         # run mongoctl restore
         logger.info("Restoring using mongoctl restore")
-        dump_dir = file_reference.file_name[: -4]
+        dump_dir = _archive_dump_dir_name(file_reference)
 
 
 
@@ -1510,7 +2046,7 @@ class DumpStrategy(BackupStrategy):
 
         dest_uri_wrapper = mongo_uri_tools.parse_mongo_uri(dest_uri)
 
-        source_stats = restore.source_backup.source_stats
+        source_stats = source_backup.source_stats
         source_mongo_version = source_stats and "version" in source_stats and \
                                MongoNormalizedVersion(source_stats["version"])
         dest_mongo_version = mongo_connector.get_mongo_version()
@@ -1537,11 +2073,11 @@ class DumpStrategy(BackupStrategy):
 
         source_database_name = restore.source_database_name
         if not source_database_name:
-            if restore.source_backup.source.database_name:
+            if source_backup.source.database_name:
                 source_database_name =\
-                    restore.source_backup.source.database_name
+                    source_backup.source.database_name
             else:
-                stats = restore.source_backup.source_stats
+                stats = source_backup.source_stats
                 source_database_name = stats.get("databaseName")
 
         # map source/dest
@@ -1555,7 +2091,7 @@ class DumpStrategy(BackupStrategy):
 
         # append  --oplogReplay for cluster backups/restore
         if (not source_database_name and
-            "repl" in restore.source_backup.source_stats):
+            "repl" in source_backup.source_stats):
             restore_options.append("--oplogReplay")
 
         # if mongo version is >= 2.4 and we are using admin creds then pass
@@ -1579,7 +2115,11 @@ class DumpStrategy(BackupStrategy):
             # stop on errors for 3.0 restores
             restore_options.append("--stopOnError")
             # numParallelCollections
-            restore_options.extend(["--numParallelCollections", "1"])
+            parallelism = self._get_restore_parallelism(
+                restore, mongo_connector, dump_dir, source_database_name)
+            restore_options.extend([
+                "--numParallelCollections",
+                str(parallelism["numParallelCollections"])])
             # default write concern to majority
             restore_options.extend(["--writeConcern", "majority"])
 
@@ -1589,10 +2129,14 @@ class DumpStrategy(BackupStrategy):
 
         restore_options = self._apply_restore_options_overrides(restore_options)
 
+        if dest_mongo_version >= VERSION_3_0:
+            self._record_restore_parallelism(restore, parallelism,
+                                             restore_options)
+
         # execute dump command
         restore_info = self.backup_assistant.run_mongo_restore(
             restore, dest_uri, dump_dir, source_database_name,
-            _restore_log_file_name(restore), _log_file_name(restore.source_backup),
+            _restore_log_file_name(restore), _log_file_name(source_backup),
             exclude_admin_system_users=exclude_admin_system_users,
             exclude_system_users=exclude_system_users,
             exclude_system_roles=exclude_system_roles,
@@ -1715,6 +2259,49 @@ class DumpStrategy(BackupStrategy):
                     restore.id)
 
 
+    ###########################################################################
+    def _get_restore_parallelism(self, restore, mongo_connector, dump_dir,
+                                 source_database_name):
+        """
+            Returns the restore parallelism document recorded on the restore
+        """
+        if self.restore_parallel_collections:
+            return {
+                "numParallelCollections": self.restore_parallel_collections,
+                "source": "strategy"
+            }
+
+        collection_sizes = self.backup_assistant.get_dump_collection_sizes(
+            restore, dump_dir, source_database_name=source_database_name)
+        sizes = (collection_sizes or {}).values()
+        num_cores = mongo_connector.get_num_cores()
+
+        return {
+            "numParallelCollections":
+                choose_num_parallel_collections(sizes, num_cores=num_cores),
+            "source": "auto",
+            "collectionCount": len(sizes),
+            "totalSize": sum(sizes),
+            "largestCollectionSize": max(sizes) if sizes else 0,
+            "destinationCores": num_cores
+        }
+
+    ###########################################################################
+    def _record_restore_parallelism(self, restore, parallelism,
+                                    restore_options):
+        # restore options overrides win
+        value = _option_list_to_dict(restore_options).get(
+            "--numParallelCollections")
+        if value and str(value[0]) != str(
+                parallelism["numParallelCollections"]):
+            parallelism["numParallelCollections"] = int(value[0])
+            parallelism["source"] = "restoreOptionsOverrides"
+
+        logger.info("Restore '%s' numParallelCollections: %s" %
+                    (restore.id, parallelism))
+        restore.restore_parallelism = parallelism
+        update_restore(restore, properties="restoreParallelism")
+
     ###########################################################################
     def _apply_dump_options_overrides(self, dump_options):
         return self._apply_mongoctl_options_overrides(dump_options, self.dump_options_overrides)
@@ -1743,6 +2330,326 @@ class DumpStrategy(BackupStrategy):
         # convert
         return _dict_to_option_list(options_dict)
 
+###############################################################################
+# OplogIncrementalStrategy
+###############################################################################
+class OplogIncrementalStrategy(DumpStrategy):
+    """
+        Dump strategy that only takes a full (base) dump every
+        max_incrementals + 1 backups of a plan. Backups in between only dump
+        the oplog entries written since the previous backup of the chain.
+        Restoring an incremental restores the base dump then replays the oplog
+        of every incremental of the chain in order.
+        Only for server level backups of replica set members
+    """
+    ###########################################################################
+    def __init__(self):
+        DumpStrategy.__init__(self)
+        self._max_incrementals = DEFAULT_MAX_INCREMENTALS
+
+    ###########################################################################
+    @property
+    def max_incrementals(self):
+        return self._max_incrementals
+
+    @max_incrementals.setter
+    def max_incrementals(self, val):
+        self._max_incrementals = val
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        doc = DumpStrategy.to_document(self, display_only=display_only)
+        doc.update({
+            "_type": "OplogIncrementalStrategy",
+            "maxIncrementals": self.max_incrementals
+        })
+
+        return doc
+
+    ###########################################################################
+    def dump_backup(self, backup, mongo_connector, database_name=None):
+        """
+            Override
+        """
+        if database_name or not mongo_connector.is_replica_member():
+            logger.info("Backup '%s' is not a server level backup of a replica"
+                        " member. Taking a full dump" % backup.id)
+            return DumpStrategy.dump_backup(self, backup, mongo_connector,
+                                            database_name=database_name)
+
+        oplog = mongo_connector.get_db("local")["oplog.rs"]
+        end_ts = _get_oplog_last_ts(oplog)
+        previous = self._get_previous_chain_backup(backup)
+        if previous and self._can_dump_incremental(backup, previous, oplog):
+            previous_info = get_oplog_incremental_info(previous)
+            backup.data_stats[OPLOG_INCREMENTAL_KEY] = {
+                "baseBackupId": previous_info["baseBackupId"],
+                "previousBackupId": previous.id,
+                "chainLength": previous_info["chainLength"] + 1,
+                "startTs": previous_info["endTs"],
+                "endTs": end_ts
+            }
+            self._dump_oplog_range(backup, mongo_connector,
+                                   previous_info["endTs"], end_ts)
+        else:
+            # the next incremental starts at the last oplog entry before the
+            # dump started. Overlapping with the oplog of the dump is fine
+            # since replaying oplog entries is idempotent
+            backup.data_stats[OPLOG_INCREMENTAL_KEY] = {
+                "baseBackupId": backup.id,
+                "previousBackupId": None,
+                "chainLength": 0,
+                "startTs": None,
+                "endTs": end_ts
+            }
+            DumpStrategy.dump_backup(self, backup, mongo_connector)
+
+    ###########################################################################
+    def _get_previous_chain_backup(self, backup):
+        """
+            Returns the last succeeded backup of the backup's plan that
+            belongs to an incremental chain still available for restore
+        """
+        if not backup.plan:
+            return None
+
+        q = {
+            "plan._id": backup.plan.id,
+            "state": State.SUCCEEDED,
+            "expiredDate": None,
+            "dataStats.%s" % OPLOG_INCREMENTAL_KEY: {"$exists": True}
+        }
+        s = [("createdDate", -1)]
+        previous = get_mbs().backup_collection.find_one(q, sort=s)
+        if not previous:
+            return None
+
+        # every link of the chain has to be restorable for the new
+        # incremental to be
+        try:
+            chain = get_restore_chain(previous)
+        except BrokenIncrementalChainError, e:
+            logger.info("Chain of backup '%s' is broken. Taking a full dump: "
+                        "%s" % (previous.id, e.detailed_message))
+            return None
+
+        expired = filter(lambda b: b.expired, chain)
+        if expired:
+            logger.info("Backup '%s' of the chain of backup '%s' has expired."
+                        " Taking a full dump" % (expired[0].id, previous.id))
+            return None
+
+        return previous
+
+    ###########################################################################
+    def _can_dump_incremental(self, backup, previous, oplog):
+        previous_info = get_oplog_incremental_info(previous)
+        if previous_info["chainLength"] >= self.max_incrementals:
+            logger.info("Chain of backup '%s' reached max incrementals (%s)."
+                        " Taking a full dump" % (previous.id,
+                                                 self.max_incrementals))
+            return False
+
+        first_ts = _get_oplog_first_ts(oplog)
+        if not first_ts or first_ts > previous_info["endTs"]:
+            msg = ("Oplog does not cover the time since backup '%s'. Taking a"
+                   " full dump" % previous.id)
+            logger.warning(msg)
+            update_backup(backup, event_type=EventType.WARNING, message=msg)
+            return False
+
+        return True
+
+    ###########################################################################
+    def _dump_oplog_range(self, backup, mongo_connector, start_ts, end_ts):
+        update_backup(backup, properties="dataStats",
+                      event_name=EVENT_START_EXTRACT,
+                      message="Dumping oplog since backup '%s'" %
+                              get_oplog_incremental_info(backup)[
+                                  "previousBackupId"])
+
+        uri = mongo_connector.dump_uri()
+        if not uri.endswith("/"):
+            uri += "/"
+        uri += "local"
+
+        query = {
+            "ts": {
+                "$gt": start_ts,
+                "$lte": end_ts
+            }
+        }
+        dump_options = [
+            "--collection", "oplog.rs",
+            "--query", json_util.dumps(query)
+        ]
+        if mongo_connector.get_mongo_version() >= \
+                MongoNormalizedVersion("2.4.0"):
+            dump_options.extend(["--authenticationDatabase", "admin"])
+
+        self.backup_assistant.dump_backup(backup, uri,
+                                          _backup_dump_dir_name(backup),
+                                          _log_file_name(backup),
+                                          options=dump_options)
+
+        update_backup(backup, properties="dataStats",
+                      event_name=EVENT_END_EXTRACT,
+                      message="Oplog dump completed")
+
+    ###########################################################################
+    # Restore implementation
+    ###########################################################################
+    def _do_run_restore(self, restore):
+        chain = get_restore_chain(restore.source_backup)
+        if len(chain) == 1:
+            return DumpStrategy._do_run_restore(self, restore)
+
+        if restore.source_database_name or restore.destination.database_name:
+            raise ConfigurationError("Database level restores of incremental"
+                                     " backups are not supported")
+
+        logger.info("Running incremental restore '%s' from base backup '%s' "
+                    "and %s incrementals" % (restore.id, chain[0].id,
+                                             len(chain) - 1))
+        self.backup_assistant.create_task_workspace(restore)
+
+        base = chain[0]
+        self._download_and_extract_source_backup(restore, backup=base)
+
+        if not restore.is_event_logged("END_RESTORE_DUMP"):
+            self._restore_dump(restore, source_backup=base)
+
+        for incremental in chain[1:]:
+            if not restore.is_event_logged(_apply_oplog_event(incremental)):
+                self._apply_incremental(restore, incremental)
+
+    ###########################################################################
+    def _apply_incremental(self, restore, incremental):
+        update_restore(restore, event_name="START_APPLY_OPLOG",
+                       message="Replaying oplog of incremental backup '%s'" %
+                               incremental.id)
+
+        self.backup_assistant.download_restore_source_backup(
+            restore, backup=incremental)
+        self.backup_assistant.extract_restore_source_backup(
+            restore, backup=incremental)
+
+        dump_dir = _archive_dump_dir_name(incremental.target_reference)
+        self.backup_assistant.prepare_oplog_replay_dump(restore, dump_dir)
+
+        mongo_connector = self.get_restore_mongo_connector(restore)
+        restore_options = ["--oplogReplay"]
+        if mongo_connector.get_mongo_version() >= \
+                MongoNormalizedVersion("2.4.0"):
+            restore_options.extend(["--authenticationDatabase", "admin"])
+
+        self.backup_assistant.run_mongo_restore(
+            restore, mongo_connector.restore_uri(), dump_dir, None,
+            "RESTORE_OPLOG_%s.log" % _backup_dump_dir_name(incremental),
+            _log_file_name(incremental), options=restore_options)
+
+        update_restore(restore, event_name=_apply_oplog_event(incremental),
+                       message="Replayed oplog of incremental backup '%s'" %
+                               incremental.id)
+
+###############################################################################
+def get_oplog_incremental_info(backup):
+    """
+        Incremental chain info recorded by OplogIncrementalStrategy or None
+    """
+    return (backup.data_stats or {}).get(OPLOG_INCREMENTAL_KEY)
+
+###############################################################################
+def get_restore_chain(backup):
+    """
+        Returns the backups needed to restore backup: its base dump followed
+        by its incrementals up to backup (just [backup] for full dumps)
+    """
+    chain = [backup]
+    info = get_oplog_incremental_info(backup)
+    while info and info["previousBackupId"]:
+        previous_id = info["previousBackupId"]
+        previous = get_mbs().backup_collection.get_by_id(previous_id)
+        if not _is_backup_restorable(previous):
+            raise BrokenIncrementalChainError(backup.id, previous_id)
+        previous_info = get_oplog_incremental_info(previous)
+        reason = _chain_link_error(info, previous_info)
+        if reason:
+            raise BrokenIncrementalChainError(backup.id, previous_id,
+                                              reason=reason)
+        chain.insert(0, previous)
+        info = previous_info
+
+    # the chain has to start at a full dump
+    if info and (info["baseBackupId"] != chain[0].id or info["startTs"]):
+        raise BrokenIncrementalChainError(backup.id, chain[0].id,
+                                          reason="is not a base backup")
+
+    return chain
+
+###############################################################################
+def _chain_link_error(info, previous_info):
+    """
+        Returns why an incremental (info) does not follow on from the
+        previous backup of its chain (previous_info) or None
+    """
+    if not previous_info:
+        return "is not part of an incremental chain"
+    if previous_info["baseBackupId"] != info["baseBackupId"]:
+        return "belongs to another chain"
+    if previous_info["chainLength"] + 1 != info["chainLength"]:
+        return "is not the previous link of the chain"
+    # oplog ranges are (startTs, endTs] so each starts where the previous ends
+    if previous_info["endTs"] != info["startTs"]:
+        return ("ends its oplog at %s but the next incremental starts at %s" %
+                (previous_info["endTs"], info["startTs"]))
+    return None
+
+###############################################################################
+def _is_backup_restorable(backup):
+    return (backup is not None and backup.state == State.SUCCEEDED and
+            not backup.deleted and
+            backup.target_reference is not None and
+            not backup.target_reference.deleted)
+
+###############################################################################
+def _apply_oplog_event(incremental):
+    return "END_APPLY_OPLOG_%s" % incremental.id
+
+###############################################################################
+def _get_oplog_first_ts(oplog):
+    entry = oplog.find_one(sort=[("$natural", 1)])
+    return entry and entry["ts"]
+
+###############################################################################
+def _get_oplog_last_ts(oplog):
+    entry = oplog.find_one(sort=[("$natural", -1)])
+    return entry and entry["ts"]
+
+###############################################################################
+def choose_num_parallel_collections(collection_sizes, num_cores=None):
+    """
+        Number of collections to restore in parallel given the dumped
+        collection sizes: one per collection big enough to keep a worker busy,
+        no more than needed to restore everything in the time of the largest
+        collection (which is restored by a single worker) and no more than the
+        destination cores
+    """
+    if not collection_sizes:
+        return 1
+
+    total_size = sum(collection_sizes)
+    largest_size = max(collection_sizes)
+    sizable_count = len(filter(lambda size: size >= PARALLEL_COLLECTION_MIN_SIZE,
+                               collection_sizes))
+    useful_count = (total_size + largest_size - 1) / largest_size \
+        if largest_size else 1
+
+    parallelism = min(sizable_count, useful_count,
+                      num_cores or DEFAULT_DESTINATION_CORES,
+                      MAX_PARALLEL_COLLECTIONS)
+    return max(1, parallelism)
+
 ###############################################################################
 def _option_list_to_dict(options):
     """
@@ -1787,8 +2694,36 @@ def _log_file_name(backup):
     return "%s.log" % _backup_dump_dir_name(backup)
 
 ###############################################################################
-def _tar_file_name(backup):
-    return "%s.tgz" % _backup_dump_dir_name(backup)
+def _tar_file_name(backup, extension="tgz"):
+    return "%s.%s" % (_backup_dump_dir_name(backup), extension)
+
+###############################################################################
+def _archive_extension(codec):
+    return codec.file_extension if codec else "tgz"
+
+###############################################################################
+def _archive_dump_dir_name(file_reference):
+    """
+        Name of the dump dir contained in the archive of file_reference
+    """
+    if isinstance(file_reference, ChunkManifestReference):
+        extension = "manifest.json"
+    elif isinstance(file_reference, IndexedArchiveReference):
+        extension = INDEXED_ARCHIVE_EXTENSION
+    elif file_reference.compression:
+        extension = get_codec(file_reference.compression).file_extension
+    else:
+        extension = "tgz"
+    return file_reference.file_name[: -(len(extension) + 1)]
+
+###############################################################################
+def _backup_all_targets(backup):
+    all_targets = [backup.target]
+
+    if backup.secondary_targets:
+        all_targets.extend(backup.secondary_targets)
+
+    return all_targets
 
 ###############################################################################
 def _failed_tar_file_name(backup):
@@ -1802,8 +2737,24 @@ def _backup_dump_dir_name(backup):
     return os.path.basename(backup.name)
 
 ###############################################################################
-def _upload_file_dest(backup):
-    return "%s.tgz" % backup.name
+def _upload_file_dest(backup, extension="tgz"):
+    return "%s.%s" % (backup.name, extension)
+
+###############################################################################
+def _cancel_ledger_upload(target, upload_ledger):
+    if not upload_ledger or not upload_ledger.upload_id:
+        return
+    try:
+        target.cancel_upload(upload_ledger)
+    except Exception, ex:
+        logger.error("Error while cancelling upload '%s' of %s in container "
+                     "'%s': %s" % (upload_ledger.upload_id,
+                                   upload_ledger.destination_path,
+                                   target.container_name, ex))
+
+###############################################################################
+def _dedup_manifest_dest(backup):
+    return dedup_manifest_path(backup.name)
 
 ###############################################################################
 def _upload_log_file_dest(backup):
@@ -2642,6 +3593,55 @@ def _grant_restore_role(connector):
 
     logger.info("restore role granted successfully!")
 
+###############################################################################
+# ParallelDumpWorker
+###############################################################################
+class ParallelDumpWorker(Thread):
+    """
+        Runs dump jobs from the shared state until there are no more jobs or
+        any worker failed
+    """
+    ###########################################################################
+    def __init__(self, dump_func, state):
+        Thread.__init__(self)
+        self.daemon = True
+        self._dump_func = dump_func
+        self._state = state
+
+    ###########################################################################
+    def run(self):
+        state = self._state
+        while True:
+            with state["lock"]:
+                if state["error"] or not state["jobs"]:
+                    return
+                job = state["jobs"].pop(0)
+
+            try:
+                dump_info = self._dump_func(job)
+                with state["lock"]:
+                    state["dumpInfos"].append(dump_info)
+            except Exception, ex:
+                logger.exception("ParallelDumpWorker: error while dumping '%s'" % job["logFileName"])
+                with state["lock"]:
+                    if not state["error"]:
+                        state["error"] = ex
+
+###############################################################################
+def _merge_dump_infos(dump_infos):
+    """
+        Merges dump infos returned by database level dumps into one
+    """
+    dump_collection_counts = {}
+    for dump_info in dump_infos:
+        if dump_info and dump_info.get("dumpCollectionCounts"):
+            dump_collection_counts.update(dump_info["dumpCollectionCounts"])
+
+    if dump_collection_counts:
+        return {
+            "dumpCollectionCounts": dump_collection_counts
+        }
+
 ###############################################################################
 def read_dump_collection_counts(backup):
     """
@@ -6,6 +6,11 @@ import sys
 import logging
 import uuid
 import re
+import time
+import hashlib
+import mimetypes
+
+from cStringIO import StringIO
 
 import cloudfiles
 import cloudfiles.errors
@@ -15,17 +20,20 @@ import mbs
 import s3_utils
 
 from base import MBSObject
+from checksum import (FileChecksum, ChecksumWriter, checksum_file,
+                      iter_checksummed, same_etag, is_md5_etag,
+                      s3_multipart_etag)
 from utils import which, execute_command, export_mbs_object_list, safe_stringify
 from azure.storage.blob.baseblobservice import BaseBlobService
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
 from boto.s3.connection import OrdinaryCallingFormat
 from boto.exception import S3ResponseError
 from cloudfiles.errors import NoSuchContainer, AuthenticationFailed
 
 import errors
 from robustify.robustify import robustify
-from splitfile import SplitFile
-from threading import Thread
+from threading import Thread, Lock, Condition, local
 import requests
 
 ###############################################################################
@@ -40,6 +48,28 @@ logger.addHandler(logging.NullHandler())
 MULTIPART_MIN_SIZE = 100 * 1024 * 1024
 CF_MULTIPART_MIN_SIZE = 5 * 1024 * 1024 * 1024
 MAX_SPLIT_SIZE = 1024 * 1024 * 1024
+# part size used when uploading streams of unknown length
+STREAM_UPLOAD_PART_SIZE = 128 * 1024 * 1024
+# multi-part puts: parts uploaded in parallel and max bytes held by them
+DEFAULT_UPLOAD_CONCURRENCY = 4
+DEFAULT_UPLOAD_MEMORY_BUDGET = 1024 * 1024 * 1024
+# multi-part part planning
+DEFAULT_TARGET_PART_COUNT = 10
+PARTS_PER_UPLOADER = 2
+MIN_PART_SECONDS = 5
+MAX_PART_SECONDS = 120
+# bytes transferred between throttling callbacks of single part transfers
+THROTTLE_CALLBACK_SIZE = 1024 * 1024
+
+DEFAULT_DOWNLOAD_CONCURRENCY = 4
+# smaller files are downloaded in a single stream
+RANGED_DOWNLOAD_MIN_SIZE = 64 * 1024 * 1024
+# value of cloud_storage_encryption for files uploaded with encrypt_key
+S3_ENCRYPTION_ALGORITHM = "AES256"
+# value of cloud_storage_encryption for files of buckets that default to
+# SSE-KMS. Their etags are not md5s
+S3_KMS_ENCRYPTION_ALGORITHM = "aws:kms"
+S3_ENCRYPTION_HEADER = "x-amz-server-side-encryption"
 
 
 # Cloud block storage statuses
@@ -59,6 +89,7 @@ class BackupTarget(MBSObject):
         self._credentials = None
         self._cloud_storage_encryption_enabled = False
         self._region = None
+        self._dedup = None
 
     ###########################################################################
     @property
@@ -109,14 +140,30 @@ class BackupTarget(MBSObject):
         """
         self._cloud_storage_encryption_enabled = bool(val)
 
+    ###########################################################################
+    @property
+    def dedup(self):
+        """
+            When true, dump backups are stored in this target as content
+            addressed chunks plus a per-backup manifest instead of a tarball
+            (see dedup.py)
+        """
+        return self._dedup
+
+    @dedup.setter
+    def dedup(self, val):
+        self._dedup = val
+
     ###########################################################################
     def put_file(self, file_path, destination_path=None,
-                 overwrite_existing=True, metadata=None):
+                 overwrite_existing=True, metadata=None, upload_ledger=None):
         """
             Uploads the specified file path under destination_path.
              destination_path defaults to base name (file name) of file_path
              This is the generic implementation that includes upload
-             verification and returning proper errors
+             verification and returning proper errors.
+             Multi-part puts record their progress in upload_ledger
+             (UploadLedger) when specified and resume from it
         """
         try:
 
@@ -142,12 +189,16 @@ class BackupTarget(MBSObject):
             target_ref = self._robustifiled_put_file(
                 file_path,
                 destination_path=destination_path,
-                metadata=metadata)
+                metadata=metadata,
+                upload_ledger=upload_ledger)
             # set the preserve field
             target_ref.preserve = self.preserve
 
-            # validate that the file has been uploaded successfully
-            self._verify_file_uploaded(destination_path, file_size)
+            # validate that the file has been uploaded successfully. Uploads
+            # whose etag was verified against the checksum of the uploaded
+            # bytes need no extra round-trip
+            if not target_ref.etag:
+                self._verify_file_uploaded(destination_path, file_size)
 
             logger.info("%s: Uploading %s (%s bytes) to container %s "
                         "completed successfully!!" %
@@ -167,14 +218,15 @@ class BackupTarget(MBSObject):
 
     ###########################################################################
     def _robustifiled_put_file(self, file_path, destination_path,
-                               metadata=None):
+                               metadata=None, upload_ledger=None):
         attempt_counter = {
             "count": 0
         }
         return self._do_robustifiled_put_file(
             attempt_counter, file_path,
             destination_path,
-            metadata=metadata)
+            metadata=metadata,
+            upload_ledger=upload_ledger)
 
     ###########################################################################
     @robustify(max_attempts=10, retry_interval=5,
@@ -183,7 +235,7 @@ class BackupTarget(MBSObject):
                do_on_failure=errors.raise_exception,)
     def _do_robustifiled_put_file(self, attempt_counter,
                                   file_path, destination_path,
-                                  metadata=None):
+                                  metadata=None, upload_ledger=None):
         """
            a robustified put file
         """
@@ -194,30 +246,184 @@ class BackupTarget(MBSObject):
                       attempt_counter["count"]))
         # check if we don't need to reupload the file if it was already
         # uploaded through a previous attempt but got interrupted (like
-        # connection reset etc)
-        if attempt_counter["count"] > 1:
-            file_size = os.path.getsize(file_path)
-            if self.file_exists(destination_path,
-                                expected_file_size=file_size):
+        # connection reset etc). A file that failed checksum verification
+        # is always uploaded again
+        if (attempt_counter["count"] > 1 and
+                not attempt_counter.get("checksumMismatch")):
+            target_ref = self._get_previously_uploaded_file(file_path,
+                                                            destination_path)
+            if target_ref:
                 logger.debug("File uploaded through a previous attempt! "
                              "nothing to do!")
-                return FileReference(file_path=destination_path,
-                                     file_size=file_size)
+                return target_ref
+
+        try:
+            return self.do_put_file(file_path, destination_path,
+                                    metadata=metadata,
+                                    upload_ledger=upload_ledger)
+        except errors.UploadedFileChecksumMismatchError:
+            attempt_counter["checksumMismatch"] = True
+            raise
+
+    ###########################################################################
+    def _get_previously_uploaded_file(self, file_path, destination_path):
+        """
+            Returns a reference to destination_path if it holds file_path.
+            Plain md5 etags are compared against the checksum of file_path.
+            Other etags (e.g. multi-part or SSE-KMS uploads) can only be
+            compared by size
+        """
+        file_size = os.path.getsize(file_path)
+        file_info = self._fetch_file_info(destination_path)
+        if not file_info or file_info['size'] != file_size:
+            return None
 
-        return self.do_put_file(file_path, destination_path,
-                                metadata=metadata)
+        etag = file_info.get('etag')
+        encryption = file_info.get('cloud_storage_encryption')
+        if not is_md5_etag(etag) or encryption == S3_KMS_ENCRYPTION_ALGORITHM:
+            return FileReference(file_path=destination_path,
+                                 file_size=file_size,
+                                 cloud_storage_encryption=encryption)
+
+        checksum = checksum_file(file_path)
+        if not same_etag(etag, checksum.md5):
+            logger.info("%s: File '%s' in container '%s' does not match the "
+                        "checksum of '%s'" % (self.target_type,
+                                              destination_path,
+                                              self.container_name, file_path))
+            return None
+
+        return FileReference(file_path=destination_path, file_size=file_size,
+                             cloud_storage_encryption=encryption,
+                             md5=checksum.md5, sha256=checksum.sha256,
+                             etag=etag)
 
     ###########################################################################
-    def do_put_file(self, file_path, destination_path, metadata=None):
+    def do_put_file(self, file_path, destination_path, metadata=None,
+                    upload_ledger=None):
         """
            does the actual work. should be implemented by subclasses
         """
         pass
 
     ###########################################################################
-    def get_file(self, file_reference, destination):
+    def can_copy_from(self, source_target):
+        """
+            True if files of source_target can be copied into this target by
+            the storage provider itself instead of being uploaded again.
+            Should be overridden by subclasses that support it
+        """
+        return False
+
+    ###########################################################################
+    def copy_file_from(self, source_target, source_reference,
+                       destination_path):
+        """
+            Copies the file of source_reference (stored in source_target) to
+            destination_path provider side. Returns the new file reference
+        """
+        try:
+            logger.info("%s: Copying '%s' from container '%s' to '%s' in "
+                        "container '%s'" %
+                        (self.target_type, source_reference.file_path,
+                         source_target.container_name, destination_path,
+                         self.container_name))
+            target_ref = self.do_copy_file_from(source_target,
+                                                source_reference,
+                                                destination_path)
+            target_ref.preserve = self.preserve
+            # copies have the same content
+            target_ref.md5 = source_reference.md5
+            target_ref.sha256 = source_reference.sha256
+            self._verify_file_uploaded(destination_path,
+                                       source_reference.file_size)
+            logger.info("%s: Copying '%s' to container '%s' completed "
+                        "successfully!!" % (self.target_type,
+                                            destination_path,
+                                            self.container_name))
+            return target_ref
+        except Exception, e:
+            logger.exception("BackupTarget.copy_file_from(): Exception caught ")
+            if isinstance(e, errors.TargetError):
+                raise
+            else:
+                raise errors.TargetUploadError(destination_path,
+                                               self.container_name, cause=e)
+
+    ###########################################################################
+    def do_copy_file_from(self, source_target, source_reference,
+                          destination_path):
+        """
+           does the actual copy. should be implemented by subclasses that
+           override can_copy_from()
+        """
+        raise errors.TargetError("%s does not support server side copies" %
+                                 self.target_type)
+
+    ###########################################################################
+    @property
+    def supports_stream_upload(self):
+        """
+            True if the target can upload a stream of unknown length through
+            open_stream_upload()
+        """
+        return False
+
+    ###########################################################################
+    def open_stream_upload(self, destination_path, metadata=None):
+        """
+            Returns a stream upload object (upload_part()/complete()/abort())
+            that uploads destination_path one part at a time.
+            Should be implemented by subclasses that support stream uploads
+        """
+        raise errors.TargetError("%s does not support stream uploads" %
+                                 self.target_type)
+
+    ###########################################################################
+    @property
+    def supports_stream_download(self):
+        """
+            True if the target can write files to a stream (see
+            download_to_stream())
+        """
+        return False
+
+    ###########################################################################
+    @property
+    def supports_range_download(self):
+        """
+            True if the target can read byte ranges of files (see
+            read_range())
+        """
+        return False
+
+    ###########################################################################
+    def read_range(self, file_reference, offset, size, stream):
+        """
+            Writes size bytes of the file of file_reference starting at offset
+            to stream. Not retried.
+            Should be implemented by subclasses that support range downloads
+        """
+        raise errors.TargetError("%s does not support range downloads" %
+                                 self.target_type)
+
+    ###########################################################################
+    def download_to_stream(self, file_reference, stream):
+        """
+            Writes the file of file_reference to stream (e.g. the stdin of an
+            extract process) as it is downloaded. The recorded checksums are
+            verified once all bytes have been written.
+            Should be implemented by subclasses that support stream downloads
+        """
+        raise errors.TargetError("%s does not support stream downloads" %
+                                 self.target_type)
+
+    ###########################################################################
+    def get_file(self, file_reference, destination, concurrency=1):
         """
-            Gets the file references and writes it to the specified destination
+            Gets the file references and writes it to the specified destination.
+            Targets that support ranged downloads download big files in
+            concurrency parallel ranges
         """
 
     ###########################################################################
@@ -227,6 +433,28 @@ class BackupTarget(MBSObject):
         """
         raise Exception( "Not implemented")
 
+    ###########################################################################
+    def cancel_upload(self, upload_ledger):
+        """
+            Discards the partial multi-part upload recorded in upload_ledger
+            (if any). Targets that record uploads in ledgers must override
+        """
+
+    ###########################################################################
+    def _cancel_stale_upload(self, upload_ledger):
+        """
+            Cancels the upload of upload_ledger before the ledger is started
+            over. Errors are logged since they must not fail the new upload
+        """
+        try:
+            self.cancel_upload(upload_ledger)
+        except Exception, ex:
+            logger.error("Error while cancelling stale upload '%s' of %s in "
+                         "container '%s': %s" %
+                         (upload_ledger.upload_id,
+                          upload_ledger.destination_path,
+                          self.container_name, ex))
+
     ###########################################################################
     def delete_file(self, file_reference):
         """
@@ -369,6 +597,9 @@ class BackupTarget(MBSObject):
         if self.region is not None:
             doc["region"] = self.region
 
+        if self.dedup is not None:
+            doc["dedup"] = self.dedup
+
         return doc
 
 ###############################################################################
@@ -387,25 +618,40 @@ class S3BucketTarget(BackupTarget):
         self._connection = None
         self._bucket = None
 
+        self._upload_concurrency = None
+        self._upload_memory_budget = None
+
     ###########################################################################
-    def do_put_file(self, file_path, destination_path, metadata=None):
+    def do_put_file(self, file_path, destination_path, metadata=None,
+                    upload_ledger=None):
         # determine single/multi part upload
 
         try:
             file_size = os.path.getsize(file_path)
+            # checksummed while uploading. The upload etag is verified
+            # against it so no file info needs to be fetched afterwards
+            checksum = FileChecksum()
 
+            upload_plan = None
             if file_size >= MULTIPART_MIN_SIZE:
-                self._multi_part_put(file_path, destination_path, file_size,
-                                     metadata=metadata)
+                upload_plan, encryption = self._multi_part_put(
+                    file_path, destination_path, file_size, metadata=metadata,
+                    upload_ledger=upload_ledger, checksum=checksum)
             else:
-                self._single_part_put(file_path, destination_path,
-                                      metadata=metadata)
-
-            cloud_storage_encryption = self._fetch_file_info(destination_path)['cloud_storage_encryption']
+                encryption = self._single_part_put(file_path,
+                                                   destination_path,
+                                                   metadata=metadata,
+                                                   checksum=checksum)
 
             return FileReference(file_path=destination_path,
                                  file_size=file_size,
-                                 cloud_storage_encryption=cloud_storage_encryption)
+                                 cloud_storage_encryption=(
+                                     self._upload_encryption(
+                                         destination_path, encryption)),
+                                 upload_plan=upload_plan,
+                                 md5=checksum.md5,
+                                 sha256=checksum.sha256,
+                                 etag=checksum.etag)
 
         except S3ResponseError, sre:
             if 403 == sre.status:
@@ -438,6 +684,7 @@ class S3BucketTarget(BackupTarget):
                         'size': not_buggy_key.size,
                         'cloud_storage_encryption': not_buggy_key.encrypted,
                         'md5': not_buggy_key.md5,
+                        'etag': not_buggy_key.etag,
                         'last_modified': not_buggy_key.last_modified,
                         'metadata': not_buggy_key.metadata,
                         "expiryDate": not_buggy_key.expiry_date,
@@ -449,10 +696,37 @@ class S3BucketTarget(BackupTarget):
         return None
 
     ###########################################################################
-    def _single_part_put(self, file_path, destination_path, metadata=None):
+    def _upload_encryption(self, destination_path, encryption):
+        """
+            Validates the server side encryption of an uploaded file (the
+            encryption header of the PUT/complete response) and returns it
+        """
+        if self.cloud_storage_encryption_enabled and not encryption:
+            raise errors.UploadedFileIsNotEncrypted(destination_path,
+                                                    self.container_name)
+        return encryption
+
+    ###########################################################################
+    def _verify_upload_etag(self, checksum, etag, encryption,
+                            destination_path, expected_etag=None):
+        """
+            Verifies the upload etag against checksum unless the etag is not
+            an md5 (SSE-KMS). Such uploads are left unverified (no checksum
+            etag) so that put_file() verifies them through the file info
+        """
+        if encryption == S3_KMS_ENCRYPTION_ALGORITHM:
+            logger.info("S3BucketTarget: Upload of %s is encrypted with "
+                        "SSE-KMS. Its etag can not be verified" %
+                        destination_path)
+            return
+        checksum.verify_upload_etag(etag, destination_path, self.bucket_name,
+                                    expected_etag=expected_etag)
+
+    ###########################################################################
+    def _single_part_put(self, file_path, destination_path, metadata=None,
+                         checksum=None):
         bucket = self._get_bucket()
-        file_obj = open(file_path)
-        k = Key(bucket)
+        k = _S3UploadKey(bucket)
         k.key = destination_path
         # set meta data (has to be before setting content in
         # order for it to work)
@@ -460,36 +734,292 @@ class S3BucketTarget(BackupTarget):
             for name, value in metadata.items():
                 k.set_metadata(name, value)
 
-        k.set_contents_from_file(file_obj, encrypt_key=self.cloud_storage_encryption_enabled)
+        md5 = None
+        if checksum:
+            # hashed in the read boto would otherwise do to compute the
+            # Content-MD5 (S3 rejects bodies that do not match it)
+            checksum.update_from_file(file_path,
+                                      os.path.getsize(file_path))
+            md5 = (checksum.md5, checksum.md5_base64)
+
+        num_call_backs = max(1, os.path.getsize(file_path) /
+                             THROTTLE_CALLBACK_SIZE)
+        with open(file_path, "rb") as file_obj:
+            k.set_contents_from_file(file_obj, md5=md5,
+                                     cb=_throttled_callback(),
+                                     num_cb=num_call_backs,
+                                     encrypt_key=self.cloud_storage_encryption_enabled)
 
+        if checksum:
+            self._verify_upload_etag(checksum, k.etag, k.encrypted,
+                                     destination_path)
+
+        return k.encrypted
 
     ###########################################################################
     def _multi_part_put(self, file_path, destination_path, file_size,
-                        metadata=None):
-
+                        metadata=None, upload_ledger=None, checksum=None):
+        """
+            When checksum (FileChecksum) is specified, the file is hashed
+            while uploading it and the etag of the completed upload is
+            verified against the etags (md5s) of its parts
+        """
         logger.info("S3BucketTarget: Starting multi-part put for %s " %
                     file_path)
-        chunk_size = int(file_size / 10)
-        if chunk_size > MAX_SPLIT_SIZE:
-            chunk_size = MAX_SPLIT_SIZE
+        planner = MultipartUploadPlanner(file_size, S3_MULTIPART_LIMITS,
+                                         concurrency=self.upload_concurrency)
 
         bucket = self._get_bucket()
-        mp = bucket.initiate_multipart_upload(destination_path, metadata=metadata,
-                                              encrypt_key=self.cloud_storage_encryption_enabled)
-
-        upload = SplitFile(file_path, chunk_size)
-
-        for i, chunk in enumerate(upload, 1):
+        mp = None
+        if upload_ledger:
+            mp = self._resume_multi_part_put(bucket, upload_ledger, planner,
+                                             destination_path, file_size)
+        if not mp:
+            mp = bucket.initiate_multipart_upload(destination_path, metadata=metadata,
+                                                  encrypt_key=self.cloud_storage_encryption_enabled)
+            if upload_ledger:
+                upload_ledger.start(mp.id, destination_path, file_size)
+
+        def upload_part(part_num, data):
             logger.info("Uploading file part %d (%s bytes)" %
-                         (i, chunk.size))
-            mp.upload_part_from_file(chunk, i)
+                        (part_num, len(data)))
+            return self._robustified_upload_part(mp, part_num, data)
+
+        part_etags = {}
+        on_part_uploaded = None
+        if upload_ledger or checksum:
+            def on_part_uploaded(part_num, offset, size, part_key):
+                part_etags[part_num] = part_key.etag
+                if upload_ledger:
+                    upload_ledger.part_completed(part_num, offset, size,
+                                                 part_key.etag)
+
+        try:
+            upload_file_parts(file_path, planner, upload_part,
+                              concurrency=self.upload_concurrency,
+                              memory_budget=self.upload_memory_budget,
+                              on_part_uploaded=on_part_uploaded,
+                              checksum=checksum)
+            if upload_ledger:
+                # complete with the ledger parts only. A crashed upload might
+                # have left parts that are not part of the file anymore
+                part_etags = dict((part["partNumber"], part["etag"])
+                                  for part in upload_ledger.parts)
+                completed = bucket.complete_multipart_upload(
+                    destination_path, mp.id,
+                    _s3_complete_multipart_xml(upload_ledger.parts))
+            else:
+                completed = mp.complete_upload()
+
+            if checksum:
+                self._verify_upload_etag(
+                    checksum, completed.etag, completed.encrypted,
+                    destination_path,
+                    expected_etag=s3_multipart_etag(
+                        [part_etags[i] for i in sorted(part_etags)]))
+        except Exception:
+            if upload_ledger:
+                logger.info("S3BucketTarget: Keeping multi-part put for %s "
+                            "to resume it on retry" % file_path)
+                raise
+            try:
+                mp.cancel_upload()
+            except Exception, ex:
+                logger.error("S3BucketTarget: Error while cancelling "
+                             "multi-part put for %s: %s" % (file_path, ex))
+            raise
 
-        mp.complete_upload()
         logger.info("S3BucketTarget: Multi-part put for %s completed"
-                    " successfully!" % file_path)
+                    " successfully! Upload plan: %s" %
+                    (file_path, planner.to_document()))
+
+        return planner.to_document(), completed.encrypted
+
+    ###########################################################################
+    def _resume_multi_part_put(self, bucket, upload_ledger, planner,
+                               destination_path, file_size):
+        """
+            Returns the multipart upload recorded in upload_ledger with the
+            planner moved past the parts that are already uploaded or None
+            if there is nothing to resume
+        """
+        if not upload_ledger.is_resumable(destination_path, file_size):
+            # the recorded upload (if any) is of another file
+            self._cancel_stale_upload(upload_ledger)
+            return None
+
+        mp = MultiPartUpload(bucket)
+        mp.key_name = destination_path
+        mp.id = upload_ledger.upload_id
+        try:
+            uploaded_etags = dict((part.part_number, part.etag)
+                                  for part in mp)
+        except S3ResponseError, sre:
+            if sre.status == 404:
+                logger.info("S3BucketTarget: Multi-part upload '%s' of %s no "
+                            "longer exists. Starting over" %
+                            (mp.id, destination_path))
+                return None
+            raise
+
+        part_count, offset = upload_ledger.resume(uploaded_etags)
+        planner.resume(part_count, offset)
+        logger.info("S3BucketTarget: Resuming multi-part put for %s after "
+                    "part %s (%s of %s bytes already uploaded)" %
+                    (destination_path, part_count, offset, file_size))
+        return mp
+
+    ###########################################################################
+    def cancel_upload(self, upload_ledger):
+        if not upload_ledger.upload_id:
+            return
+        logger.info("S3BucketTarget: Cancelling multi-part upload '%s' of %s"
+                    % (upload_ledger.upload_id, upload_ledger.destination_path))
+        try:
+            self._get_bucket().cancel_multipart_upload(
+                upload_ledger.destination_path, upload_ledger.upload_id)
+        except S3ResponseError, sre:
+            # already completed or cancelled
+            if sre.status != 404:
+                raise
+
+    ###########################################################################
+    @robustify(max_attempts=5, retry_interval=5,
+               backoff=2,
+               do_on_exception=errors.raise_if_not_retriable,
+               do_on_failure=errors.raise_exception)
+    def _robustified_upload_part(self, mp, part_num, data):
+        """
+            Retries a single part so that a failed part does not restart the
+            whole file upload. Returns the uploaded part key (with etag)
+        """
+        return mp.upload_part_from_file(StringIO(data), part_num)
+
+    ###########################################################################
+    def can_copy_from(self, source_target):
+        """
+            S3 copies need the same credentials (so that this target can read
+            the source bucket) and the same region
+        """
+        if not (isinstance(source_target, S3BucketTarget) and
+                source_target.get_access_key() == self.get_access_key() and
+                source_target.get_secret_key() == self.get_secret_key()):
+            return False
+
+        try:
+            self.load_region()
+            source_target.load_region()
+        except Exception, e:
+            logger.info("S3BucketTarget: Can not copy from '%s' to '%s': %s" %
+                        (source_target.bucket_name, self.bucket_name, e))
+            return False
+
+        return source_target.region == self.region
+
+    ###########################################################################
+    def do_copy_file_from(self, source_target, source_reference,
+                          destination_path):
+        file_size = source_reference.file_size
+        upload_plan = None
+        # single copies are limited to the max part size (5 GB)
+        if file_size > S3_MULTIPART_LIMITS.max_part_size:
+            upload_plan = self._multi_part_copy(source_target,
+                                                source_reference,
+                                                destination_path)
+        else:
+            self._get_bucket().copy_key(
+                destination_path, source_target.bucket_name,
+                source_reference.file_path,
+                encrypt_key=self.cloud_storage_encryption_enabled)
+
+        file_info = self._fetch_file_info(destination_path)
+        return FileReference(file_path=destination_path,
+                             file_size=file_size,
+                             cloud_storage_encryption=(
+                                 file_info and
+                                 file_info['cloud_storage_encryption']),
+                             upload_plan=upload_plan)
+
+    ###########################################################################
+    def _multi_part_copy(self, source_target, source_reference,
+                         destination_path):
+        logger.info("S3BucketTarget: Starting multi-part copy of %s " %
+                    source_reference.file_path)
+        planner = MultipartUploadPlanner(source_reference.file_size,
+                                         S3_MULTIPART_LIMITS)
+        mp = self._get_bucket().initiate_multipart_upload(
+            destination_path,
+            encrypt_key=self.cloud_storage_encryption_enabled)
+        try:
+            part = planner.next_part()
+            while part:
+                part_num, offset, size = part
+                logger.info("Copying file part %d (%s bytes)" %
+                            (part_num, size))
+                self._robustified_copy_part(mp, source_target.bucket_name,
+                                            source_reference.file_path,
+                                            part_num, offset,
+                                            offset + size - 1)
+                part = planner.next_part()
+            mp.complete_upload()
+        except Exception:
+            try:
+                mp.cancel_upload()
+            except Exception, ex:
+                logger.error("S3BucketTarget: Error while cancelling "
+                             "multi-part copy to %s: %s" %
+                             (destination_path, ex))
+            raise
+
+        return planner.to_document()
+
+    ###########################################################################
+    @robustify(max_attempts=5, retry_interval=5,
+               backoff=2,
+               do_on_exception=errors.raise_if_not_retriable,
+               do_on_failure=errors.raise_exception)
+    def _robustified_copy_part(self, mp, src_bucket_name, src_key_name,
+                               part_num, start, end):
+        mp.copy_part_from_key(src_bucket_name, src_key_name, part_num,
+                              start=start, end=end)
+
+    ###########################################################################
+    @property
+    def upload_concurrency(self):
+        """
+            Max number of parts uploaded in parallel in multi-part puts
+        """
+        return self._upload_concurrency or DEFAULT_UPLOAD_CONCURRENCY
+
+    @upload_concurrency.setter
+    def upload_concurrency(self, val):
+        self._upload_concurrency = val
+
+    ###########################################################################
+    @property
+    def upload_memory_budget(self):
+        """
+            Max number of bytes held in memory by in-flight parts
+        """
+        return self._upload_memory_budget or DEFAULT_UPLOAD_MEMORY_BUDGET
+
+    @upload_memory_budget.setter
+    def upload_memory_budget(self, val):
+        self._upload_memory_budget = val
 
     ###########################################################################
-    def get_file(self, file_reference, destination):
+    @property
+    def supports_stream_upload(self):
+        return True
+
+    ###########################################################################
+    def open_stream_upload(self, destination_path, metadata=None):
+        logger.info("S3BucketTarget: Starting stream upload for %s " %
+                    destination_path)
+        return S3StreamUpload(self, destination_path, metadata=metadata)
+
+    ###########################################################################
+    def get_file(self, file_reference, destination, concurrency=1):
 
         file_path = file_reference.file_path
 
@@ -507,11 +1037,24 @@ class S3BucketTarget(BackupTarget):
                                               "'%s'" % (file_path,
                                                         self.bucket_name))
 
-            file_obj = open(os.path.join(destination, file_name), mode="w")
-
-            num_call_backs = key.size / 1000
-            key.get_contents_to_file(file_obj, cb=_download_progress,
-                                     num_cb=num_call_backs)
+            des_file = os.path.join(destination, file_name)
+            if concurrency > 1 and key.size >= RANGED_DOWNLOAD_MIN_SIZE:
+                checksum = download_file_parts(
+                    des_file, key.size, self._download_part_func(file_path,
+                                                                 des_file),
+                    concurrency=concurrency)
+            else:
+                num_call_backs = key.size / 1000
+                with open(des_file, "wb") as file_obj:
+                    # verify the checksums recorded at upload while
+                    # downloading
+                    writer = ChecksumWriter(file_obj)
+                    key.get_contents_to_file(
+                        writer, cb=_throttled_callback(_download_progress),
+                        num_cb=num_call_backs)
+                checksum = writer.checksum
+
+            checksum.verify(file_reference, container_name=self.bucket_name)
 
             print("Download completed successfully!!")
 
@@ -522,6 +1065,81 @@ class S3BucketTarget(BackupTarget):
             logger.exception(msg)
             raise errors.TargetError(msg, cause=e)
 
+    ###########################################################################
+    @property
+    def supports_stream_download(self):
+        return True
+
+    ###########################################################################
+    @property
+    def supports_range_download(self):
+        return True
+
+    ###########################################################################
+    def read_range(self, file_reference, offset, size, stream):
+        self._read_range(file_reference.file_path, offset, size, stream)
+
+    ###########################################################################
+    def _read_range(self, file_path, offset, size, stream):
+        # a key per range: keys hold the response being read
+        key = Key(self._get_bucket(), file_path)
+        byte_range = "bytes=%d-%d" % (offset, offset + size - 1)
+        key.get_contents_to_file(stream, headers={"Range": byte_range},
+                                 cb=_throttled_callback(),
+                                 num_cb=max(1, size / THROTTLE_CALLBACK_SIZE))
+
+    ###########################################################################
+    def download_to_stream(self, file_reference, stream):
+        file_path = file_reference.file_path
+
+        try:
+            logger.info("S3BucketTarget: Streaming '%s' from s3 bucket '%s'" %
+                        (file_path, self.bucket_name))
+
+            key = self._get_bucket().get_key(file_path)
+            if not key:
+                raise errors.TargetFileNotFoundError(
+                    "No such file '%s' in bucket '%s'" % (file_path,
+                                                          self.bucket_name))
+
+            writer = ChecksumWriter(stream)
+            key.get_contents_to_file(writer, cb=_throttled_callback(),
+                                     num_cb=max(1, key.size /
+                                                THROTTLE_CALLBACK_SIZE))
+            writer.checksum.verify(file_reference,
+                                   container_name=self.bucket_name)
+        except Exception, e:
+            msg = ("S3BucketTarget: Error while trying to stream '%s'"
+                   " from s3 bucket %s. Cause: %s" %
+                   (file_path, self.bucket_name, e))
+            logger.exception(msg)
+            raise errors.TargetError(msg, cause=e)
+
+    ###########################################################################
+    def _download_part_func(self, file_path, des_file):
+        def download_part(part_num, offset, size):
+            logger.info("S3BucketTarget: Downloading part %s of '%s' (%s "
+                        "bytes at offset %s)" % (part_num, file_path, size,
+                                                 offset))
+            self._robustified_download_part(file_path, des_file, offset, size)
+
+        return download_part
+
+    ###########################################################################
+    @robustify(max_attempts=5, retry_interval=5, backoff=2,
+               do_on_exception=errors.raise_if_not_retriable,
+               do_on_failure=errors.raise_exception)
+    def _robustified_download_part(self, file_path, des_file, offset, size):
+        with open(des_file, "r+b") as file_obj:
+            file_obj.seek(offset)
+            self._read_range(file_path, offset, size, file_obj)
+            downloaded = file_obj.tell() - offset
+
+        if downloaded != size:
+            raise errors.DownloadedFileSizeMatchError(
+                file_path=file_path, container_name=self.bucket_name,
+                size=downloaded, expected_size=size)
+
     ###########################################################################
     def do_delete_file(self, file_reference):
         file_path = file_reference.file_path
@@ -690,6 +1308,12 @@ class S3BucketTarget(BackupTarget):
                 "secretKey": "xxxxx" if display_only else self._secret_key
             })
 
+        if self._upload_concurrency is not None:
+            doc["uploadConcurrency"] = self._upload_concurrency
+
+        if self._upload_memory_budget is not None:
+            doc["uploadMemoryBudget"] = self._upload_memory_budget
+
         return doc
 
     ###########################################################################
@@ -769,9 +1393,11 @@ class RackspaceCloudFilesTarget(BackupTarget):
         BackupTarget.__init__(self)
         self._container_name = None
         self._container = None
+        self._thread_local = local()
 
     ###########################################################################
-    def do_put_file(self, file_path, destination_path, metadata=None):
+    def do_put_file(self, file_path, destination_path, metadata=None,
+                    upload_ledger=None):
 
         # determine single/multi part upload
         file_size = os.path.getsize(file_path)
@@ -779,23 +1405,47 @@ class RackspaceCloudFilesTarget(BackupTarget):
         destination_path = destination_path or os.path.basename(file_path)
 
 
-        if file_size >= CF_MULTIPART_MIN_SIZE:
-            self._multi_part_put(file_path, destination_path, file_size,
-                                 metadata=metadata)
+        # checksummed while uploading
+        checksum = FileChecksum()
+        upload_plan = None
+        if file_size >= CF_MULTIPART_MIN_SIZE and upload_ledger:
+            upload_plan = self._segmented_put(file_path, destination_path,
+                                              file_size, upload_ledger,
+                                              checksum=checksum)
+        elif file_size >= CF_MULTIPART_MIN_SIZE:
+            upload_plan = self._multi_part_put(file_path, destination_path,
+                                               file_size, metadata=metadata)
+            # st reads the file itself
+            checksum = None
         else:
             self._single_part_put(file_path, destination_path,
-                                  metadata=metadata)
+                                  metadata=metadata, checksum=checksum)
 
         return FileReference(file_path=destination_path,
-                             file_size=file_size)
+                             file_size=file_size,
+                             upload_plan=upload_plan,
+                             md5=checksum and checksum.md5,
+                             sha256=checksum and checksum.sha256,
+                             etag=checksum and checksum.etag)
 
     ###########################################################################
-    def _single_part_put(self, file_path, destination_path, metadata=None):
+    def _single_part_put(self, file_path, destination_path, metadata=None,
+                         checksum=None):
+        checksum = checksum or FileChecksum()
         try:
 
             container = self._get_container()
             container_obj = container.create_object(destination_path)
-            container_obj.load_from_filename(file_path)
+            container_obj.content_type = (mimetypes.guess_type(file_path)[0] or
+                                          "application/octet-stream")
+            container_obj.size = os.path.getsize(file_path)
+            # hash the bytes as they are sent. The object etag is the md5
+            # of what the server received
+            with open(file_path, "rb") as file_obj:
+                container_obj.send(_iter_throttled(
+                    iter_checksummed(file_obj, checksum)))
+            checksum.verify_upload_etag(container_obj.etag, destination_path,
+                                        self.container_name)
         except Exception, ex:
             if "unauthorized" in safe_stringify(ex).lower():
                 raise errors.TargetConnectionError(self.container_name, ex)
@@ -813,11 +1463,10 @@ class RackspaceCloudFilesTarget(BackupTarget):
         logger.info("RackspaceCloudFilesTarget: Starting multi-part put "
                     "for %s " % file_path)
 
-        # calculate chunk size
-        # split into 10 chunks if possible
-        chunk_size = int(file_size / 10)
-        if chunk_size > MAX_SPLIT_SIZE:
-            chunk_size = MAX_SPLIT_SIZE
+        # st uploads segments of a fixed size so only the initial planned
+        # part size is used
+        planner = MultipartUploadPlanner(file_size, CF_MULTIPART_LIMITS)
+        chunk_size = planner.initial_part_size
 
         st_exe = which("st")
         st_command = [
@@ -836,6 +1485,111 @@ class RackspaceCloudFilesTarget(BackupTarget):
         logger.info("RackspaceCloudFilesTarget: Multi-part put for %s "
                     "completed successfully!" % file_path)
 
+        return {
+            "initialPartSize": chunk_size,
+            "partCount": planner.estimated_part_count,
+            "concurrency": 1
+        }
+
+
+    ###########################################################################
+    def _segmented_put(self, file_path, destination_path, file_size,
+                       upload_ledger, checksum=None):
+        """
+            Uploads file as segments (recorded in upload_ledger) under
+            "<destination_path>.segments/<upload id>/" followed by a dynamic
+            large object manifest at destination_path. Unlike st, a restarted
+            upload resumes after the segments that are already uploaded.
+            The file is hashed by checksum (FileChecksum) while uploading
+        """
+        logger.info("RackspaceCloudFilesTarget: Starting segmented put "
+                    "for %s " % file_path)
+        planner = MultipartUploadPlanner(file_size, CF_MULTIPART_LIMITS)
+        container = self._get_container()
+
+        if upload_ledger.is_resumable(destination_path, file_size):
+            segment_prefix = _cf_segment_prefix(destination_path,
+                                                upload_ledger.upload_id)
+            uploaded_etags = self._list_segment_etags(segment_prefix)
+            part_count, offset = upload_ledger.resume(uploaded_etags)
+            planner.resume(part_count, offset)
+            logger.info("RackspaceCloudFilesTarget: Resuming segmented put "
+                        "for %s after segment %s (%s of %s bytes already "
+                        "uploaded)" % (destination_path, part_count, offset,
+                                       file_size))
+        else:
+            # the recorded segments (if any) are of another file
+            self._cancel_stale_upload(upload_ledger)
+            upload_ledger.start(uuid.uuid4().hex, destination_path,
+                                file_size)
+            segment_prefix = _cf_segment_prefix(destination_path,
+                                                upload_ledger.upload_id)
+
+        def upload_segment(part_num, data):
+            logger.info("Uploading file segment %d (%s bytes)" %
+                        (part_num, len(data)))
+            return self._robustified_upload_segment(
+                "%s%08d" % (segment_prefix, part_num), data)
+
+        def on_segment_uploaded(part_num, offset, size, etag):
+            upload_ledger.part_completed(part_num, offset, size, etag)
+
+        # cloudfiles connections are not thread safe
+        upload_file_parts(file_path, planner, upload_segment, concurrency=1,
+                          on_part_uploaded=on_segment_uploaded,
+                          checksum=checksum)
+
+        # the manifest serves every object under the prefix so delete
+        # segments a crashed upload left beyond the last segment
+        part_count = len(upload_ledger.parts)
+        for part_num in self._list_segment_etags(segment_prefix).keys():
+            if part_num > part_count:
+                container.delete_object("%s%08d" % (segment_prefix, part_num))
+
+        manifest_obj = container.create_object(destination_path)
+        manifest_obj.manifest = "%s/%s" % (self.container_name,
+                                           segment_prefix)
+        manifest_obj.sync_manifest()
+
+        logger.info("RackspaceCloudFilesTarget: Segmented put for %s "
+                    "completed successfully! Upload plan: %s" %
+                    (file_path, planner.to_document()))
+
+        upload_plan = planner.to_document()
+        upload_plan["segmentPrefix"] = segment_prefix
+        return upload_plan
+
+    ###########################################################################
+    @robustify(max_attempts=5, retry_interval=5,
+               backoff=2,
+               do_on_exception=errors.raise_if_not_retriable,
+               do_on_failure=errors.raise_exception)
+    def _robustified_upload_segment(self, segment_name, data):
+        container_obj = self._get_container().create_object(segment_name)
+        # sending the md5 makes the server reject a corrupted segment
+        container_obj.etag = hashlib.md5(data).hexdigest()
+        container_obj.write(data)
+        return container_obj.etag
+
+    ###########################################################################
+    def _list_segment_etags(self, segment_prefix):
+        """
+            Returns a part number => etag dict of segments under
+            segment_prefix
+        """
+        etags = {}
+        container = self._get_container()
+        marker = None
+        while True:
+            infos = container.list_objects_info(prefix=segment_prefix,
+                                                marker=marker)
+            if not infos:
+                return etags
+            for info in infos:
+                segment_num = info["name"][len(segment_prefix):]
+                if segment_num.isdigit():
+                    etags[int(segment_num)] = info["hash"]
+            marker = infos[-1]["name"]
 
     ###########################################################################
     def _fetch_file_info(self, destination_path):
@@ -843,7 +1597,12 @@ class RackspaceCloudFilesTarget(BackupTarget):
         try:
             container_obj = container.get_object(destination_path)
             if container_obj:
-                return {'size': container_obj.size}
+                return {
+                    'size': container_obj.size,
+                    # manifest etags are not the md5 of the file
+                    'etag': None if container_obj.manifest else
+                    container_obj.etag
+                }
 
         except cloudfiles.errors.NoSuchObject:
             pass
@@ -851,7 +1610,7 @@ class RackspaceCloudFilesTarget(BackupTarget):
         return None
 
     ###########################################################################
-    def get_file(self, file_reference, destination):
+    def get_file(self, file_reference, destination, concurrency=1):
         file_path = file_reference.file_path
 
         try:
@@ -867,8 +1626,24 @@ class RackspaceCloudFilesTarget(BackupTarget):
 
             file_name = file_reference.file_name
             des_file = os.path.join(destination, file_name)
-            container_obj.save_to_filename(des_file,
-                                           callback=_download_progress)
+            file_size = container_obj.size
+            if concurrency > 1 and file_size >= RANGED_DOWNLOAD_MIN_SIZE:
+                checksum = download_file_parts(
+                    des_file, file_size, self._download_part_func(file_path,
+                                                                  des_file),
+                    concurrency=concurrency)
+            else:
+                with open(des_file, "wb") as file_obj:
+                    # verify the checksums recorded at upload while
+                    # downloading
+                    writer = ChecksumWriter(file_obj)
+                    container_obj.read(
+                        buffer=writer,
+                        callback=_throttled_callback(_download_progress))
+                checksum = writer.checksum
+
+            checksum.verify(file_reference,
+                            container_name=self.container_name)
             print("\nDownload completed successfully!!")
 
         except Exception, e:
@@ -877,6 +1652,70 @@ class RackspaceCloudFilesTarget(BackupTarget):
                    (file_path, self.container_name, e))
             raise errors.TargetError(msg, e)
 
+    ###########################################################################
+    @property
+    def supports_stream_download(self):
+        return True
+
+    ###########################################################################
+    @property
+    def supports_range_download(self):
+        return True
+
+    ###########################################################################
+    def read_range(self, file_reference, offset, size, stream):
+        self._read_range(file_reference.file_path, offset, size, stream)
+
+    ###########################################################################
+    def _read_range(self, file_path, offset, size, stream):
+        container_obj = self._get_thread_container().get_object(file_path)
+        container_obj.read(size=size, offset=offset, buffer=stream,
+                           callback=_throttled_callback())
+
+    ###########################################################################
+    def download_to_stream(self, file_reference, stream):
+        file_path = file_reference.file_path
+
+        try:
+            logger.info("RackspaceCloudFilesTarget: Streaming '%s' from "
+                        "container '%s'" % (file_path, self.container_name))
+
+            container_obj = self._get_container().get_object(file_path)
+            writer = ChecksumWriter(stream)
+            container_obj.read(buffer=writer, callback=_throttled_callback())
+            writer.checksum.verify(file_reference,
+                                   container_name=self.container_name)
+        except Exception, e:
+            msg = ("RackspaceCloudFilesTarget: Error while trying to stream "
+                   "'%s' from container %s. Cause: %s" %
+                   (file_path, self.container_name, e))
+            raise errors.TargetError(msg, e)
+
+    ###########################################################################
+    def _download_part_func(self, file_path, des_file):
+        def download_part(part_num, offset, size):
+            logger.info("RackspaceCloudFilesTarget: Downloading part %s of "
+                        "'%s' (%s bytes at offset %s)" %
+                        (part_num, file_path, size, offset))
+            self._robustified_download_part(file_path, des_file, offset, size)
+
+        return download_part
+
+    ###########################################################################
+    @robustify(max_attempts=5, retry_interval=5, backoff=2,
+               do_on_exception=errors.raise_if_not_retriable,
+               do_on_failure=errors.raise_exception)
+    def _robustified_download_part(self, file_path, des_file, offset, size):
+        with open(des_file, "r+b") as file_obj:
+            file_obj.seek(offset)
+            self._read_range(file_path, offset, size, file_obj)
+            downloaded = file_obj.tell() - offset
+
+        if downloaded != size:
+            raise errors.DownloadedFileSizeMatchError(
+                file_path=file_path, container_name=self.container_name,
+                size=downloaded, expected_size=size)
+
     ###########################################################################
     def do_delete_file(self, file_reference):
         try:
@@ -887,6 +1726,7 @@ class RackspaceCloudFilesTarget(BackupTarget):
 
             container = self._get_container()
             container.delete_object(file_path)
+            self._delete_segments(file_reference)
             logger.info("RackspaceCloudFilesTarget: Successfully deleted '%s' "
                         "from container '%s'" %
                         (file_path, self.container_name))
@@ -906,9 +1746,62 @@ class RackspaceCloudFilesTarget(BackupTarget):
 
 
     ###########################################################################
-    def get_temp_download_url(self, file_reference):
-        return cloudfiles_utils.get_download_url(self._get_container(),
-                                                 file_reference.file_path)
+    def can_copy_from(self, source_target):
+        """
+            Server side copies only work within the same account and region
+        """
+        return (isinstance(source_target, RackspaceCloudFilesTarget) and
+                source_target.username == self.username and
+                source_target.api_key == self.api_key and
+                source_target.region == self.region)
+
+    ###########################################################################
+    def do_copy_file_from(self, source_target, source_reference,
+                          destination_path):
+        # large (segmented) objects can not be copied server side
+        if source_reference.file_size >= CF_MULTIPART_MIN_SIZE:
+            raise errors.TargetError("'%s' is too large for a server side "
+                                     "copy" % source_reference.file_path)
+
+        source_obj = source_target._get_container().get_object(
+            source_reference.file_path)
+        source_obj.copy_to(self.container_name, destination_path)
+
+        return FileReference(file_path=destination_path,
+                             file_size=source_reference.file_size)
+
+    ###########################################################################
+    def _delete_segments(self, file_reference):
+        """
+            Deletes the segments of files uploaded through _segmented_put()
+        """
+        upload_plan = file_reference.upload_plan
+        segment_prefix = upload_plan and upload_plan.get("segmentPrefix")
+        if not segment_prefix:
+            return
+
+        self._delete_segment_prefix(segment_prefix)
+
+    ###########################################################################
+    def _delete_segment_prefix(self, segment_prefix):
+        container = self._get_container()
+        for part_num in self._list_segment_etags(segment_prefix).keys():
+            container.delete_object("%s%08d" % (segment_prefix, part_num))
+
+    ###########################################################################
+    def cancel_upload(self, upload_ledger):
+        if not upload_ledger.upload_id:
+            return
+        segment_prefix = _cf_segment_prefix(upload_ledger.destination_path,
+                                            upload_ledger.upload_id)
+        logger.info("RackspaceCloudFilesTarget: Deleting segments of "
+                    "cancelled upload %s" % segment_prefix)
+        self._delete_segment_prefix(segment_prefix)
+
+    ###########################################################################
+    def get_temp_download_url(self, file_reference):
+        return cloudfiles_utils.get_download_url(self._get_container(),
+                                                 file_reference.file_path)
 
     ###########################################################################
     @property
@@ -922,17 +1815,33 @@ class RackspaceCloudFilesTarget(BackupTarget):
     ###########################################################################
     def _get_container(self):
         if not self._container:
-            try:
-                conn = cloudfiles.get_connection(username=self.username,
-                                                 api_key=self.api_key,
-                                                 timeout=30)
-
-                self._container = conn.get_container(self.container_name)
-            except (AuthenticationFailed, NoSuchContainer), e:
-                raise errors.TargetInaccessibleError(self.container_name,
-                                              cause=e)
+            self._container = self._connect_container()
         return self._container
 
+    ###########################################################################
+    def _get_thread_container(self):
+        """
+            cloudfiles connections are not thread safe. Returns the container
+            over a connection of the calling thread
+        """
+        container = getattr(self._thread_local, "container", None)
+        if container is None:
+            container = self._connect_container()
+            self._thread_local.container = container
+        return container
+
+    ###########################################################################
+    def _connect_container(self):
+        try:
+            conn = cloudfiles.get_connection(username=self.username,
+                                             api_key=self.api_key,
+                                             timeout=30)
+
+            return conn.get_container(self.container_name)
+        except (AuthenticationFailed, NoSuchContainer), e:
+            raise errors.TargetInaccessibleError(self.container_name,
+                                                 cause=e)
+
     ###########################################################################
     @property
     def username(self):
@@ -1005,7 +1914,7 @@ class AzureContainerTarget(BackupTarget):
 
     ###########################################################################
     def put_file(self, file_path, destination_path=None,
-                 overwrite_existing=False, metadata=None):
+                 overwrite_existing=False, metadata=None, upload_ledger=None):
         try:
 
             # calculating file size
@@ -1045,7 +1954,7 @@ class AzureContainerTarget(BackupTarget):
 
 
     ###########################################################################
-    def get_file(self, file_reference, destination):
+    def get_file(self, file_reference, destination, concurrency=1):
         raise Exception("AzureContainerTarget: get_file not supported yet")
 
     ###########################################################################
@@ -1197,11 +2106,17 @@ class TargetReference(MBSObject):
 class FileReference(TargetReference):
 
     ###########################################################################
-    def __init__(self, file_path=None, file_size=None, preserve=None, cloud_storage_encryption=None):
+    def __init__(self, file_path=None, file_size=None, preserve=None, cloud_storage_encryption=None,
+                 upload_plan=None, md5=None, sha256=None, etag=None):
         TargetReference.__init__(self, preserve=preserve)
         self._file_path = file_path
         self._file_size = file_size
         self._cloud_storage_encryption = cloud_storage_encryption
+        self._upload_plan = upload_plan
+        self._compression = None
+        self._md5 = md5
+        self._sha256 = sha256
+        self._etag = etag
 
     ###########################################################################
     @property
@@ -1230,6 +2145,70 @@ class FileReference(TargetReference):
     def file_size(self, file_size):
         self._file_size = file_size
 
+    ###########################################################################
+    @property
+    def upload_plan(self):
+        """
+            Multi-part upload plan used to upload the file (part sizes, part
+            count, concurrency and observed part latency)
+        """
+        return self._upload_plan
+
+    @upload_plan.setter
+    def upload_plan(self, val):
+        self._upload_plan = val
+
+    ###########################################################################
+    @property
+    def compression(self):
+        """
+            Name of the compression codec of the archive (see
+            compression.get_codec). None for gzip archives created before
+            codecs existed
+        """
+        return self._compression
+
+    @compression.setter
+    def compression(self, val):
+        self._compression = val
+
+    ###########################################################################
+    @property
+    def md5(self):
+        """
+            MD5 of the file computed while uploading it
+        """
+        return self._md5
+
+    @md5.setter
+    def md5(self, val):
+        self._md5 = val
+
+    ###########################################################################
+    @property
+    def sha256(self):
+        """
+            SHA-256 of the file computed while uploading it
+        """
+        return self._sha256
+
+    @sha256.setter
+    def sha256(self, val):
+        self._sha256 = val
+
+    ###########################################################################
+    @property
+    def etag(self):
+        """
+            Provider etag of the file. Only set when the upload verified it
+            against the checksum of the uploaded bytes
+        """
+        return self._etag
+
+    @etag.setter
+    def etag(self, val):
+        self._etag = val
+
     ###########################################################################
     @property
     def file_name(self):
@@ -1245,6 +2224,21 @@ class FileReference(TargetReference):
             "cloudStorageEncryption": self.cloud_storage_encryption
         })
 
+        if self.upload_plan:
+            doc["uploadPlan"] = self.upload_plan
+
+        if self.compression:
+            doc["compression"] = self.compression
+
+        if self.md5:
+            doc["md5"] = self.md5
+
+        if self.sha256:
+            doc["sha256"] = self.sha256
+
+        if self.etag:
+            doc["etag"] = self.etag
+
         return doc
 
     ###########################################################################
@@ -1252,6 +2246,169 @@ class FileReference(TargetReference):
         return "(File Path: '%s', File Size: '%s')" % (self.file_path,
                                                        self.file_size)
 
+###############################################################################
+# ChunkManifestReference
+###############################################################################
+class ChunkManifestReference(FileReference):
+    """
+        Reference to the manifest of a dedup backup. The manifest lists the
+        content addressed chunks of each dump file (see dedup.py)
+    """
+    ###########################################################################
+    def __init__(self, file_path=None, file_size=None, preserve=None,
+                 cloud_storage_encryption=None):
+        FileReference.__init__(self, file_path=file_path, file_size=file_size,
+                               preserve=preserve,
+                               cloud_storage_encryption=cloud_storage_encryption)
+        self._logical_size = None
+        self._chunk_count = None
+        self._unique_chunk_count = None
+        self._uploaded_chunk_count = None
+
+    ###########################################################################
+    @property
+    def logical_size(self):
+        """
+            Total size of the dump files
+        """
+        return self._logical_size
+
+    @logical_size.setter
+    def logical_size(self, val):
+        self._logical_size = val
+
+    ###########################################################################
+    @property
+    def chunk_count(self):
+        return self._chunk_count
+
+    @chunk_count.setter
+    def chunk_count(self, val):
+        self._chunk_count = val
+
+    ###########################################################################
+    @property
+    def unique_chunk_count(self):
+        return self._unique_chunk_count
+
+    @unique_chunk_count.setter
+    def unique_chunk_count(self, val):
+        self._unique_chunk_count = val
+
+    ###########################################################################
+    @property
+    def uploaded_chunk_count(self):
+        """
+            Number of chunks that were not in the target already
+        """
+        return self._uploaded_chunk_count
+
+    @uploaded_chunk_count.setter
+    def uploaded_chunk_count(self, val):
+        self._uploaded_chunk_count = val
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        doc = FileReference.to_document(self, display_only=display_only)
+        doc.update({
+            "_type": "ChunkManifestReference",
+            "logicalSize": self.logical_size,
+            "chunkCount": self.chunk_count,
+            "uniqueChunkCount": self.unique_chunk_count,
+            "uploadedChunkCount": self.uploaded_chunk_count
+        })
+
+        return doc
+
+###############################################################################
+# IndexedArchiveReference
+###############################################################################
+class IndexedArchiveReference(FileReference):
+    """
+        Reference to an indexed backup archive. Dump files are compressed
+        independently and located through the archive index so that restores
+        can fetch only the files they need (see indexed_archive.py)
+    """
+    ###########################################################################
+    def __init__(self, file_path=None, file_size=None, preserve=None,
+                 cloud_storage_encryption=None, upload_plan=None, md5=None,
+                 sha256=None, etag=None):
+        FileReference.__init__(self, file_path=file_path, file_size=file_size,
+                               preserve=preserve,
+                               cloud_storage_encryption=cloud_storage_encryption,
+                               upload_plan=upload_plan, md5=md5,
+                               sha256=sha256, etag=etag)
+        self._index_offset = None
+        self._index_size = None
+        self._database_names = None
+        self._member_count = None
+        self._logical_size = None
+
+    ###########################################################################
+    @property
+    def index_offset(self):
+        return self._index_offset
+
+    @index_offset.setter
+    def index_offset(self, val):
+        self._index_offset = val
+
+    ###########################################################################
+    @property
+    def index_size(self):
+        return self._index_size
+
+    @index_size.setter
+    def index_size(self, val):
+        self._index_size = val
+
+    ###########################################################################
+    @property
+    def database_names(self):
+        """
+            Databases with files in the archive
+        """
+        return self._database_names
+
+    @database_names.setter
+    def database_names(self, val):
+        self._database_names = val
+
+    ###########################################################################
+    @property
+    def member_count(self):
+        return self._member_count
+
+    @member_count.setter
+    def member_count(self, val):
+        self._member_count = val
+
+    ###########################################################################
+    @property
+    def logical_size(self):
+        """
+            Total size of the dump files
+        """
+        return self._logical_size
+
+    @logical_size.setter
+    def logical_size(self, val):
+        self._logical_size = val
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        doc = FileReference.to_document(self, display_only=display_only)
+        doc.update({
+            "_type": "IndexedArchiveReference",
+            "indexOffset": self.index_offset,
+            "indexSize": self.index_size,
+            "databaseNames": self.database_names,
+            "memberCount": self.member_count,
+            "logicalSize": self.logical_size
+        })
+
+        return doc
+
 ###############################################################################
 # CloudBlockStorageSnapshotReference
 ###############################################################################
@@ -1762,24 +2919,83 @@ def _download_progress(transferred, size):
     sys.stdout.flush()
 
 
+###############################################################################
+# Bandwidth throttling
+###############################################################################
+def _throttle(nbytes):
+    """
+        Blocks until nbytes can be transferred within the engine bandwidth
+        budget (when a bandwidth governor is configured)
+    """
+    governor = mbs.get_mbs().bandwidth_governor
+    if governor:
+        governor.throttle(nbytes)
+
+###############################################################################
+def _throttled_callback(callback=None):
+    """
+        Returns a transfer progress callback (transferred, size) that
+        throttles the bytes transferred since its previous call
+    """
+    state = {
+        "transferred": 0
+    }
+
+    def throttled_callback(transferred, size):
+        # transfers restarted by a retry count from 0 again
+        _throttle(max(0, transferred - state["transferred"]))
+        state["transferred"] = transferred
+        if callback:
+            callback(transferred, size)
+
+    return throttled_callback
+
+###############################################################################
+def _iter_throttled(chunks):
+    for chunk in chunks:
+        _throttle(len(chunk))
+        yield chunk
 
 ###############################################################################
 # Concurrent multi target upload
 ###############################################################################
 def multi_target_upload_file(targets,
-                             file_path, **upload_kargs):
-
+                             file_path, upload_ledgers=None, **upload_kargs):
+    """
+        Uploads file_path to all targets concurrently. upload_ledgers is an
+        optional list of UploadLedger (one per target) used by multi-part
+        puts to resume
+    """
     logger.info("MULTI TARGET UPLOAD: Starting concurrent target upload for "
                 "file '%s'" % file_path)
-    uploaders = []
-
-    # first kick off the uploads
-    for target in targets:
-        target_uploader = TargetUploader(target, file_path, **upload_kargs)
-        uploaders.append(target_uploader)
+    uploaders = [None] * len(targets)
+
+    # targets that can take parts of the same read share a single read
+    fan_out_indexes = _fan_out_target_indexes(targets, file_path,
+                                              upload_ledgers)
+
+    # first kick off the uploads of the other targets
+    for i, target in enumerate(targets):
+        if i in fan_out_indexes:
+            continue
+        target_kargs = dict(upload_kargs)
+        if upload_ledgers:
+            target_kargs["upload_ledger"] = upload_ledgers[i]
+        target_uploader = TargetUploader(target, file_path, **target_kargs)
+        uploaders[i] = target_uploader
         logger.info("Starting uploader for target: %s" % target)
         target_uploader.start()
 
+    if fan_out_indexes:
+        fan_out_uploads = fan_out_upload_file(
+            [targets[i] for i in fan_out_indexes], file_path,
+            destination_path=upload_kargs.get("destination_path"),
+            metadata=upload_kargs.get("metadata"),
+            upload_ledgers=(upload_ledgers and
+                            [upload_ledgers[i] for i in fan_out_indexes]))
+        for i, fan_out_upload in zip(fan_out_indexes, fan_out_uploads):
+            uploaders[i] = fan_out_upload
+
     logger.info("Waiting for all target uploaders to finish")
     # wait for all target uploaders to finish
     for target_uploader in uploaders:
@@ -1841,3 +3057,1087 @@ class TargetUploader(Thread):
     def completed(self):
         return self.target_reference is not None or self.error is not None
 
+
+###############################################################################
+# Single read fan-out uploads
+###############################################################################
+def _fan_out_target_indexes(targets, file_path, upload_ledgers=None):
+    """
+        Indexes of the targets that should share a single read of file_path:
+        multi-part sized files going to at least two targets supporting
+        stream uploads. Targets with an upload to resume are left out
+    """
+    if (not os.path.exists(file_path) or
+            os.path.getsize(file_path) < MULTIPART_MIN_SIZE):
+        return []
+
+    indexes = []
+    for i, target in enumerate(targets):
+        ledger = upload_ledgers and upload_ledgers[i]
+        if target.supports_stream_upload and not (ledger and
+                                                  ledger.upload_id):
+            indexes.append(i)
+
+    return indexes if len(indexes) > 1 else []
+
+###############################################################################
+def fan_out_upload_file(targets, file_path, destination_path=None,
+                        metadata=None, upload_ledgers=None,
+                        memory_budget=DEFAULT_UPLOAD_MEMORY_BUDGET):
+    """
+        Uploads file_path to all targets (that support stream uploads)
+        reading each part from disk only once. Parts wait in a bounded
+        PartRing until every target uploaded them. A failing target is
+        dropped from the fan-out without affecting the others and is then
+        retried on its own through put_file() (resuming from its upload
+        ledger if any).
+        Returns a FanOutTargetUpload (target, target_reference, error) per
+        target
+    """
+    destination_path = destination_path or os.path.basename(file_path)
+    file_size = os.path.getsize(file_path)
+    concurrency = max(map(_target_upload_concurrency, targets))
+    planner = MultipartUploadPlanner(file_size, S3_MULTIPART_LIMITS,
+                                     concurrency=concurrency)
+    capacity = max(2, memory_budget / planner.initial_part_size)
+
+    logger.info("FAN OUT UPLOAD: Uploading '%s' to %s targets in ~%s parts of"
+                " %s bytes (ring of %s parts)" %
+                (file_path, len(targets), planner.estimated_part_count,
+                 planner.initial_part_size, capacity))
+
+    ring = PartRing(capacity, len(targets))
+    checksum = FileChecksum()
+    uploads = []
+    for i, target in enumerate(targets):
+        upload = FanOutTargetUpload(i, target, ring, destination_path,
+                                    file_size, metadata=metadata,
+                                    upload_ledger=(upload_ledgers and
+                                                   upload_ledgers[i]))
+        uploads.append(upload)
+        upload.start()
+
+    try:
+        with open(file_path, "rb") as file_obj:
+            part = planner.next_part()
+            while part and ring.has_consumers():
+                part_num, offset, size = part
+                file_obj.seek(offset)
+                data = file_obj.read(size)
+                checksum.update(data)
+                ring.put((part_num, offset, data))
+                part = planner.next_part()
+    except Exception, e:
+        logger.exception("FAN OUT UPLOAD: error while reading '%s'" %
+                         file_path)
+        for upload in uploads:
+            upload.fail(e)
+    finally:
+        ring.close()
+
+    for upload in uploads:
+        upload.wait(planner.to_document(), checksum=checksum)
+
+    # failure isolation: retry failed targets on their own
+    retries = []
+    for upload in uploads:
+        if upload.error:
+            logger.warning("FAN OUT UPLOAD: Upload of '%s' to %s failed. "
+                           "Retrying it on its own" %
+                           (file_path, upload.target))
+            retry = TargetUploader(upload.target, file_path,
+                                   destination_path=destination_path,
+                                   metadata=metadata,
+                                   upload_ledger=upload.upload_ledger)
+            retries.append((upload, retry))
+            retry.start()
+
+    for upload, retry in retries:
+        retry.join()
+        upload.retried(retry.target_reference, retry.error)
+
+    return uploads
+
+###############################################################################
+def _target_upload_concurrency(target):
+    return getattr(target, "upload_concurrency", None) or \
+           DEFAULT_UPLOAD_CONCURRENCY
+
+###############################################################################
+# PartRing class
+###############################################################################
+class PartRing(object):
+    """
+        Bounded buffer of file parts shared by several consumers (numbered
+        0..consumer_count-1). Each consumer gets every part once. A part is
+        dropped when all live consumers released it and put() blocks while
+        the ring holds capacity parts. Removed (failed) consumers never hold
+        parts back
+    """
+    ###########################################################################
+    def __init__(self, capacity, consumer_count):
+        self._capacity = capacity
+        # [part, consumers that did not release it yet]
+        self._entries = []
+        self._first_seq = 0
+        self._next_seq = 0
+        self._cursors = [0] * consumer_count
+        self._live_consumers = set(range(consumer_count))
+        self._closed = False
+        self._condition = Condition()
+
+    ###########################################################################
+    def has_consumers(self):
+        with self._condition:
+            return len(self._live_consumers) > 0
+
+    ###########################################################################
+    def put(self, part):
+        with self._condition:
+            while (len(self._entries) >= self._capacity and
+                   self._live_consumers):
+                self._condition.wait()
+
+            if not self._live_consumers:
+                return
+
+            self._entries.append([part, set(self._live_consumers)])
+            self._next_seq += 1
+            self._condition.notify_all()
+
+    ###########################################################################
+    def close(self):
+        """
+            No more parts
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    ###########################################################################
+    def get(self, consumer):
+        """
+            Returns (seq, part) of the next part for consumer or None when
+            there are no more parts (or the consumer was removed)
+        """
+        with self._condition:
+            while True:
+                if consumer not in self._live_consumers:
+                    return None
+                seq = self._cursors[consumer]
+                if seq < self._next_seq:
+                    self._cursors[consumer] += 1
+                    return seq, self._entries[seq - self._first_seq][0]
+                if self._closed:
+                    return None
+                self._condition.wait()
+
+    ###########################################################################
+    def release(self, consumer, seq):
+        with self._condition:
+            self._entries[seq - self._first_seq][1].discard(consumer)
+            self._drop_released()
+
+    ###########################################################################
+    def remove_consumer(self, consumer):
+        with self._condition:
+            self._live_consumers.discard(consumer)
+            for entry in self._entries:
+                entry[1].discard(consumer)
+            self._drop_released()
+            self._condition.notify_all()
+
+    ###########################################################################
+    def _drop_released(self):
+        dropped = False
+        while self._entries and not self._entries[0][1]:
+            self._entries.pop(0)
+            self._first_seq += 1
+            dropped = True
+
+        if dropped:
+            self._condition.notify_all()
+
+###############################################################################
+# FanOutTargetUpload class
+###############################################################################
+class FanOutTargetUpload(object):
+    """
+        Uploads the parts of a fan-out upload to one target through a stream
+        upload using upload_concurrency threads. Has the same
+        target/target_reference/error interface as TargetUploader
+    """
+    ###########################################################################
+    def __init__(self, index, target, ring, destination_path, file_size,
+                 metadata=None, upload_ledger=None):
+        self._index = index
+        self._target = target
+        self._ring = ring
+        self._destination_path = destination_path
+        self._file_size = file_size
+        self._metadata = metadata
+        self._upload_ledger = upload_ledger
+        self._stream_upload = None
+        self._threads = []
+        self._target_reference = None
+        self._error = None
+        self._lock = Lock()
+
+    ###########################################################################
+    @property
+    def target(self):
+        return self._target
+
+    ###########################################################################
+    @property
+    def target_reference(self):
+        return self._target_reference
+
+    ###########################################################################
+    @property
+    def error(self):
+        return self._error
+
+    ###########################################################################
+    @property
+    def upload_ledger(self):
+        return self._upload_ledger
+
+    ###########################################################################
+    def start(self):
+        try:
+            self._stream_upload = self._target.open_stream_upload(
+                self._destination_path, metadata=self._metadata)
+            if self._upload_ledger:
+                self._upload_ledger.start(self._stream_upload.upload_id,
+                                          self._destination_path,
+                                          self._file_size)
+        except Exception, e:
+            logger.exception("FanOutTargetUpload: error while starting upload"
+                             " to %s" % self._target)
+            self.fail(e)
+            return
+
+        for i in range(_target_upload_concurrency(self._target)):
+            thread = Thread(target=self._upload_parts)
+            thread.daemon = True
+            self._threads.append(thread)
+            thread.start()
+
+    ###########################################################################
+    def _upload_parts(self):
+        while not self._error:
+            item = self._ring.get(self._index)
+            if item is None:
+                return
+            seq, (part_num, offset, data) = item
+            try:
+                etag = self._stream_upload.upload_part(data,
+                                                       part_num=part_num)
+                if self._upload_ledger:
+                    self._upload_ledger.part_completed(part_num, offset,
+                                                       len(data), etag)
+            except Exception, e:
+                logger.exception("FanOutTargetUpload: error while uploading "
+                                 "part %s to %s" % (part_num, self._target))
+                self.fail(e)
+                return
+            self._ring.release(self._index, seq)
+
+    ###########################################################################
+    def fail(self, error):
+        with self._lock:
+            if self._error:
+                return
+            self._error = error
+
+        self._ring.remove_consumer(self._index)
+        # keep uploaded parts when the retry can resume from them
+        if self._stream_upload and not self._upload_ledger:
+            self._stream_upload.abort()
+
+    ###########################################################################
+    def wait(self, upload_plan, checksum=None):
+        """
+            Waits for all parts to be uploaded and completes the upload.
+            checksum (FileChecksum) holds the checksum of the parts read
+        """
+        for thread in self._threads:
+            thread.join()
+
+        if self._error:
+            return
+
+        try:
+            target_ref = self._stream_upload.complete()
+            target_ref.preserve = self._target.preserve
+            target_ref.upload_plan = upload_plan
+            if checksum:
+                target_ref.md5 = checksum.md5
+                target_ref.sha256 = checksum.sha256
+            if not target_ref.etag:
+                self._target._verify_file_uploaded(self._destination_path,
+                                                   self._file_size)
+            self._target_reference = target_ref
+        except Exception, e:
+            logger.exception("FanOutTargetUpload: error while completing "
+                             "upload to %s" % self._target)
+            self.fail(e)
+
+    ###########################################################################
+    def retried(self, target_reference, error):
+        self._target_reference = target_reference
+        self._error = error
+
+    ###########################################################################
+    def join(self):
+        """
+            For TargetUploader compatibility. Fan-out uploads are done by the
+            time they are returned
+        """
+
+###############################################################################
+# Multi-part upload planning
+###############################################################################
+class MultipartLimits(object):
+    """
+        Provider limits for multi-part uploads
+    """
+    ###########################################################################
+    def __init__(self, min_part_size, max_part_size, max_parts):
+        self.min_part_size = min_part_size
+        self.max_part_size = max_part_size
+        self.max_parts = max_parts
+
+S3_MULTIPART_LIMITS = MultipartLimits(min_part_size=5 * 1024 * 1024,
+                                      max_part_size=5 * 1024 * 1024 * 1024,
+                                      max_parts=10000)
+
+# swift segments have no minimum size. max_parts is the default static
+# large object manifest limit
+CF_MULTIPART_LIMITS = MultipartLimits(min_part_size=1,
+                                      max_part_size=5 * 1024 * 1024 * 1024,
+                                      max_parts=1000)
+
+# ranged downloads have no provider limits. Ranges below min_part_size are
+# dominated by request latency
+RANGED_DOWNLOAD_LIMITS = MultipartLimits(min_part_size=8 * 1024 * 1024,
+                                         max_part_size=MAX_SPLIT_SIZE,
+                                         max_parts=10000)
+
+###############################################################################
+# MultipartUploadPlanner class
+###############################################################################
+class MultipartUploadPlanner(object):
+    """
+        Chooses part sizes for a multi-part upload.
+
+        The initial part size splits the file into enough parts to keep all
+        uploaders busy (at least DEFAULT_TARGET_PART_COUNT parts, or
+        PARTS_PER_UPLOADER parts per uploader), capped at MAX_SPLIT_SIZE
+        unless the provider part count limit forces bigger parts.
+
+        While uploading, part sizes adapt to the observed per-part latency:
+        parts slower than MAX_PART_SECONDS halve the part size so that a
+        retried part costs less, and fast parts grow it back up to the
+        initial size. Every part stays within the provider limits.
+    """
+    ###########################################################################
+    def __init__(self, file_size, limits, concurrency=1):
+        self._file_size = file_size
+        self._limits = limits
+        self._concurrency = concurrency
+        self._initial_part_size = self._compute_initial_part_size()
+        self._part_size = self._initial_part_size
+        self._offset = 0
+        self._part_count = 0
+        self._completed_count = 0
+        self._total_part_seconds = 0
+        self._max_part_seconds = 0
+        self._min_part_size_used = None
+        self._max_part_size_used = 0
+        self._lock = Lock()
+
+    ###########################################################################
+    def _compute_initial_part_size(self):
+        limits = self._limits
+        target_part_count = max(DEFAULT_TARGET_PART_COUNT,
+                                self._concurrency * PARTS_PER_UPLOADER)
+        part_size = _ceil_div(self._file_size, target_part_count)
+        part_size = min(part_size, MAX_SPLIT_SIZE)
+        part_size = max(part_size,
+                        _ceil_div(self._file_size, limits.max_parts),
+                        limits.min_part_size)
+
+        return min(part_size, limits.max_part_size)
+
+    ###########################################################################
+    @property
+    def initial_part_size(self):
+        return self._initial_part_size
+
+    ###########################################################################
+    @property
+    def estimated_part_count(self):
+        return max(1, _ceil_div(self._file_size, self._initial_part_size))
+
+    ###########################################################################
+    @property
+    def offset(self):
+        """
+            Offset of the next part
+        """
+        return self._offset
+
+    ###########################################################################
+    def next_part(self):
+        """
+            Returns the next (part_num, offset, size) to upload or None if all
+            parts have been handed out
+        """
+        with self._lock:
+            remaining = self._file_size - self._offset
+            if remaining <= 0:
+                return None
+
+            limits = self._limits
+            size = self._part_size
+            # remaining bytes must fit in the remaining number of parts
+            parts_left = limits.max_parts - self._part_count
+            if parts_left <= 1:
+                size = remaining
+            else:
+                size = max(size, _ceil_div(remaining, parts_left))
+
+            # do not leave a trailing part below the provider minimum
+            if 0 < remaining - size < limits.min_part_size:
+                if remaining <= limits.max_part_size:
+                    size = remaining
+                else:
+                    size = remaining - limits.min_part_size
+
+            size = min(size, remaining, limits.max_part_size)
+
+            self._part_count += 1
+            part = (self._part_count, self._offset, size)
+            self._offset += size
+
+            if self._min_part_size_used is None or size < self._min_part_size_used:
+                self._min_part_size_used = size
+            if size > self._max_part_size_used:
+                self._max_part_size_used = size
+
+            return part
+
+    ###########################################################################
+    def resume(self, part_count, offset):
+        """
+            Continues an upload whose first part_count parts (offset bytes)
+            have already been uploaded
+        """
+        with self._lock:
+            self._part_count = part_count
+            self._offset = offset
+
+    ###########################################################################
+    def part_completed(self, size, seconds):
+        with self._lock:
+            self._completed_count += 1
+            self._total_part_seconds += seconds
+            self._max_part_seconds = max(self._max_part_seconds, seconds)
+
+            if seconds > MAX_PART_SECONDS:
+                self._part_size = max(self._part_size / 2,
+                                      self._limits.min_part_size)
+            elif seconds < MIN_PART_SECONDS:
+                self._part_size = min(self._part_size * 2,
+                                      self._initial_part_size)
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        doc = {
+            "initialPartSize": self._initial_part_size,
+            "minPartSize": self._min_part_size_used,
+            "maxPartSize": self._max_part_size_used,
+            "partCount": self._part_count,
+            "concurrency": self._concurrency
+        }
+
+        if self._completed_count:
+            avg_part_seconds = (self._total_part_seconds /
+                                self._completed_count)
+            doc["avgPartSeconds"] = round(avg_part_seconds, 3)
+            doc["maxPartSeconds"] = round(self._max_part_seconds, 3)
+
+        return doc
+
+###############################################################################
+def _ceil_div(a, b):
+    return (a + b - 1) / b
+
+###############################################################################
+# UploadLedger class
+###############################################################################
+class UploadLedger(MBSObject):
+    """
+        Persisted progress of a multi-part upload of one file to one target:
+        the provider upload id and the number, offset, size and etag of each
+        completed part. Calls on_change(ledger) after every change so that
+        the owner can save it. A restarted upload resumes after the longest
+        run of completed parts (1..n) that are still on the target
+    """
+    ###########################################################################
+    def __init__(self, target_index=None):
+        MBSObject.__init__(self)
+        self._target_index = target_index
+        self._destination_path = None
+        self._file_size = None
+        self._upload_id = None
+        self._parts = []
+        self._on_change = None
+        self._lock = Lock()
+
+    ###########################################################################
+    @property
+    def target_index(self):
+        """
+            Index of the target in the backup's target + secondary targets
+        """
+        return self._target_index
+
+    @target_index.setter
+    def target_index(self, val):
+        self._target_index = val
+
+    ###########################################################################
+    @property
+    def destination_path(self):
+        return self._destination_path
+
+    @destination_path.setter
+    def destination_path(self, val):
+        self._destination_path = val
+
+    ###########################################################################
+    @property
+    def file_size(self):
+        return self._file_size
+
+    @file_size.setter
+    def file_size(self, val):
+        self._file_size = val
+
+    ###########################################################################
+    @property
+    def upload_id(self):
+        return self._upload_id
+
+    @upload_id.setter
+    def upload_id(self, val):
+        self._upload_id = val
+
+    ###########################################################################
+    @property
+    def parts(self):
+        """
+            Completed parts sorted by part number
+        """
+        return self._parts
+
+    @parts.setter
+    def parts(self, val):
+        self._parts = val or []
+
+    ###########################################################################
+    @property
+    def on_change(self):
+        return self._on_change
+
+    @on_change.setter
+    def on_change(self, val):
+        self._on_change = val
+
+    ###########################################################################
+    def is_resumable(self, destination_path, file_size):
+        return (self.upload_id is not None and
+                self.destination_path == destination_path and
+                self.file_size == file_size)
+
+    ###########################################################################
+    def start(self, upload_id, destination_path, file_size):
+        with self._lock:
+            self._upload_id = upload_id
+            self._destination_path = destination_path
+            self._file_size = file_size
+            self._parts = []
+        self._changed()
+
+    ###########################################################################
+    def resume(self, uploaded_etags):
+        """
+            Keeps the completed parts 1..n whose etags match uploaded_etags
+            (part number => etag of parts on the target) and drops the rest.
+            Returns (n, offset of part n+1)
+        """
+        with self._lock:
+            resumable_parts = []
+            offset = 0
+            for part in self._parts:
+                etag = uploaded_etags.get(part["partNumber"])
+                if (part["partNumber"] != len(resumable_parts) + 1 or
+                        part["offset"] != offset or
+                        not same_etag(etag, part["etag"])):
+                    break
+                resumable_parts.append(part)
+                offset += part["size"]
+
+            self._parts = resumable_parts
+        self._changed()
+        return len(resumable_parts), offset
+
+    ###########################################################################
+    def part_completed(self, part_num, offset, size, etag):
+        with self._lock:
+            parts = filter(lambda p: p["partNumber"] != part_num, self._parts)
+            parts.append({
+                "partNumber": part_num,
+                "offset": offset,
+                "size": size,
+                "etag": etag
+            })
+            self._parts = sorted(parts, key=lambda p: p["partNumber"])
+        self._changed()
+
+    ###########################################################################
+    def _changed(self):
+        if self.on_change:
+            self.on_change(self)
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        with self._lock:
+            return {
+                "_type": "UploadLedger",
+                "targetIndex": self.target_index,
+                "destinationPath": self.destination_path,
+                "fileSize": self.file_size,
+                "uploadId": self.upload_id,
+                "parts": list(self._parts)
+            }
+
+###############################################################################
+class _S3UploadKey(Key):
+    """
+        Key that records the server side encryption header of its PUT
+        response. Boto compares the etag of the response with the md5 of the
+        body which always fails for SSE-KMS objects so that check is skipped
+        for them (the upload is verified by size instead)
+    """
+    ###########################################################################
+    def should_retry(self, response, chunked_transfer=False):
+        self.encrypted = response.getheader(S3_ENCRYPTION_HEADER, None)
+        if (self.encrypted == S3_KMS_ENCRYPTION_ALGORITHM and
+                200 <= response.status <= 299):
+            self.etag = response.getheader("etag")
+            return True
+        return Key.should_retry(self, response,
+                                chunked_transfer=chunked_transfer)
+
+###############################################################################
+def _s3_complete_multipart_xml(parts):
+    xml = "<CompleteMultipartUpload>\n"
+    for part in parts:
+        xml += "  <Part>\n"
+        xml += "    <PartNumber>%d</PartNumber>\n" % part["partNumber"]
+        xml += "    <ETag>%s</ETag>\n" % part["etag"]
+        xml += "  </Part>\n"
+    xml += "</CompleteMultipartUpload>"
+    return xml
+
+###############################################################################
+def _cf_segment_prefix(destination_path, upload_id):
+    return "%s.segments/%s/" % (destination_path, upload_id)
+
+###############################################################################
+# Concurrent file part uploads
+###############################################################################
+def upload_file_parts(file_path, planner, upload_part_func,
+                      concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+                      memory_budget=DEFAULT_UPLOAD_MEMORY_BUDGET,
+                      on_part_uploaded=None, checksum=None):
+    """
+        Uploads file_path in parts chosen by planner (MultipartUploadPlanner)
+        by calling upload_part_func(part_num, data) for each part (part
+        numbers start at 1) using a bounded pool of uploader threads. Each
+        thread holds at most one part in memory so the pool size is capped
+        by memory_budget.
+        on_part_uploaded(part_num, offset, size, result) is called with the
+        result of upload_part_func after each part is uploaded.
+        Each part is hashed by checksum (FileChecksum) if specified.
+        Raises the first error encountered after all threads stop
+    """
+    part_size = planner.initial_part_size
+    pool_size = min(concurrency, memory_budget / part_size,
+                    planner.estimated_part_count)
+    pool_size = max(1, pool_size)
+
+    logger.info("Uploading '%s' in ~%s parts of %s bytes using %s uploader "
+                "threads" % (file_path, planner.estimated_part_count,
+                             part_size, pool_size))
+
+    if checksum:
+        # parts of a resumed upload are not read by the uploaders
+        checksum.update_from_file(file_path, planner.offset)
+
+    state = {
+        "error": None,
+        "lock": Lock()
+    }
+    uploaders = []
+    for i in range(pool_size):
+        uploader = FilePartUploader(file_path, planner, upload_part_func,
+                                    state, on_part_uploaded=on_part_uploaded,
+                                    checksum=checksum)
+        uploaders.append(uploader)
+        uploader.start()
+
+    for uploader in uploaders:
+        uploader.join()
+
+    if state["error"]:
+        raise state["error"]
+
+###############################################################################
+# FilePartUploader class
+###############################################################################
+class FilePartUploader(Thread):
+    """
+        Uploads parts handed out by the planner until there are no more parts
+        or any uploader failed. Reports each part's upload time back to the
+        planner
+    """
+    ###########################################################################
+    def __init__(self, file_path, planner, upload_part_func, state,
+                 on_part_uploaded=None, checksum=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self._file_path = file_path
+        self._planner = planner
+        self._upload_part_func = upload_part_func
+        self._state = state
+        self._on_part_uploaded = on_part_uploaded
+        self._checksum = checksum
+
+    ###########################################################################
+    def run(self):
+        try:
+            with open(self._file_path, "rb") as file_obj:
+                while not self._state["error"]:
+                    part = self._planner.next_part()
+                    if part is None:
+                        break
+
+                    part_num, offset, size = part
+                    file_obj.seek(offset)
+                    data = file_obj.read(size)
+                    if self._checksum:
+                        self._checksum.update_at(offset, data)
+                    _throttle(len(data))
+                    start_time = time.time()
+                    result = self._upload_part_func(part_num, data)
+                    self._planner.part_completed(size,
+                                                 time.time() - start_time)
+                    if self._on_part_uploaded:
+                        self._on_part_uploaded(part_num, offset, size, result)
+        except Exception, ex:
+            logger.exception("FilePartUploader: error while uploading part "
+                             "of '%s'" % self._file_path)
+            with self._state["lock"]:
+                if not self._state["error"]:
+                    self._state["error"] = ex
+            # other uploaders might be waiting to hash their parts after
+            # this uploader's part
+            if self._checksum:
+                self._checksum.abort()
+
+###############################################################################
+# Concurrent ranged downloads
+###############################################################################
+def download_file_parts(file_path, file_size, download_part_func,
+                        concurrency=DEFAULT_DOWNLOAD_CONCURRENCY):
+    """
+        Downloads a file of file_size bytes to file_path in ranges by calling
+        download_part_func(part_num, offset, size) for each range using
+        concurrency downloader threads. file_path is preallocated and
+        download_part_func must write the range at its offset.
+        Ranges are hashed in file order as soon as all ranges before them
+        have been written (they are read back from the page cache).
+        Returns the FileChecksum of the file.
+        Raises the first error encountered after all threads stop
+    """
+    planner = MultipartUploadPlanner(file_size, RANGED_DOWNLOAD_LIMITS,
+                                     concurrency=concurrency)
+    pool_size = max(1, min(concurrency, planner.estimated_part_count))
+
+    logger.info("Downloading '%s' in ~%s parts of %s bytes using %s "
+                "downloader threads" % (file_path,
+                                        planner.estimated_part_count,
+                                        planner.initial_part_size, pool_size))
+
+    with open(file_path, "wb") as file_obj:
+        file_obj.truncate(file_size)
+
+    checksum = FileChecksum()
+    state = {
+        "error": None,
+        "lock": Lock(),
+        # offset => size of the downloaded parts that are not hashed yet
+        "downloaded": {},
+        "downloaded_end": 0
+    }
+    downloaders = []
+    for i in range(pool_size):
+        downloader = FilePartDownloader(file_path, planner,
+                                        download_part_func, state, checksum)
+        downloaders.append(downloader)
+        downloader.start()
+
+    for downloader in downloaders:
+        downloader.join()
+
+    if state["error"]:
+        raise state["error"]
+
+    if checksum.size != file_size:
+        raise errors.DownloadedFileSizeMatchError(
+            file_path=file_path, size=checksum.size, expected_size=file_size)
+
+    return checksum
+
+###############################################################################
+# FilePartDownloader class
+###############################################################################
+class FilePartDownloader(Thread):
+    """
+        Downloads parts handed out by the planner until there are no more
+        parts or any downloader failed
+    """
+    ###########################################################################
+    def __init__(self, file_path, planner, download_part_func, state,
+                 checksum):
+        Thread.__init__(self)
+        self.daemon = True
+        self._file_path = file_path
+        self._planner = planner
+        self._download_part_func = download_part_func
+        self._state = state
+        self._checksum = checksum
+
+    ###########################################################################
+    def run(self):
+        try:
+            while not self._state["error"]:
+                part = self._planner.next_part()
+                if part is None:
+                    break
+
+                part_num, offset, size = part
+                start_time = time.time()
+                self._download_part_func(part_num, offset, size)
+                self._planner.part_completed(size, time.time() - start_time)
+                self._hash_downloaded(offset, size)
+        except Exception, ex:
+            logger.exception("FilePartDownloader: error while downloading "
+                             "part of '%s'" % self._file_path)
+            with self._state["lock"]:
+                if not self._state["error"]:
+                    self._state["error"] = ex
+
+    ###########################################################################
+    def _hash_downloaded(self, offset, size):
+        state = self._state
+        with state["lock"]:
+            downloaded = state["downloaded"]
+            downloaded[offset] = size
+            end = state["downloaded_end"]
+            while end in downloaded:
+                end += downloaded.pop(end)
+            state["downloaded_end"] = end
+
+        # concurrent calls are serialized by the checksum and calls with an
+        # end that is already hashed do nothing
+        self._checksum.update_from_file(self._file_path, end)
+
+###############################################################################
+# Stream uploads
+###############################################################################
+def multi_target_upload_stream(targets, stream, destination_path,
+                               metadata=None,
+                               part_size=STREAM_UPLOAD_PART_SIZE):
+    """
+        Reads the specified stream (e.g. stdout of a tar process) one part at
+        a time and uploads each part to all targets. The stream is read only
+        once. Returns the list of target references in the order of targets
+    """
+    logger.info("MULTI TARGET STREAM UPLOAD: Starting stream upload to '%s' "
+                "for %s targets" % (destination_path, len(targets)))
+
+    stream_uploads = []
+    current_target = None
+    checksum = FileChecksum()
+    try:
+        for target in targets:
+            current_target = target
+            stream_uploads.append(
+                target.open_stream_upload(destination_path,
+                                          metadata=metadata))
+
+        while True:
+            data = _read_stream_part(stream, part_size)
+            if not data:
+                break
+            checksum.update(data)
+            for target, stream_upload in zip(targets, stream_uploads):
+                current_target = target
+                stream_upload.upload_part(data)
+
+        target_references = []
+        for target, stream_upload in zip(targets, stream_uploads):
+            current_target = target
+            target_ref = stream_upload.complete()
+            target_ref.preserve = target.preserve
+            target_ref.md5 = checksum.md5
+            target_ref.sha256 = checksum.sha256
+            if not target_ref.etag:
+                target._verify_file_uploaded(destination_path,
+                                             target_ref.file_size)
+            target_references.append(target_ref)
+
+        logger.info("MULTI TARGET STREAM UPLOAD: SUCCESSFULLY uploaded '%s'"
+                    " (%s bytes)!" % (destination_path,
+                                      target_references[0].file_size))
+        return target_references
+
+    except Exception, e:
+        logger.exception("multi_target_upload_stream(): Exception caught ")
+        for stream_upload in stream_uploads:
+            stream_upload.abort()
+
+        if isinstance(e, errors.TargetError):
+            raise
+        elif errors.is_connection_exception(e):
+            raise errors.TargetConnectionError(current_target.container_name,
+                                               cause=e)
+        else:
+            raise errors.TargetUploadError(destination_path,
+                                           current_target.container_name,
+                                           cause=e)
+
+###############################################################################
+def _read_stream_part(stream, part_size):
+    chunks = []
+    remaining = part_size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+
+    return "".join(chunks)
+
+###############################################################################
+# S3StreamUpload class
+###############################################################################
+class S3StreamUpload(object):
+    """
+        Uploads a stream of unknown length to an s3 bucket as a multipart
+        upload. Parts are retried individually. Parts with explicit part
+        numbers can be uploaded concurrently
+    """
+    ###########################################################################
+    def __init__(self, target, destination_path, metadata=None):
+        self._target = target
+        self._destination_path = destination_path
+        self._part_count = 0
+        self._part_etags = {}
+        self._size = 0
+        self._max_part_size = 0
+        self._lock = Lock()
+        bucket = target._get_bucket()
+        self._mp = bucket.initiate_multipart_upload(
+            destination_path, metadata=metadata,
+            encrypt_key=target.cloud_storage_encryption_enabled)
+
+    ###########################################################################
+    @property
+    def upload_id(self):
+        return self._mp.id
+
+    ###########################################################################
+    def upload_part(self, data, part_num=None):
+        """
+            Uploads the next part (or part part_num). Returns the part etag
+        """
+        with self._lock:
+            if part_num is None:
+                part_num = self._part_count + 1
+            self._part_count = max(self._part_count, part_num)
+
+        logger.info("S3StreamUpload: Uploading part %d (%s bytes) of '%s'" %
+                    (part_num, len(data), self._destination_path))
+        _throttle(len(data))
+        part_key = self._robustified_upload_part(part_num, data)
+
+        with self._lock:
+            self._part_etags[part_num] = part_key.etag
+            self._size += len(data)
+            self._max_part_size = max(self._max_part_size, len(data))
+
+        return part_key.etag
+
+    ###########################################################################
+    @robustify(max_attempts=5, retry_interval=5,
+               backoff=2,
+               do_on_exception=errors.raise_if_not_retriable,
+               do_on_failure=errors.raise_exception)
+    def _robustified_upload_part(self, part_num, data):
+        return self._mp.upload_part_from_file(StringIO(data), part_num)
+
+    ###########################################################################
+    def complete(self):
+        """
+            Completes the upload and verifies its etag against the etags
+            (md5s) of the uploaded parts
+        """
+        completed = self._mp.complete_upload()
+        expected_etag = s3_multipart_etag([self._part_etags[i]
+                                           for i in sorted(self._part_etags)])
+        if not same_etag(completed.etag, expected_etag):
+            raise errors.UploadedFileChecksumMismatchError(
+                destination_path=self._destination_path,
+                container_name=self._target.container_name,
+                dest_etag=completed.etag, expected_etag=expected_etag)
+
+        logger.info("S3StreamUpload: Stream upload of '%s' (%s parts, %s "
+                    "bytes) completed successfully!" %
+                    (self._destination_path, self._part_count, self._size))
+
+        upload_plan = {
+            "initialPartSize": self._max_part_size,
+            "partCount": self._part_count,
+            "concurrency": 1
+        }
+        return FileReference(file_path=self._destination_path,
+                             file_size=self._size,
+                             cloud_storage_encryption=completed.encrypted,
+                             upload_plan=upload_plan,
+                             etag=completed.etag)
+
+    ###########################################################################
+    def abort(self):
+        try:
+            self._mp.cancel_upload()
+        except Exception, e:
+            logger.error("S3StreamUpload: Error while cancelling stream "
+                         "upload of '%s': %s" % (self._destination_path, e))
@@ -0,0 +1,190 @@
+__author__ = 'abdul'
+
+import time
+import logging
+import traceback
+
+import pymongo
+from pymongo.cursor import CursorType
+from pymongo.errors import CollectionInvalid
+
+from threading import Thread
+
+from base import MBSObject
+from date_utils import date_now
+
+###############################################################################
+# LOGGER
+###############################################################################
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+###############################################################################
+# CONSTANTS
+###############################################################################
+DEFAULT_COLLECTION_NAME = "task-wakeups"
+# 1 MB is plenty since wakeups are only relevant for a few seconds
+DEFAULT_SIZE_IN_BYTES = 1024 * 1024
+
+# time to wait before re-tailing after a cursor dies or an error
+RETAIL_SLEEP = 1
+
+###############################################################################
+# TaskWakeupChannel
+###############################################################################
+class TaskWakeupChannel(MBSObject):
+    """
+        Optional channel used to wake up engines as soon as a task is
+        scheduled instead of waiting for their next poll. Backed by a capped
+        collection in the mbs database that engines tail. Engines still poll
+        so a lost wakeup only delays a task until the next poll.
+    """
+    ###########################################################################
+    def __init__(self):
+        MBSObject.__init__(self)
+        self._collection_name = DEFAULT_COLLECTION_NAME
+        self._size_in_bytes = DEFAULT_SIZE_IN_BYTES
+        self._collection = None
+
+    ###########################################################################
+    @property
+    def collection_name(self):
+        return self._collection_name
+
+    @collection_name.setter
+    def collection_name(self, val):
+        self._collection_name = val
+
+    ###########################################################################
+    @property
+    def size_in_bytes(self):
+        return self._size_in_bytes
+
+    @size_in_bytes.setter
+    def size_in_bytes(self, val):
+        self._size_in_bytes = val
+
+    ###########################################################################
+    @property
+    def collection(self):
+        if self._collection is None:
+            from mbs import get_mbs
+            database = get_mbs().database
+            try:
+                database.create_collection(self.collection_name, capped=True,
+                                           size=self.size_in_bytes)
+            except CollectionInvalid:
+                # already exists
+                pass
+            self._collection = database[self.collection_name]
+
+        return self._collection
+
+    ###########################################################################
+    def signal(self, task_collection_name, task):
+        """
+            Signals engines that task has been scheduled in
+            task_collection_name. Never raises since polling is the fallback
+        """
+        self.signal_tasks(task_collection_name, [task])
+
+    ###########################################################################
+    def signal_tasks(self, task_collection_name, tasks):
+        """
+            Signals engines once for a batch of tasks scheduled in
+            task_collection_name. Never raises since polling is the fallback
+        """
+        if not tasks:
+            return
+        task_ids = [task.id for task in tasks]
+        priorities = [task.priority for task in tasks
+                      if task.priority is not None]
+        try:
+            self.collection.insert_one({
+                "taskCollection": task_collection_name,
+                "taskIds": task_ids,
+                "priority": min(priorities) if priorities else None,
+                "createdDate": date_now()
+            })
+        except Exception, e:
+            logger.error("Failed to signal wakeup for tasks %s: %s" %
+                         (task_ids, e))
+
+    ###########################################################################
+    def tail(self, on_wakeup, should_stop):
+        """
+            Calls on_wakeup(task_collection_name) for every wakeup signaled
+            after tail() was called until should_stop() returns true
+        """
+        last_id = None
+        started = False
+        while not should_stop():
+            try:
+                # inside the retry loop so that a transient error at startup
+                # does not stop the listener
+                if not started:
+                    last_id = self._get_last_wakeup_id()
+                    started = True
+
+                q = {"_id": {"$gt": last_id}} if last_id else {}
+                cursor = self.collection.find(
+                    q, cursor_type=CursorType.TAILABLE_AWAIT,
+                    max_await_time_ms=1000)
+                while cursor.alive and not should_stop():
+                    for doc in cursor:
+                        last_id = doc["_id"]
+                        on_wakeup(doc.get("taskCollection"))
+                        if should_stop():
+                            break
+            except Exception, e:
+                logger.error("Error while tailing task wakeups: %s\n%s" %
+                             (e, traceback.format_exc()))
+
+            if not should_stop():
+                time.sleep(RETAIL_SLEEP)
+
+    ###########################################################################
+    def _get_last_wakeup_id(self):
+        last = self.collection.find_one(sort=[("$natural",
+                                               pymongo.DESCENDING)])
+        return last and last["_id"]
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        return {
+            "_type": "TaskWakeupChannel",
+            "collectionName": self.collection_name,
+            "sizeInBytes": self.size_in_bytes
+        }
+
+###############################################################################
+# TaskWakeupListener
+###############################################################################
+class TaskWakeupListener(Thread):
+    """
+        Tails the wakeup channel and wakes up the engine task processor of
+        the signaled task collection
+    """
+    ###########################################################################
+    def __init__(self, channel, task_processors):
+        Thread.__init__(self)
+        self.daemon = True
+        self._channel = channel
+        self._task_processors = task_processors
+        self._stopped = False
+
+    ###########################################################################
+    def run(self):
+        logger.info("Task wakeup listener started")
+        self._channel.tail(self._on_wakeup, lambda: self._stopped)
+        logger.info("Task wakeup listener stopped")
+
+    ###########################################################################
+    def _on_wakeup(self, task_collection_name):
+        processor = self._task_processors.get(task_collection_name)
+        if processor:
+            processor.wake_up()
+
+    ###########################################################################
+    def stop(self):
+        self._stopped = True
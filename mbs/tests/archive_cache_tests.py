@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+
+import mbs.target
+
+from . import BaseTest
+
+
+###############################################################################
+# ArchiveCacheTest
+###############################################################################
+class ArchiveCacheTest(BaseTest):
+
+    ###########################################################################
+    def test_lru_eviction(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            cache = self.mbs.maker.make({
+                "_type": "ArchiveCache",
+                "cacheDir": os.path.join(work_dir, "cache"),
+                "maxSize": 2500
+            })
+
+            refs = []
+            for i in range(3):
+                path = os.path.join(work_dir, "backup%s.tgz" % i)
+                with open(path, "w") as f:
+                    f.write(str(i) * 1000)
+                refs.append(mbs.target.FileReference(
+                    file_path="backup%s.tgz" % i, file_size=1000,
+                    md5="%032d" % i))
+
+            restored = os.path.join(work_dir, "restored.tgz")
+            # archives without checksums are not cached
+            self.assertFalse(cache.get(mbs.target.FileReference(
+                file_path="foo.tgz", file_size=1000), restored))
+            self.assertFalse(cache.get(refs[0], restored))
+
+            cache.put(refs[0], os.path.join(work_dir, "backup0.tgz"))
+            cache.put(refs[1], os.path.join(work_dir, "backup1.tgz"))
+            # make backup1 the least recently used
+            os.utime(cache._entry_path(refs[1].md5), (0, 0))
+            self.assertTrue(cache.get(refs[0], restored))
+            with open(restored) as f:
+                self.assertEqual(f.read(), "0" * 1000)
+
+            cache.put(refs[2], os.path.join(work_dir, "backup2.tgz"))
+            self.assertFalse(os.path.exists(cache._entry_path(refs[1].md5)))
+            self.assertTrue(os.path.exists(cache._entry_path(refs[0].md5)))
+            self.assertTrue(os.path.exists(cache._entry_path(refs[2].md5)))
+        finally:
+            shutil.rmtree(work_dir)
+
+    ###########################################################################
+    def test_stale_temp_files(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            cache_dir = os.path.join(work_dir, "cache")
+            cache = self.mbs.maker.make({
+                "_type": "ArchiveCache",
+                "cacheDir": cache_dir
+            })
+            path = os.path.join(work_dir, "backup.tgz")
+            with open(path, "w") as f:
+                f.write("x" * 1000)
+            ref = mbs.target.FileReference(file_path="backup.tgz",
+                                           file_size=1000, md5="%032d" % 1)
+
+            # left behind by workers that died while adding entries
+            os.makedirs(cache_dir)
+            for key in [ref.md5, "%032d" % 2]:
+                with open(os.path.join(cache_dir, ".tmp-%s" % key), "w") as f:
+                    f.write("partial")
+
+            cache.put(ref, path)
+            self.assertTrue(os.path.exists(cache._entry_path(ref.md5)))
+            self.assertEqual(sorted(os.listdir(cache_dir)),
+                             [".lock", ref.md5])
+        finally:
+            shutil.rmtree(work_dir)
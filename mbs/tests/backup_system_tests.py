@@ -0,0 +1,63 @@
+from datetime import datetime
+
+from mock import Mock, PropertyMock, patch
+
+import mbs.backup_system
+import mbs.mbs
+import mbs.scheduler
+
+from . import BaseTest
+
+
+###############################################################################
+# BackupSystemTest
+###############################################################################
+class BackupSystemTest(BaseTest):
+
+    ###########################################################################
+    def _mock_plan_collection(self, plan_docs, plans):
+        def find(q, projection=None):
+            return [doc for doc in plan_docs
+                    if doc.get("nextOccurrence") is None or
+                    doc["nextOccurrence"] <= datetime.utcnow()]
+
+        def save_document(doc):
+            doc["_id"] = "p%s" % len(plan_docs)
+            plan_docs.append(doc)
+
+        def find_iter(q, sort=None):
+            return [plan for plan in plans if plan.id in q["_id"]["$in"]]
+
+        plan_collection = Mock()
+        plan_collection.collection.find.side_effect = find
+        plan_collection.save_document.side_effect = save_document
+        plan_collection.find_iter.side_effect = find_iter
+        return plan_collection
+
+    ###########################################################################
+    def test_plan_saved_by_other_backup_system_is_dispatched(self):
+        plan_docs = []
+        plan = Mock(id=None, created_date=None, next_occurrence=None,
+                    priority=None)
+        plan.validate.return_value = None
+        plan.to_document.return_value = {"nextOccurrence": None}
+        plan_collection = self._mock_plan_collection(plan_docs, [plan])
+
+        with patch.object(mbs.mbs.MBS, "plan_collection",
+                          new_callable=PropertyMock) as plan_collection_prop:
+            plan_collection_prop.return_value = plan_collection
+
+            scheduler = mbs.scheduler.BackupScheduler(Mock())
+            scheduler._reload_plan_timeline()
+            self.assertEqual(len(scheduler.plan_timeline), 0)
+
+            # e.g. the api server
+            mbs.backup_system.BackupSystem().save_plan(plan)
+            self.assertEqual(plan.id, "p0")
+
+            # no timeline reload is due and no maintenance
+            scheduler._maintenance_date = datetime(2100, 1, 1)
+            scheduler._dispatch_plans = Mock()
+            scheduler.tick()
+
+            scheduler._dispatch_plans.assert_called_once_with([plan])
@@ -0,0 +1,82 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from mock import Mock
+
+import mbs.bandwidth
+import mbs.errors
+
+from . import BaseTest
+
+
+###############################################################################
+# BandwidthTest
+###############################################################################
+class BandwidthTest(BaseTest):
+
+    ###########################################################################
+    def test_token_bucket_priorities(self):
+        bucket = mbs.bandwidth.TokenBucket(10000, burst=1000)
+        # drain the bucket so that both acquirers have to wait
+        bucket.acquire(1000)
+        served = []
+
+        def acquire(name, priority):
+            bucket.acquire(1000, priority)
+            served.append(name)
+
+        backup = threading.Thread(target=acquire, args=("backup", 10))
+        backup.start()
+        time.sleep(0.01)
+        restore = threading.Thread(target=acquire, args=("restore", 0))
+        restore.start()
+        backup.join()
+        restore.join()
+
+        # the restore preempted the backup that was waiting before it
+        self.assertEqual(served, ["restore", "backup"])
+
+    ###########################################################################
+    def test_governor_server(self):
+        socket_dir = tempfile.mkdtemp()
+        try:
+            governor = self.mbs.maker.make({
+                "_type": "BandwidthGovernor",
+                "maxBytesPerSecond": 1000000,
+                "grantSize": 100000,
+                "socketPath": os.path.join(socket_dir, "governor.sock")
+            })
+            governor.set_task(Mock(type_name="Restore"))
+            server = governor.start_server()
+            try:
+                # a second engine can not take over a live socket
+                self.assertRaises(mbs.errors.ConfigurationError,
+                                  governor.start_server)
+
+                # burst (1 sec) then 0.2 sec for the other 2 grants
+                start = time.time()
+                governor.throttle(1250000)
+                self.assertGreater(time.time() - start, 0.15)
+            finally:
+                server.stop()
+                server.join()
+
+            # workers are never failed by an unreachable engine
+            start = time.time()
+            governor._client = None
+            governor.throttle(1000000)
+            self.assertLess(time.time() - start, 0.1)
+
+            # a socket file left behind by a dead engine is taken over
+            stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stale.bind(os.path.join(socket_dir, "governor.sock"))
+            stale.close()
+            server = governor.start_server()
+            server.stop()
+            server.join()
+        finally:
+            shutil.rmtree(socket_dir)
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import subprocess
+
+import mbs.compression
+
+from . import BaseTest
+
+
+###############################################################################
+# CompressionTest
+###############################################################################
+class CompressionTest(BaseTest):
+
+    ###########################################################################
+    def test_tar_commands(self):
+        # default keeps plain tar gzip
+        cmd = mbs.compression.tar_create_command(None, "a.tgz", "dump")
+        self.assertEqual(cmd[1:], ["-cv", "-z", "-f", "a.tgz", "dump"])
+        cmd = mbs.compression.tar_extract_command(None, "a.tgz")
+        self.assertEqual(cmd[1:], ["-xf", "a.tgz"])
+
+        codec = self.mbs.maker.make({"_type": "ZstdCodec", "level": 5})
+        self.assertEqual(codec.file_extension, "tar.zst")
+        cmd = mbs.compression.tar_create_command(codec, "a.tar.zst", "dump")
+        self.assertIn("--use-compress-program=zstd -T0 -5", cmd)
+        cmd = mbs.compression.tar_extract_command(
+            mbs.compression.get_codec(codec.name), "a.tar.zst")
+        self.assertIn("--use-compress-program=zstd", cmd)
+
+        self.assertRaises(mbs.compression.MBSError,
+                          mbs.compression.get_codec, "foo")
+
+    ###########################################################################
+    def test_benchmark_codecs(self):
+        source_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(source_dir, "foo.bson"), "w") as f:
+                f.write("foo" * 10000)
+
+            results = mbs.compression.benchmark_codecs(
+                source_dir, [mbs.compression.GzipCodec()])
+            self.assertEqual(len(results), 1)
+            self.assertEqual(results[0]["sourceSize"], 30000)
+            self.assertGreater(results[0]["ratio"], 1)
+        finally:
+            shutil.rmtree(source_dir)
+
+    ###########################################################################
+    def test_stream_extract(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            for db in ["db1", "db2"]:
+                os.makedirs(os.path.join(work_dir, "dump", db))
+                with open(os.path.join(work_dir, "dump", db, "foo.bson"),
+                          "w") as f:
+                    f.write(db)
+            mbs.compression.execute_command(
+                mbs.compression.tar_create_command(None, "dump.tgz", "dump",
+                                                   verbose=False),
+                cwd=work_dir)
+
+            # archives piped to tar need an explicit decompress option
+            extract_dir = os.path.join(work_dir, "extract")
+            os.mkdir(extract_dir)
+            cmd = mbs.compression.tar_extract_command(None, "-",
+                                                      members=["dump/db1"])
+            self.assertIn("-z", cmd)
+            tar_process = subprocess.Popen(cmd, cwd=extract_dir,
+                                           stdin=subprocess.PIPE)
+            with open(os.path.join(work_dir, "dump.tgz"), "rb") as f:
+                tar_process.stdin.write(f.read())
+            tar_process.stdin.close()
+            self.assertEqual(tar_process.wait(), 0)
+
+            self.assertEqual(os.listdir(os.path.join(extract_dir, "dump")),
+                             ["db1"])
+        finally:
+            shutil.rmtree(work_dir)
@@ -0,0 +1,103 @@
+from tempfile import NamedTemporaryFile
+
+import bson
+from mock import patch, Mock, PropertyMock
+
+import mbs.dedup
+
+from . import BaseTest
+
+
+###############################################################################
+# DedupTest
+###############################################################################
+class DedupTest(BaseTest):
+
+    ###########################################################################
+    def test_iter_file_chunks(self):
+        docs = [bson.BSON.encode({"_id": i, "x": "foo%s" % i * 10})
+                for i in range(2000)]
+        # insert a document in the middle of the second dump
+        docs2 = docs[:1000] + [bson.BSON.encode({"_id": "new"})] + docs[1000:]
+
+        with NamedTemporaryFile(suffix=".bson") as dump1, \
+             NamedTemporaryFile(suffix=".bson") as dump2, \
+             patch.object(mbs.dedup, "MIN_CHUNK_SIZE", 1024), \
+             patch.object(mbs.dedup, "AVG_CHUNK_SIZE", 4096), \
+             patch.object(mbs.dedup, "MAX_CHUNK_SIZE", 16384):
+            dump1.write("".join(docs))
+            dump1.flush()
+            dump2.write("".join(docs2))
+            dump2.flush()
+
+            chunks1 = list(mbs.dedup.iter_file_chunks(dump1.name))
+            chunks2 = list(mbs.dedup.iter_file_chunks(dump2.name))
+
+            self.assertEqual("".join(chunks1), "".join(docs))
+            self.assertEqual("".join(chunks2), "".join(docs2))
+            self.assertGreater(len(chunks1), 10)
+            self.assertTrue(all(len(c) <= 16384 for c in chunks1))
+
+            # only the chunk with the new document differs
+            digests1 = set(map(mbs.dedup.chunk_digest, chunks1))
+            digests2 = set(map(mbs.dedup.chunk_digest, chunks2))
+            self.assertLessEqual(len(digests2 - digests1), 2)
+
+    ###########################################################################
+    def test_upload_missing_dump_dir(self):
+        self.assertRaises(mbs.dedup.MBSError, mbs.dedup.dedup_upload_dump,
+                          "/no/such/dump", [], "backup.manifest.json", "/tmp")
+
+    ###########################################################################
+    def test_collect_garbage(self):
+        target = Mock(target_type="S3BucketTarget", container_name="bucket")
+        index = Mock()
+        index.find.side_effect = [
+            # chunks with stale references
+            [{"_id": "c1", "refs": ["dead.manifest.json", "live.manifest.json"]},
+             {"_id": "c2", "refs": ["dead.manifest.json"]}],
+            # unreferenced chunks
+            [{"digest": "ab12"}]
+        ]
+        index.find_one_and_update.return_value = {"_id": "c2"}
+
+        with patch.object(mbs.dedup.ChunkStore, "index",
+                          new_callable=PropertyMock, return_value=index):
+            store = mbs.dedup.ChunkStore(target, "/tmp")
+            total = store.collect_garbage(
+                live_manifest_paths=set(["live.manifest.json"]))
+
+        self.assertEqual(total, 1)
+        # dead references are dropped from both chunks
+        self.assertEqual(index.update_one.call_count, 2)
+        for call in index.update_one.call_args_list:
+            self.assertEqual(call[0][1],
+                             {"$pull": {"refs": {"$in": ["dead.manifest.json"]}}})
+        # the unreferenced chunk is deleted from the target and the index
+        file_ref = target.delete_file.call_args[0][0]
+        self.assertEqual(file_ref.file_path, "dedup-chunks/ab/ab12.zlib")
+        self.assertEqual(index.delete_one.call_count, 1)
+
+    ###########################################################################
+    def test_chunk_codec(self):
+        data = "foo" * 10000
+        stored = mbs.dedup.compress_chunk(data, mbs.dedup.CHUNK_CODEC_ZLIB)
+        self.assertLess(len(stored), len(data))
+        self.assertEqual(
+            mbs.dedup.decompress_chunk(stored, mbs.dedup.CHUNK_CODEC_ZLIB), data)
+        # version 1 manifests have uncompressed chunks
+        self.assertEqual(mbs.dedup.decompress_chunk(data, None), data)
+
+    ###########################################################################
+    def test_iter_file_chunks_invalid_tail(self):
+        doc = bson.BSON.encode({"_id": 1})
+        # not a bson document. the rest is cut into fixed size chunks
+        tail = "\xff\xff\xff\xff" + "x" * 40000
+        with NamedTemporaryFile(suffix=".bson") as dump, \
+             patch.object(mbs.dedup, "MAX_CHUNK_SIZE", 16384):
+            dump.write(doc + tail)
+            dump.flush()
+            chunks = list(mbs.dedup.iter_file_chunks(dump.name))
+
+        self.assertEqual("".join(chunks), doc + tail)
+        self.assertEqual(map(len, chunks), [16384, 16384, len(doc) + 7236])
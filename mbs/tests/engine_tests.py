@@ -0,0 +1,178 @@
+from datetime import timedelta
+from StringIO import StringIO
+
+from mock import Mock, patch
+
+import mbs.engine
+
+from . import BaseTest
+
+
+###############################################################################
+# WarmWorkerPoolTest
+###############################################################################
+class WarmWorkerPoolTest(BaseTest):
+
+    ###########################################################################
+    def _new_pool(self, size):
+        pool = mbs.engine.WarmWorkerPool(size)
+        pool._spawn_worker = Mock(
+            side_effect=lambda: Mock(**{"poll.return_value": None}))
+        return pool
+
+    ###########################################################################
+    def test_run_task(self):
+        pool = self._new_pool(2)
+        pool.start()
+        self.assertEqual(pool._spawn_worker.call_count, 2)
+        worker = pool._idle[0]
+
+        # the first task is handed to a worker spawned ahead of it
+        popen = pool.run_task("run-backup", "b1", "/logs/backup-b1.log")
+        self.assertIs(popen, worker)
+        worker.stdin.write.assert_called_once_with(
+            "run-backup b1 /logs/backup-b1.log\n")
+        worker.stdin.close.assert_called_once_with()
+        self.assertEqual(len(pool._idle), 2)
+
+        # no workers are spawned once shut down
+        idle = list(pool._idle)
+        pool.shutdown()
+        for popen in idle:
+            popen.stdin.close.assert_called_once_with()
+        self.assertIsNone(pool.run_task("run-backup", "b2", "/logs/b2.log"))
+        self.assertEqual(pool._spawn_worker.call_count, 3)
+
+    ###########################################################################
+    def test_run_task_skips_exited_workers(self):
+        pool = self._new_pool(1)
+        pool.start()
+        pool._idle[0].poll.return_value = 1
+
+        popen = pool.run_task("run-restore", "r1", "/logs/restore-r1.log")
+        self.assertIs(popen, None)
+        self.assertEqual(len(pool._idle), 1)
+
+    ###########################################################################
+    def test_run_warm_task_worker(self):
+        task = Mock()
+        fake_sys = Mock(stdin=StringIO("run-backup b1 /logs/backup-b1.log\n"))
+        with patch.object(mbs.engine, "sys", fake_sys), \
+                patch.object(mbs.engine, "get_mbs"), \
+                patch.object(mbs.engine, "open", create=True) as open_mock, \
+                patch.object(mbs.engine.os, "dup2") as dup2_mock, \
+                patch.object(mbs.engine.persistence, "get_backup",
+                             return_value=task) as get_backup_mock, \
+                patch.object(mbs.engine, "TaskWorker") as task_worker_mock:
+            mbs.engine.run_warm_task_worker()
+
+        open_mock.assert_called_once_with("/logs/backup-b1.log", "a")
+        self.assertEqual(dup2_mock.call_count, 2)
+        get_backup_mock.assert_called_once_with("b1")
+        task_worker_mock.assert_called_once_with(task)
+        task_worker_mock.return_value.run.assert_called_once_with()
+
+    ###########################################################################
+    def test_run_warm_task_worker_pool_shutdown(self):
+        fake_sys = Mock(stdin=StringIO(""))
+        with patch.object(mbs.engine, "sys", fake_sys), \
+                patch.object(mbs.engine, "get_mbs"), \
+                patch.object(mbs.engine, "TaskWorker") as task_worker_mock:
+            mbs.engine.run_warm_task_worker()
+
+        self.assertFalse(task_worker_mock.called)
+
+
+###############################################################################
+# BackupEngineTest
+###############################################################################
+class BackupEngineTest(BaseTest):
+
+    ###########################################################################
+    def test_start_warm_worker_pool(self):
+        engine = mbs.engine.BackupEngine(id="test")
+        self.assertIsNone(engine.warm_worker_pool)
+
+        engine.warm_workers = 3
+        with patch.object(mbs.engine, "WarmWorkerPool") as pool_class, \
+                patch.object(engine, "get_task_worker_env_vars",
+                             create=True, return_value={}):
+            engine._start_warm_worker_pool()
+
+        pool_class.assert_called_once_with(3, env_vars={})
+        pool_class.return_value.start.assert_called_once_with()
+        self.assertIs(engine.warm_worker_pool, pool_class.return_value)
+
+
+###############################################################################
+# TaskQueueProcessorTest
+###############################################################################
+class TaskQueueProcessorTest(BaseTest):
+
+    ###########################################################################
+    def _new_processor(self, max_workers=10):
+        engine = Mock(engine_guid="engine-1", tags=None)
+        return mbs.engine.TaskQueueProcessor("Backups", "Backup", "backups",
+                                             engine, max_workers=max_workers,
+                                             sleep_time=25)
+
+    ###########################################################################
+    def test_start_next_tasks_fills_free_slots(self):
+        processor = self._new_processor(max_workers=3)
+        processor._workers = {"w0": Mock()}
+        tasks = [Mock(id="t%s" % i) for i in range(5)]
+        processor.read_next_task = Mock(side_effect=tasks)
+
+        def start_task(task):
+            processor._workers[task.id] = Mock()
+        processor._start_task = Mock(side_effect=start_task)
+
+        processor._start_next_tasks()
+        self.assertEqual(processor.worker_count, 3)
+        self.assertEqual(processor.read_next_task.call_count, 2)
+
+        # stops when there are no more tasks
+        processor._workers = {}
+        processor.read_next_task = Mock(side_effect=[tasks[2], None])
+        processor._start_next_tasks()
+        self.assertEqual(processor.worker_count, 1)
+
+    ###########################################################################
+    def test_read_next_task_starvation_sort(self):
+        processor = self._new_processor()
+        collection = processor._engine.get_task_collection_by_name.return_value
+        collection.find_and_modify.return_value = Mock()
+
+        for i in range(10):
+            processor.read_next_task()
+        # failed claims do not count
+        collection.find_and_modify.return_value = None
+        processor.read_next_task()
+
+        sorts = [kwargs["sort"] for args, kwargs in
+                 collection.find_and_modify.call_args_list]
+        created_date_sorts = [i for i, sort in enumerate(sorts)
+                              if sort == [("createdDate", 1)]]
+        self.assertEqual(created_date_sorts, [4, 9])
+        query = collection.find_and_modify.call_args[1]["query"]
+        self.assertEqual(query["engineGuid"], {"$in": ["engine-1", None]})
+
+    ###########################################################################
+    def test_failed_task_cleanup_by_elapsed_time(self):
+        processor = self._new_processor()
+        processor._monitor_workers = Mock()
+        processor._start_next_tasks = Mock()
+        processor._monitor_cancel_requests = Mock()
+        processor._clean_next_past_due_failed_task = Mock()
+
+        # extra ticks (e.g. wakeups) do not make the cleanup due
+        for i in range(100):
+            processor._tick()
+        self.assertFalse(processor._clean_next_past_due_failed_task.called)
+
+        processor._failed_task_cleanup_date -= timedelta(
+            seconds=mbs.engine.FAILED_TASK_CLEANUP_SLEEP_TIMES * 25)
+        processor._tick()
+        processor._tick()
+        self.assertEqual(
+            processor._clean_next_past_due_failed_task.call_count, 1)
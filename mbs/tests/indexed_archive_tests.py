@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+
+from mock import Mock
+
+import mbs.indexed_archive
+import mbs.target
+
+from . import BaseTest
+
+
+###############################################################################
+# IndexedArchiveTest
+###############################################################################
+class IndexedArchiveTest(BaseTest):
+
+    ###########################################################################
+    def test_extract_selected_members(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            dump_dir = os.path.join(work_dir, "dump")
+            for db in ["db1", "db2"]:
+                os.makedirs(os.path.join(dump_dir, db))
+                for coll in ["c1", "c2"]:
+                    for ext in ["bson", "metadata.json"]:
+                        with open(os.path.join(dump_dir, db, "%s.%s" %
+                                               (coll, ext)), "w") as f:
+                            f.write("%s.%s" % (db, coll) * 1000)
+            with open(os.path.join(dump_dir, "oplog.bson"), "w") as f:
+                f.write("oplog")
+            # pre-3.0 dumps have the indexes of all collections in one file
+            with open(os.path.join(dump_dir, "db1", "system.indexes.bson"),
+                      "w") as f:
+                f.write("indexes")
+
+            archive_path = os.path.join(work_dir, "dump.mbsa")
+            index = mbs.indexed_archive.create_indexed_archive(dump_dir,
+                                                               archive_path)
+            self.assertEqual(index, mbs.indexed_archive.read_archive_index(
+                archive_path))
+            self.assertEqual(
+                mbs.indexed_archive.index_database_names(index),
+                ["db1", "db2"])
+
+            # a target that serves ranges of the local archive
+            requested = []
+            local_read = mbs.indexed_archive._local_range_reader(archive_path)
+
+            def read_range(reference, offset, size, stream):
+                requested.append(size)
+                local_read(offset, size, stream)
+
+            target = Mock(supports_range_download=True,
+                          read_range=Mock(side_effect=read_range))
+            ref = mbs.indexed_archive.indexed_archive_reference(
+                mbs.target.FileReference(
+                    file_path="dump.mbsa",
+                    file_size=os.path.getsize(archive_path)), index)
+            self.assertEqual(ref.database_names, ["db1", "db2"])
+            # the footer locates the index when the reference does not
+            ref.index_offset = None
+
+            extract_dir = os.path.join(work_dir, "extract")
+            mbs.indexed_archive.extract_indexed_archive(
+                target, ref, extract_dir, database_names=["db1"],
+                collection_names=["c1"])
+
+            self.assertEqual(sorted(os.listdir(os.path.join(extract_dir,
+                                                            "dump"))),
+                             ["db1"])
+            self.assertEqual(sorted(os.listdir(os.path.join(extract_dir,
+                                                            "dump", "db1"))),
+                             ["c1.bson", "c1.metadata.json",
+                              "system.indexes.bson"])
+            with open(os.path.join(extract_dir, "dump", "db1",
+                                   "c1.bson")) as f:
+                self.assertEqual(f.read(), "db1.c1" * 1000)
+
+            # footer + index + one range for the two consecutive c1 members
+            # + one for system.indexes
+            self.assertEqual(len(requested), 4)
+            self.assertLess(sum(requested), os.path.getsize(archive_path))
+        finally:
+            shutil.rmtree(work_dir)
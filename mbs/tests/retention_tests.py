@@ -0,0 +1,92 @@
+from mock import Mock, patch
+
+import mbs.retention.sweeper
+
+from mbs.backup import Backup
+from mbs.dedup import CHUNK_CODECS, dedup_manifest_path
+from mbs.globals import State
+from mbs.retention.expiration_manager import \
+    exclude_incremental_chain_dependencies
+
+from . import BaseTest
+
+
+###############################################################################
+# RetentionTest
+###############################################################################
+class RetentionTest(BaseTest):
+
+    ###########################################################################
+    def test_exclude_incremental_chain_dependencies(self):
+        # base1 <- inc1 <- inc2, base2 <- inc3
+        base1 = _chain_backup("base1", None)
+        inc1 = _chain_backup("inc1", "base1")
+        inc2 = _chain_backup("inc2", "inc1")
+        base2 = _chain_backup("base2", None)
+        inc3 = _chain_backup("inc3", "base2")
+        full = Backup()
+        full.id = "full"
+        plan_backups = [inc3, base2, inc2, inc1, base1, full]
+
+        # inc2 is retained so its whole chain is retained
+        dues = exclude_incremental_chain_dependencies(
+            plan_backups, [inc2, inc1, base1, full])
+        self.assertEqual(dues, [inc2, inc1, base1, full])
+        dues = exclude_incremental_chain_dependencies(
+            plan_backups, [inc1, base1, full])
+        self.assertEqual(dues, [full])
+        dues = exclude_incremental_chain_dependencies(
+            plan_backups, [base2, inc1, base1])
+        self.assertEqual(dues, [])
+
+    ###########################################################################
+    def test_get_dedup_stores(self):
+        dedup_target = {"_type": "S3BucketTarget", "bucketName": "chunks",
+                        "dedup": True}
+        plain_target = {"_type": "S3BucketTarget", "bucketName": "plain"}
+        collection = Mock()
+        collection.distinct.side_effect = lambda field, q: {
+            "target": [dedup_target],
+            "secondaryTargets": [dedup_target, plain_target]
+        }[field]
+        collection.find.return_value = [{
+            "name": "plan/b1",
+            "targetReference": {"filePath": "plan/b1.manifest.json"},
+            "secondaryTargetReferences": [{"filePath": "plan/b1.copy.json"}]
+        }]
+        mbs_mock = Mock()
+        mbs_mock.backup_collection.collection = collection
+        mbs_mock.maker.make.side_effect = lambda doc: Mock(
+            target_type="S3BucketTarget", container_name=doc["bucketName"])
+
+        sweeper = mbs.retention.sweeper.BackupSweeper()
+        with patch.object(mbs.retention.sweeper, "get_mbs",
+                          return_value=mbs_mock), \
+                patch.object(sweeper, "_get_dedup_workspace",
+                             return_value="/tmp/dedup"):
+            stores, live_manifest_paths = sweeper._get_dedup_stores()
+
+        # one store per codec of the distinct dedup target
+        self.assertEqual(len(stores), len(CHUNK_CODECS))
+        self.assertEqual(set(store.store_key for store in stores),
+                         set(["S3BucketTarget/chunks"]))
+        self.assertEqual(mbs_mock.maker.make.call_count, 2)
+
+        # only backups that are not deleted or canceled keep manifests alive
+        q = collection.find.call_args[0][0]
+        self.assertEqual(q["deletedDate"], None)
+        self.assertEqual(q["state"], {"$ne": State.CANCELED})
+        self.assertEqual(live_manifest_paths,
+                         set(["plan/b1.manifest.json", "plan/b1.copy.json",
+                              dedup_manifest_path("plan/b1")]))
+
+###############################################################################
+def _chain_backup(backup_id, previous_backup_id):
+    backup = Backup()
+    backup.id = backup_id
+    backup.data_stats = {
+        "oplogIncremental": {
+            "previousBackupId": previous_backup_id
+        }
+    }
+    return backup
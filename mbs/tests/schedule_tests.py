@@ -1,5 +1,9 @@
+import time
+
 from datetime import datetime, timedelta
 
+from croniter import croniter
+
 import mbs.schedule as schedule
 
 from mbs.date_utils import epoch_date
@@ -110,3 +114,168 @@ class CronScheduleTest(BaseTest):
             cron_sched._max_acceptable_lag_for_period(timedelta(1)),
             cron_sched.max_acceptable_lag(datetime(2012, 10, 8, 3)))
 
+
+    ###########################################################################
+    def test_spread(self):
+        cron_sched = self.mbs.maker.make({'_type': 'CronSchedule',
+                                          'expression': '0 0 * * *'})
+        sched = self.mbs.maker.make({'_type': 'Schedule',
+                                     'frequency_in_seconds': 24 * 60 * 60})
+
+        offset = schedule.spread_offset("plan1", 3600)
+        self.assertEqual(offset, schedule.spread_offset("plan1", 3600))
+        self.assertTrue(0 <= offset < 3600)
+
+        for s in [cron_sched, sched]:
+            s.spread_seconds = 120
+            self.assertEqual(s.next_natural_occurrence(datetime(2012, 10, 1)),
+                             datetime(2012, 10, 1, 0, 2))
+            self.assertEqual(
+                s.last_natural_occurrence(datetime(2012, 10, 1, 0, 1)),
+                datetime(2012, 9, 30, 0, 2))
+            self.assertEqual(
+                s.natural_occurrences_between(datetime(2012, 10, 1),
+                                              datetime(2012, 10, 3)),
+                [datetime(2012, 10, 1, 0, 2),
+                 datetime(2012, 10, 2, 0, 2)])
+            self.assertEqual(
+                s.max_acceptable_lag(datetime(2012, 10, 1, 0, 2)),
+                s._max_acceptable_lag_for_period(timedelta(1)))
+
+    ###########################################################################
+    def test_occurrence_cache(self):
+        expression = '0 2 * * 1,2'
+        dt = datetime(2012, 10, 8, 2)
+        self.assertTrue(schedule.cron_is_occurrence(expression, dt))
+        self.assertEqual(schedule.cron_next_occurrence(expression, dt),
+                         croniter(expression, dt).get_next(datetime))
+        self.assertEqual(schedule.cron_previous_occurrence(expression, dt),
+                         croniter(expression, dt).get_prev(datetime))
+
+        # spans days without occurrences
+        self.assertEqual(
+            schedule.cron_occurrences_between(expression, datetime(2012, 10, 1),
+                                              datetime(2012, 10, 16)),
+            [datetime(2012, 10, 1, 2), datetime(2012, 10, 2, 2),
+             datetime(2012, 10, 8, 2), datetime(2012, 10, 9, 2),
+             datetime(2012, 10, 15, 2)])
+
+    ###########################################################################
+    def test_occurrence_cache_bounds(self):
+        # dense expressions are cached in smaller windows
+        self.assertEqual(
+            schedule._parsed_cron_expression('* * * * *').window_seconds,
+            24 * 60 * 60)
+        self.assertEqual(
+            schedule._parsed_cron_expression('* * * * * *').window_seconds, 60)
+        self.assertIs(schedule._parsed_cron_expression('* * * * * *'),
+                      schedule._parsed_cron_expression('* * * * * *'))
+
+        dt = datetime(2012, 10, 1, 3, 5, 2)
+        self.assertEqual(schedule.cron_next_occurrence('* * * * * *', dt),
+                         datetime(2012, 10, 1, 3, 5, 3))
+        self.assertEqual(
+            len(schedule.cron_occurrences_between('* * * * * *', dt,
+                                                  dt + timedelta(minutes=3))),
+            180)
+
+        # least recently used windows are evicted by occurrence count
+        cache = schedule.CronWindowCache(20)
+        for key in ["a", "b", "c"]:
+            cache.put(key, (None, (1, 2, 3), None))
+        self.assertEqual(cache.size, 15)
+        cache.get("a")
+        cache.put("d", (None, tuple(range(6)), None))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNone(cache.get("c"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertEqual(cache.size, 13)
+        # windows larger than the cache are not cached
+        cache.put("e", (None, tuple(range(30)), None))
+        self.assertIsNone(cache.get("e"))
+        self.assertEqual(cache.size, 13)
+
+    ###########################################################################
+    def test_occurrence_cache_benchmark(self):
+        """ Audit like workload on 10k plans sharing a few expressions, with
+        and without the occurrence cache. Set MBS_RUN_BENCHMARKS to run
+
+        """
+        self._get_env_var_or_skip('MBS_RUN_BENCHMARKS')
+
+        expressions = ['0 0 * * *', '0 */6 * * *', '0 2 * * 1,2',
+                       '30 3 1 * *', '0 * * * *']
+        plans = []
+        for i in range(10000):
+            plans.append(self.mbs.maker.make({
+                '_type': 'CronSchedule',
+                'expression': expressions[i % len(expressions)]}))
+
+        def audit(clear_cache):
+            audit_date = datetime(2012, 10, 8)
+            start = time.time()
+            for plan in plans:
+                if clear_cache:
+                    schedule._cron_window_cache.clear()
+                plan.natural_occurrences_as_of(audit_date)
+                plan.max_acceptable_lag(audit_date)
+                plan.last_natural_occurrence(audit_date)
+            return time.time() - start
+
+        uncached = audit(True)
+        cached = audit(False)
+        print ("CronSchedule occurrences of %s plans: %.2fs uncached, %.2fs "
+               "cached (%.1fx)" % (len(plans), uncached, cached,
+                                   uncached / cached))
+        self.assertLess(cached, uncached)
+
+
+###############################################################################
+# ScheduleTest
+###############################################################################
+class ScheduleTest(BaseTest):
+
+    ###########################################################################
+    def test_occurrence_range(self):
+        sched = self.mbs.maker.make({'_type': 'Schedule',
+                                     'frequency_in_seconds': 300})
+
+        # a year of 5 minute occurrences
+        occurrences = sched.natural_occurrences_between(
+            datetime(2012, 1, 1, 0, 1), datetime(2013, 1, 1))
+        self.assertIsInstance(occurrences, schedule.OccurrenceRange)
+        self.assertEqual(len(occurrences), 366 * 288 - 1)
+        self.assertEqual(occurrences[0], datetime(2012, 1, 1, 0, 5))
+        self.assertEqual(occurrences[-1], datetime(2012, 12, 31, 23, 55))
+        self.assertIn(datetime(2012, 6, 1, 12, 10), occurrences)
+        self.assertNotIn(datetime(2012, 6, 1, 12, 11), occurrences)
+        self.assertEqual(occurrences.index(datetime(2012, 1, 1, 0, 15)), 2)
+        self.assertEqual(list(occurrences[1:4]),
+                         [datetime(2012, 1, 1, 0, 10),
+                          datetime(2012, 1, 1, 0, 15),
+                          datetime(2012, 1, 1, 0, 20)])
+
+        # the occurrence a backup created at some date belongs to
+        self.assertEqual(occurrences.occurrence_of(datetime(2012, 6, 1, 12, 13)),
+                         datetime(2012, 6, 1, 12, 10))
+        self.assertEqual(occurrences.bisect_left(datetime(2012, 1, 1, 0, 10)),
+                         1)
+        self.assertEqual(occurrences.bisect_right(datetime(2012, 1, 1, 0, 10)),
+                         2)
+
+        self.assertEqual(sched.last_n_occurrences(3, dt=datetime(2012, 1, 1,
+                                                                 0, 12)),
+                         [datetime(2012, 1, 1, 0, 10),
+                          datetime(2012, 1, 1, 0, 5),
+                          datetime(2012, 1, 1)])
+
+        composite = schedule.CompositeSchedule(
+            schedules=[sched, Schedule(frequency_in_seconds=120)])
+        occurrences = composite.natural_occurrences_between(
+            datetime(2012, 1, 1), datetime(2012, 1, 1, 0, 11))
+        self.assertEqual(list(occurrences),
+                         [datetime(2012, 1, 1, 0, m)
+                          for m in [0, 2, 4, 5, 6, 8, 10]])
+        self.assertIn(datetime(2012, 1, 1, 0, 5), occurrences)
+        self.assertEqual(occurrences.occurrence_of(datetime(2012, 1, 1, 0, 7)),
+                         datetime(2012, 1, 1, 0, 6))
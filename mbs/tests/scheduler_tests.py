@@ -0,0 +1,103 @@
+from datetime import datetime
+
+from mock import Mock, PropertyMock, patch
+
+import mbs.mbs
+import mbs.scheduler
+
+from . import BaseTest
+
+
+###############################################################################
+# PlanTimelineTest
+###############################################################################
+class PlanTimelineTest(BaseTest):
+
+    ###########################################################################
+    def test_pop_due(self):
+        timeline = mbs.scheduler.PlanTimeline()
+        timeline.set("p1", datetime(2020, 1, 1, 10))
+        timeline.set("p2", datetime(2020, 1, 1, 9), priority=5)
+        timeline.set("p3", datetime(2020, 1, 1, 9), priority=1)
+        # not scheduled yet => due right away
+        timeline.set("p4", None)
+        timeline.set("p5", datetime(2020, 1, 1, 8))
+
+        # rescheduled and removed plans leave stale entries behind
+        timeline.set("p1", datetime(2020, 1, 1, 12))
+        timeline.remove("p5")
+
+        self.assertEqual(len(timeline), 4)
+        self.assertEqual(timeline.pop_due(datetime(2020, 1, 1, 11)),
+                         ["p4", "p3", "p2"])
+        self.assertEqual(timeline.pop_due(datetime(2020, 1, 1, 11)), [])
+        self.assertEqual(timeline.next_occurrence(),
+                         datetime(2020, 1, 1, 12))
+        self.assertEqual(timeline.pop_due(datetime(2020, 1, 1, 12), limit=1),
+                         ["p1"])
+        self.assertEqual(len(timeline), 0)
+
+
+###############################################################################
+# BackupSchedulerTest
+###############################################################################
+class BackupSchedulerTest(BaseTest):
+
+    ###########################################################################
+    def test_dispatch_due_plans_in_batch(self):
+        plans = [Mock(id="p%s" % i, next_occurrence=datetime(2020, 1, 1),
+                      priority=None, validate=Mock(return_value=None))
+                 for i in range(3)]
+        backup_system = Mock()
+        backup_system.schedule_plan_backups.return_value = (
+            [Mock(), Mock()], [(plans[1], Exception("insert failed"))])
+
+        scheduler = mbs.scheduler.BackupScheduler(backup_system)
+        scheduler._dispatch_plans(plans)
+
+        backup_system.schedule_plan_backups.assert_called_once_with(plans)
+        # failed plans are retried later
+        self.assertEqual(len(scheduler.plan_timeline), 1)
+        self.assertTrue("p1" in scheduler.plan_timeline)
+
+    ###########################################################################
+    def test_failed_plan_waits_for_retry_date(self):
+        plan = Mock(id="p1", next_occurrence=datetime(2020, 1, 1),
+                    priority=None)
+        scheduler = mbs.scheduler.BackupScheduler(Mock())
+        scheduler._plan_failed(plan)
+
+        plan_collection = Mock()
+        plan_collection.collection.find.return_value = [
+            {"_id": "p1", "nextOccurrence": datetime(2020, 1, 1)}]
+        with patch.object(mbs.mbs.MBS, "plan_collection",
+                          new_callable=PropertyMock) as plan_collection_prop:
+            plan_collection_prop.return_value = plan_collection
+            # still due in the collection but not picked up before its retry
+            scheduler._sync_due_plans()
+            self.assertEqual(scheduler.plan_timeline.pop_due(datetime.utcnow()), [])
+
+            scheduler._plan_retry_dates["p1"] = datetime(2000, 1, 1)
+            scheduler._sync_due_plans()
+            self.assertEqual(scheduler.plan_timeline.pop_due(datetime.utcnow()), ["p1"])
+
+    ###########################################################################
+    def test_projected_plan_load_curve(self):
+        plan_collection = Mock()
+        plan_collection.collection.aggregate.return_value = [
+            {"_id": datetime(2020, 1, 1, 10, 0), "count": 30},
+            {"_id": datetime(2020, 1, 1, 10, 1), "count": 120}]
+
+        with patch.object(mbs.mbs.MBS, "plan_collection",
+                          new_callable=PropertyMock) as plan_collection_prop, \
+                patch.object(mbs.mbs.MBS, "plan_capacity_per_minute",
+                             new_callable=PropertyMock) as capacity_prop:
+            plan_collection_prop.return_value = plan_collection
+            capacity_prop.return_value = 40
+
+            load_curve = mbs.scheduler.projected_plan_load_curve()
+
+        self.assertEqual(load_curve["peak"], 120)
+        self.assertEqual(load_curve["peakMinute"], datetime(2020, 1, 1, 10, 1))
+        self.assertEqual(load_curve["recommendedSpreadWindowInSeconds"], 180)
+        self.assertEqual(len(load_curve["curve"]), 2)
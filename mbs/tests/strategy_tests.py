@@ -0,0 +1,137 @@
+from mock import Mock, patch
+
+import mbs.strategy
+
+from mbs.errors import DumpError
+from mbs.mongo_uri_tools import parse_mongo_uri
+
+from . import BaseTest
+
+
+###############################################################################
+# StrategyTest
+###############################################################################
+class StrategyTest(BaseTest):
+
+    ###########################################################################
+    def test_choose_num_parallel_collections(self):
+        mb = 1024 * 1024
+        choose = mbs.strategy.choose_num_parallel_collections
+
+        self.assertEqual(choose([]), 1)
+        # small collections do not need parallel workers
+        self.assertEqual(choose([mb] * 100, num_cores=16), 1)
+        # one per sizable collection, capped by the destination cores
+        self.assertEqual(choose([100 * mb] * 3, num_cores=16), 3)
+        self.assertEqual(choose([100 * mb] * 20, num_cores=4), 4)
+        self.assertEqual(choose([100 * mb] * 20, num_cores=64),
+                         mbs.strategy.MAX_PARALLEL_COLLECTIONS)
+        # a dominant collection bounds the restore time anyway
+        self.assertEqual(choose([10000 * mb, 100 * mb, 100 * mb],
+                                num_cores=16), 2)
+        # unknown destination hardware
+        self.assertEqual(choose([100 * mb] * 20),
+                         mbs.strategy.DEFAULT_DESTINATION_CORES)
+
+    ###########################################################################
+    def test_stream_dump_keeps_dump_dir_until_upload_is_recorded(self):
+        strategy = mbs.strategy.DumpStrategy()
+        steps = Mock()
+        strategy.backup_assistant = steps.backup_assistant
+        steps.backup_assistant.stream_backup.return_value = ["reference"]
+        backup = Mock(name="backup", upload_ledgers=None)
+        backup.name = "plan/backup-1"
+
+        with patch.object(mbs.strategy, "update_backup"), \
+                patch.object(mbs.strategy, "_backup_all_targets",
+                             return_value=[Mock()]), \
+                patch.object(strategy, "_set_upload_target_references",
+                             steps.set_upload_target_references):
+            strategy._stream_dump(backup)
+
+        self.assertEqual(
+            [name for name, args, kwargs in steps.mock_calls],
+            ["backup_assistant.stream_backup",
+             "set_upload_target_references",
+             "backup_assistant.delete_dump_dir"])
+        steps.backup_assistant.delete_dump_dir.assert_called_once_with(
+            backup, "backup-1")
+
+    ###########################################################################
+    def _parallel_dump_strategy(self, dump_backup):
+        strategy = mbs.strategy.DumpStrategy()
+        strategy.parallel_dump_workers = 2
+        strategy.backup_assistant = Mock()
+        strategy.backup_assistant.dump_backup.side_effect = dump_backup
+        mongo_connector = Mock()
+        mongo_connector.admin_db.command.return_value = {"databases": [
+            {"name": "small", "sizeOnDisk": 10},
+            {"name": "local", "sizeOnDisk": 1000},
+            {"name": "big", "sizeOnDisk": 100},
+            {"name": "empty"}
+        ]}
+        return strategy, mongo_connector
+
+    ###########################################################################
+    def test_should_parallel_dump(self):
+        strategy = mbs.strategy.DumpStrategy()
+        server_uri = parse_mongo_uri("mongodb://host:27017")
+        database_uri = parse_mongo_uri("mongodb://host:27017/db")
+
+        self.assertFalse(strategy._should_parallel_dump(server_uri, []))
+        strategy.parallel_dump_workers = 4
+        self.assertTrue(strategy._should_parallel_dump(server_uri, []))
+        # only server level dumps are split
+        self.assertFalse(strategy._should_parallel_dump(database_uri, []))
+        # replica members need --oplog unless told to do without
+        self.assertFalse(strategy._should_parallel_dump(server_uri,
+                                                        ["--oplog"]))
+        strategy.parallel_dump_without_oplog = True
+        self.assertTrue(strategy._should_parallel_dump(server_uri,
+                                                       ["--oplog"]))
+
+    ###########################################################################
+    def test_parallel_dump_backup(self):
+        def dump_backup(backup, uri, destination, log_file_name, options=None):
+            database_name = uri.rsplit("/", 1)[1]
+            return {"dumpCollectionCounts": {database_name: [["c1", 1]]}}
+
+        strategy, mongo_connector = self._parallel_dump_strategy(dump_backup)
+        backup = Mock(id="b1")
+        dump_info = strategy._parallel_dump_backup(
+            backup, mongo_connector, "mongodb://host:27017", "dump-dir",
+            "dump.log", ["--oplog", "--authenticationDatabase", "admin"])
+
+        # one dump per database (except local), without --oplog
+        calls = strategy.backup_assistant.dump_backup.call_args_list
+        self.assertEqual(
+            sorted((args[1], args[3]) for args, kwargs in calls),
+            [("mongodb://host:27017/big", "dump.log.big"),
+             ("mongodb://host:27017/empty", "dump.log.empty"),
+             ("mongodb://host:27017/small", "dump.log.small")])
+        for args, kwargs in calls:
+            self.assertEqual(args[2], "dump-dir")
+            self.assertEqual(kwargs["options"],
+                             ["--authenticationDatabase", "admin"])
+
+        # largest databases first
+        strategy.backup_assistant.merge_dump_log_files.assert_called_once_with(
+            backup, "dump-dir", ["dump.log.big", "dump.log.small",
+                                 "dump.log.empty"], "dump.log")
+        self.assertEqual(dump_info, {"dumpCollectionCounts": {
+            "big": [["c1", 1]], "small": [["c1", 1]], "empty": [["c1", 1]]}})
+
+    ###########################################################################
+    def test_parallel_dump_backup_worker_failure(self):
+        def dump_backup(backup, uri, destination, log_file_name, options=None):
+            if uri.endswith("/big"):
+                raise DumpError(return_code=1)
+
+        strategy, mongo_connector = self._parallel_dump_strategy(dump_backup)
+        self.assertRaises(DumpError,
+                          strategy._parallel_dump_backup, Mock(id="b1"),
+                          mongo_connector, "mongodb://host:27017/",
+                          "dump-dir", "dump.log", [])
+        # the logs of the dumps that ran are still merged
+        self.assertTrue(
+            strategy.backup_assistant.merge_dump_log_files.called)
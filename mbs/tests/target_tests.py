@@ -1,10 +1,14 @@
 import hashlib
 import math
+import os
 
+from cStringIO import StringIO
 from tempfile import NamedTemporaryFile
 
 from mock import patch, Mock
 
+import mbs.checksum
+import mbs.errors
 import mbs.target
 
 from . import BaseTest
@@ -19,25 +23,339 @@ class TargetTest(BaseTest):
     ###########################################################################
     def test_multi_part_put(self):
         hash_ = hashlib.md5()
+        # parts are uploaded concurrently so collect them by part number
+        parts = {}
         mp_upload_mock = Mock(**{'upload_part_from_file.side_effect':
-                                 lambda data, i: hash_.update(data.read()),
+                                 lambda data, i: parts.update({i: data.read()}),
                                  'complete_upload': Mock()})
         with NamedTemporaryFile() as dump, \
              open('/dev/urandom', 'rb') as random_data, \
              patch.object(mbs.target, 'MAX_SPLIT_SIZE', 1024), \
+             patch.object(mbs.target, 'S3_MULTIPART_LIMITS',
+                          mbs.target.MultipartLimits(1, 1024, 10000)), \
              patch.object(mbs.target.S3BucketTarget,
                           '_get_bucket',
                           Mock(return_value=Mock(
                                 **{'initiate_multipart_upload.return_value':
                                    mp_upload_mock}))):
             dump.write(random_data.read(10000))
+            dump.flush()
             target = self.mbs.maker.make({'_type': 'S3BucketTarget'})
-            target._multi_part_put(dump.name, 'com.foo.bar', 10000)
+            upload_plan, _ = target._multi_part_put(dump.name, 'com.foo.bar',
+                                                    10000)
 
             self.assertEqual(mp_upload_mock.upload_part_from_file.call_count,
-                             math.ceil(10000/1024))
+                             math.ceil(10000/1024.0))
             self.assertTrue(mp_upload_mock.complete_upload.called)
+            for i in sorted(parts):
+                hash_.update(parts[i])
             self.assertEqual(hash_.hexdigest(), md5(dump.name))
+            self.assertEqual(upload_plan["partCount"], 10)
+            self.assertEqual(upload_plan["initialPartSize"], 1000)
+
+    ###########################################################################
+    def test_resume_multi_part_put(self):
+        parts = {}
+
+        def upload_part(data, i):
+            parts[i] = data.read()
+            return Mock(etag='"etag%s"' % i)
+
+        # parts 1 and 2 survived the crash, part 3 did not finish
+        mp_upload_mock = Mock(**{'upload_part_from_file.side_effect':
+                                 upload_part,
+                                 '__iter__': Mock(return_value=iter([
+                                     Mock(part_number=1, etag='"etag1"'),
+                                     Mock(part_number=2, etag='"etag2"')]))})
+        bucket_mock = Mock()
+        ledger = mbs.target.UploadLedger(target_index=0)
+        ledger.start("upload1", "com.foo.bar", 10000)
+        ledger.part_completed(1, 0, 1000, '"etag1"')
+        ledger.part_completed(2, 1000, 1000, '"etag2"')
+        ledger.part_completed(3, 2000, 1000, '"etag3"')
+        changes = []
+        ledger.on_change = changes.append
+
+        with NamedTemporaryFile() as dump, \
+             patch.object(mbs.target, 'MAX_SPLIT_SIZE', 1024), \
+             patch.object(mbs.target, 'S3_MULTIPART_LIMITS',
+                          mbs.target.MultipartLimits(1, 1024, 10000)), \
+             patch.object(mbs.target, 'MultiPartUpload',
+                          Mock(return_value=mp_upload_mock)), \
+             patch.object(mbs.target.S3BucketTarget, '_get_bucket',
+                          Mock(return_value=bucket_mock)):
+            dump.write("x" * 10000)
+            dump.flush()
+            target = self.mbs.maker.make({'_type': 'S3BucketTarget'})
+            target._multi_part_put(dump.name, 'com.foo.bar', 10000,
+                                   upload_ledger=ledger)
+
+            self.assertFalse(bucket_mock.initiate_multipart_upload.called)
+            self.assertEqual(sorted(parts), range(3, 11))
+            self.assertEqual(len(parts[3]), 1000)
+            self.assertEqual([p["partNumber"] for p in ledger.parts],
+                             range(1, 11))
+            self.assertEqual(len(changes), 1 + 8)
+            xml = bucket_mock.complete_multipart_upload.call_args[0][2]
+            self.assertEqual(xml.count("<Part>"), 10)
+
+    ###########################################################################
+    def test_multi_part_put_cancels_stale_upload(self):
+        mp_upload_mock = Mock(id="upload2", **{
+            'upload_part_from_file.side_effect':
+                lambda data, i: Mock(etag='"etag%s"' % i)})
+        bucket_mock = Mock(**{'initiate_multipart_upload.return_value':
+                              mp_upload_mock})
+        # the ledger is of an upload of a previous (bigger) tar
+        ledger = mbs.target.UploadLedger(target_index=0)
+        ledger.start("upload1", "com.foo.bar", 20000)
+
+        with NamedTemporaryFile() as dump, \
+             patch.object(mbs.target, 'MAX_SPLIT_SIZE', 1024), \
+             patch.object(mbs.target, 'S3_MULTIPART_LIMITS',
+                          mbs.target.MultipartLimits(1, 1024, 10000)), \
+             patch.object(mbs.target.S3BucketTarget, '_get_bucket',
+                          Mock(return_value=bucket_mock)):
+            dump.write("x" * 10000)
+            dump.flush()
+            target = self.mbs.maker.make({'_type': 'S3BucketTarget'})
+            target._multi_part_put(dump.name, 'com.foo.bar', 10000,
+                                   upload_ledger=ledger)
+
+        bucket_mock.cancel_multipart_upload.assert_called_once_with(
+            "com.foo.bar", "upload1")
+        self.assertEqual(ledger.upload_id, "upload2")
+
+    ###########################################################################
+    def test_multi_part_put_checksum(self):
+        part_etags = {}
+
+        def upload_part(data, i):
+            part_etags[i] = '"%s"' % hashlib.md5(data.read()).hexdigest()
+            return Mock(etag=part_etags[i])
+
+        def complete_upload():
+            return Mock(etag=mbs.target.s3_multipart_etag(
+                [part_etags[i] for i in sorted(part_etags)]))
+
+        mp_upload_mock = Mock(**{'upload_part_from_file.side_effect':
+                                 upload_part,
+                                 'complete_upload.side_effect':
+                                 complete_upload})
+        with NamedTemporaryFile() as dump, \
+             open('/dev/urandom', 'rb') as random_data, \
+             patch.object(mbs.target, 'MAX_SPLIT_SIZE', 1024), \
+             patch.object(mbs.target, 'S3_MULTIPART_LIMITS',
+                          mbs.target.MultipartLimits(1, 1024, 10000)), \
+             patch.object(mbs.target.S3BucketTarget,
+                          '_get_bucket',
+                          Mock(return_value=Mock(
+                                **{'initiate_multipart_upload.return_value':
+                                   mp_upload_mock}))):
+            dump.write(random_data.read(10000))
+            dump.flush()
+            target = self.mbs.maker.make({'_type': 'S3BucketTarget'})
+
+            # parts uploaded concurrently are hashed in file order
+            checksum = mbs.checksum.FileChecksum()
+            target._multi_part_put(dump.name, 'com.foo.bar', 10000,
+                                   checksum=checksum)
+            self.assertEqual(checksum.md5, md5(dump.name))
+            self.assertEqual(checksum.sha256, hashlib.sha256(
+                open(dump.name, 'rb').read()).hexdigest())
+            self.assertEqual(checksum.etag, complete_upload().etag)
+
+            # an upload that does not match its parts is rejected
+            mp_upload_mock.complete_upload.side_effect = None
+            mp_upload_mock.complete_upload.return_value = Mock(
+                etag='"%s-10"' % ("0" * 32))
+            self.assertRaises(mbs.errors.UploadedFileChecksumMismatchError,
+                              target._multi_part_put, dump.name,
+                              'com.foo.bar', 10000,
+                              checksum=mbs.checksum.FileChecksum())
+
+            # etags of SSE-KMS uploads are not md5s so they are not verified
+            mp_upload_mock.complete_upload.return_value = Mock(
+                etag='"%s-10"' % ("0" * 32), encrypted="aws:kms")
+            kms_checksum = mbs.checksum.FileChecksum()
+            upload_plan, encryption = target._multi_part_put(
+                dump.name, 'com.foo.bar', 10000, checksum=kms_checksum)
+            self.assertEqual(encryption, "aws:kms")
+            self.assertIsNone(kms_checksum.etag)
+
+            # downloads are verified against the checksums of the upload
+            ref = mbs.target.FileReference(file_path='com.foo.bar',
+                                           md5=checksum.md5,
+                                           sha256=checksum.sha256)
+            writer = mbs.checksum.ChecksumWriter(StringIO())
+            writer.write(open(dump.name, 'rb').read())
+            writer.checksum.verify(ref)
+            writer.write("x")
+            self.assertRaises(mbs.errors.DownloadedFileChecksumMismatchError,
+                              writer.checksum.verify, ref)
+
+    ###########################################################################
+    def test_ranged_get_file(self):
+        class RangedKey(object):
+            """
+                Serves Range requests of the source file
+            """
+            def __init__(self, bucket, name):
+                pass
+
+            def get_contents_to_file(self, fp, headers=None, **kwargs):
+                start, end = map(int, headers["Range"][6:].split("-"))
+                with open(source.name, 'rb') as source_obj:
+                    source_obj.seek(start)
+                    fp.write(source_obj.read(end - start + 1))
+
+        with NamedTemporaryFile() as source, \
+             NamedTemporaryFile() as destination, \
+             open('/dev/urandom', 'rb') as random_data, \
+             patch.object(mbs.target, 'RANGED_DOWNLOAD_MIN_SIZE', 1), \
+             patch.object(mbs.target, 'RANGED_DOWNLOAD_LIMITS',
+                          mbs.target.MultipartLimits(1, 1024, 10000)), \
+             patch.object(mbs.target, 'Key', RangedKey), \
+             patch.object(mbs.target.S3BucketTarget, '_get_bucket',
+                          Mock(return_value=Mock(**{'get_key.return_value':
+                                                    Mock(size=10000)}))):
+            source.write(random_data.read(10000))
+            source.flush()
+            target = self.mbs.maker.make({'_type': 'S3BucketTarget'})
+            ref = mbs.target.FileReference(
+                file_path=os.path.basename(destination.name),
+                md5=md5(source.name))
+
+            target.get_file(ref, os.path.dirname(destination.name),
+                            concurrency=4)
+            self.assertEqual(open(destination.name, 'rb').read(),
+                             open(source.name, 'rb').read())
+
+            # corrupted downloads are rejected
+            ref.md5 = "0" * 32
+            self.assertRaises(mbs.errors.TargetError, target.get_file, ref,
+                              os.path.dirname(destination.name),
+                              concurrency=4)
+
+    ###########################################################################
+    def test_multi_target_upload_stream(self):
+        hashes = [hashlib.md5(), hashlib.md5()]
+
+        def make_bucket(hash_):
+            part_etags = []
+
+            def upload_part(data, i):
+                data = data.read()
+                hash_.update(data)
+                part_etags.append(hashlib.md5(data).hexdigest())
+                return Mock(etag='"%s"' % part_etags[-1])
+
+            def complete_upload():
+                return Mock(etag=mbs.target.s3_multipart_etag(part_etags),
+                            encrypted=None)
+
+            mp_upload_mock = Mock(**{'upload_part_from_file.side_effect':
+                                     upload_part,
+                                     'complete_upload.side_effect':
+                                     complete_upload})
+            return Mock(**{'initiate_multipart_upload.return_value':
+                           mp_upload_mock})
+
+        with NamedTemporaryFile() as dump, \
+             open('/dev/urandom', 'rb') as random_data:
+            dump.write(random_data.read(10000))
+            dump.flush()
+
+            targets = []
+            for hash_ in hashes:
+                target = self.mbs.maker.make({'_type': 'S3BucketTarget'})
+                target._get_bucket = Mock(return_value=make_bucket(hash_))
+                target._fetch_file_info = Mock(return_value={
+                    'size': 10000, 'cloud_storage_encryption': None})
+                targets.append(target)
+
+            with open(dump.name, 'rb') as stream:
+                refs = mbs.target.multi_target_upload_stream(
+                    targets, stream, 'com.foo.bar', part_size=1024)
+
+            self.assertEqual(len(refs), 2)
+            for target, ref, hash_ in zip(targets, refs, hashes):
+                mp = target._get_bucket().initiate_multipart_upload()
+                self.assertEqual(mp.upload_part_from_file.call_count,
+                                 math.ceil(10000/1024.0))
+                self.assertTrue(mp.complete_upload.called)
+                self.assertEqual(ref.file_size, 10000)
+                self.assertEqual(ref.md5, md5(dump.name))
+                self.assertEqual(hash_.hexdigest(), md5(dump.name))
+
+    ###########################################################################
+    def test_multi_target_fan_out_upload(self):
+        received = [{}, {}]
+
+        def make_target(i, fail_part=None):
+            def upload_part(data, part_num=None):
+                if part_num == fail_part:
+                    raise Exception("part upload failed")
+                received[i][part_num] = data
+                return "etag%s" % part_num
+
+            stream_upload = Mock(**{
+                'upload_part.side_effect': upload_part,
+                'complete.return_value': Mock()})
+            return Mock(supports_stream_upload=True, upload_concurrency=2,
+                        **{'open_stream_upload.return_value': stream_upload,
+                           'put_file.return_value': "retried"})
+
+        targets = [make_target(0), make_target(1, fail_part=3)]
+        with NamedTemporaryFile() as dump, \
+             patch.object(mbs.target, 'MULTIPART_MIN_SIZE', 1), \
+             patch.object(mbs.target, 'MAX_SPLIT_SIZE', 1024), \
+             patch.object(mbs.target, 'S3_MULTIPART_LIMITS',
+                          mbs.target.MultipartLimits(1, 1024, 10000)):
+            dump.write("".join(chr(i % 256) for i in range(10000)))
+            dump.flush()
+            uploaders = mbs.target.multi_target_upload_file(
+                targets, dump.name, destination_path="com.foo.bar")
+
+            self.assertEqual("".join(received[0][i]
+                                     for i in sorted(received[0])),
+                             open(dump.name).read())
+            self.assertIsNone(uploaders[0].error)
+            self.assertFalse(targets[0].put_file.called)
+            # the failed target does not fail the others and is retried
+            self.assertIsNone(uploaders[1].error)
+            self.assertEqual(uploaders[1].target_reference, "retried")
+            self.assertTrue(targets[1].put_file.called)
+
+    ###########################################################################
+    def test_s3_server_side_copy(self):
+        def make_target(bucket_name, access_key, region):
+            target = self.mbs.maker.make({'_type': 'S3BucketTarget',
+                                          'bucketName': bucket_name,
+                                          'accessKey': access_key,
+                                          'secretKey': 'secret'})
+            target.load_region = Mock(side_effect=lambda: setattr(
+                target, 'region', region))
+            return target
+
+        source = make_target('source', 'key', 'us-east-1')
+        self.assertTrue(make_target('dest', 'key', 'us-east-1')
+                        .can_copy_from(source))
+        self.assertFalse(make_target('dest', 'key', 'eu-west-1')
+                         .can_copy_from(source))
+        self.assertFalse(make_target('dest', 'key2', 'us-east-1')
+                         .can_copy_from(source))
+
+        dest = make_target('dest', 'key', 'us-east-1')
+        dest._bucket = Mock()
+        dest._fetch_file_info = Mock(return_value={
+            'size': 1000, 'cloud_storage_encryption': None})
+        source_ref = mbs.target.FileReference(file_path='foo.tgz',
+                                              file_size=1000)
+        ref = dest.copy_file_from(source, source_ref, 'foo.tgz')
+        dest._bucket.copy_key.assert_called_once_with(
+            'foo.tgz', 'source', 'foo.tgz', encrypt_key=False)
+        self.assertEqual(ref.file_size, 1000)
 
     def test_s3_validate(self):
         target = self.mbs.maker.make({
@@ -87,3 +405,39 @@ class TargetTest(BaseTest):
         })
         self.assertGreater(len(target.has_sufficient_permissions()), 0)
 
+
+    ###########################################################################
+    def test_multipart_upload_planner(self):
+        gb = 1024 * 1024 * 1024
+        limits = mbs.target.S3_MULTIPART_LIMITS
+
+        # small files are not split below the provider minimum part size
+        planner = mbs.target.MultipartUploadPlanner(20 * 1024 * 1024, limits,
+                                                    concurrency=4)
+        self.assertEqual(planner.initial_part_size, limits.min_part_size)
+
+        # huge files use bigger parts to stay within the part count limit
+        planner = mbs.target.MultipartUploadPlanner(20000 * gb, limits,
+                                                    concurrency=4)
+        self.assertEqual(planner.initial_part_size, 2 * gb)
+        self.assertLessEqual(planner.estimated_part_count, limits.max_parts)
+
+        # slow parts shrink the part size, fast parts grow it back
+        planner = mbs.target.MultipartUploadPlanner(100 * gb, limits,
+                                                    concurrency=4)
+        self.assertEqual(planner.initial_part_size, gb)
+        part_num, offset, size = planner.next_part()
+        self.assertEqual((part_num, offset, size), (1, 0, gb))
+        planner.part_completed(size, mbs.target.MAX_PART_SECONDS + 1)
+        self.assertEqual(planner.next_part(), (2, gb, gb / 2))
+        planner.part_completed(gb / 2, 0)
+        self.assertEqual(planner.next_part(), (3, gb + gb / 2, gb))
+
+        # all parts cover the file exactly
+        total = gb + gb / 2 + gb
+        part = planner.next_part()
+        while part:
+            self.assertEqual(part[1], total)
+            total += part[2]
+            part = planner.next_part()
+        self.assertEqual(total, 100 * gb)
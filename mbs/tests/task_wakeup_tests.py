@@ -0,0 +1,161 @@
+import time
+
+from mock import Mock, patch
+
+import mbs.engine
+import mbs.task_wakeup
+
+from . import BaseTest
+
+
+###############################################################################
+# TaskWakeupChannelTest
+###############################################################################
+class TaskWakeupChannelTest(BaseTest):
+
+    ###########################################################################
+    def _new_channel(self, collection):
+        channel = mbs.task_wakeup.TaskWakeupChannel()
+        channel._collection = collection
+        return channel
+
+    ###########################################################################
+    def test_signal_tasks(self):
+        collection = _FakeWakeupCollection()
+        channel = self._new_channel(collection)
+        channel.signal_tasks("backups", [Mock(id="b1", priority=5),
+                                         Mock(id="b2", priority=2),
+                                         Mock(id="b3", priority=None)])
+        channel.signal("restores", Mock(id="r1", priority=None))
+        channel.signal_tasks("backups", [])
+
+        self.assertEqual(len(collection.docs), 2)
+        self.assertEqual(collection.docs[0]["taskCollection"], "backups")
+        self.assertEqual(collection.docs[0]["taskIds"], ["b1", "b2", "b3"])
+        self.assertEqual(collection.docs[0]["priority"], 2)
+        self.assertEqual(collection.docs[1]["taskIds"], ["r1"])
+        self.assertEqual(collection.docs[1]["priority"], None)
+
+        # polling is the fallback
+        collection.insert_one = Mock(side_effect=Exception("not primary"))
+        channel.signal("backups", Mock(id="b4", priority=None))
+
+    ###########################################################################
+    def test_tail(self):
+        collection = _FakeWakeupCollection()
+        collection.insert_one({"taskCollection": "backups"})
+        # signaled after tail() started
+        collection.new_docs = [{"taskCollection": "restores"},
+                               {"taskCollection": "backups"}]
+        channel = self._new_channel(collection)
+
+        wakeups = []
+        with patch.object(mbs.task_wakeup.time, "sleep"):
+            channel.tail(wakeups.append, lambda: len(wakeups) == 2)
+
+        # wakeups signaled before tail() are skipped
+        self.assertEqual(wakeups, ["restores", "backups"])
+        self.assertEqual(collection.queries, [{"_id": {"$gt": 1}}])
+
+    ###########################################################################
+    def test_tail_resumes_after_errors(self):
+        collection = _FakeWakeupCollection()
+        collection.find_one_errors = [Exception("no primary")]
+        collection.find_errors = [Exception("connection reset")]
+        collection.new_docs = [{"taskCollection": "backups"}]
+        channel = self._new_channel(collection)
+
+        wakeups = []
+
+        def on_wakeup(task_collection_name):
+            wakeups.append(task_collection_name)
+            # signaled while the cursor is dead
+            if len(wakeups) == 1:
+                collection.insert_one({"taskCollection": "restores"})
+
+        with patch.object(mbs.task_wakeup.time, "sleep") as sleep_mock:
+            channel.tail(on_wakeup, lambda: len(wakeups) == 2)
+
+        self.assertEqual(wakeups, ["backups", "restores"])
+        # the failed read of the last wakeup id is retried and the cursor
+        # resumes after the last wakeup received
+        self.assertEqual(collection.queries, [{}, {}, {"_id": {"$gt": 1}}])
+        self.assertEqual(sleep_mock.call_count, 3)
+
+
+###############################################################################
+# TaskWakeupListenerTest
+###############################################################################
+class TaskWakeupListenerTest(BaseTest):
+
+    ###########################################################################
+    def test_wakeup_ends_processor_wait(self):
+        processor = mbs.engine.TaskQueueProcessor("Backups", "Backup",
+                                                  "backups", Mock(),
+                                                  sleep_time=25)
+        listener = mbs.task_wakeup.TaskWakeupListener(
+            Mock(), {"backups": processor})
+
+        listener._on_wakeup("restores")
+        self.assertFalse(processor._wakeup_event.is_set())
+        listener._on_wakeup("backups")
+
+        start = time.time()
+        processor._wait_for_next_tick()
+        self.assertLess(time.time() - start, 1)
+        self.assertFalse(processor._wakeup_event.is_set())
+
+
+###############################################################################
+# _FakeWakeupCollection
+###############################################################################
+class _FakeWakeupCollection(object):
+    """
+        Capped collection stand in. Cursors die once they return all
+        matching docs
+    """
+    ###########################################################################
+    def __init__(self):
+        self.docs = []
+        self.new_docs = []
+        self.queries = []
+        self.find_errors = []
+        self.find_one_errors = []
+
+    ###########################################################################
+    def insert_one(self, doc):
+        doc["_id"] = len(self.docs) + 1
+        self.docs.append(doc)
+
+    ###########################################################################
+    def find_one(self, sort=None):
+        if self.find_one_errors:
+            raise self.find_one_errors.pop(0)
+        last = self.docs[-1] if self.docs else None
+        for doc in self.new_docs:
+            self.insert_one(doc)
+        self.new_docs = []
+        return last
+
+    ###########################################################################
+    def find(self, q, **kwargs):
+        self.queries.append(q)
+        if self.find_errors:
+            raise self.find_errors.pop(0)
+        last_id = q["_id"]["$gt"] if q else 0
+        return _FakeCursor([doc for doc in self.docs if doc["_id"] > last_id])
+
+
+###############################################################################
+class _FakeCursor(object):
+
+    ###########################################################################
+    def __init__(self, docs):
+        self._docs = docs
+        self.alive = True
+
+    ###########################################################################
+    def __iter__(self):
+        for doc in self._docs:
+            yield doc
+        self.alive = False
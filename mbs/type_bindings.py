@@ -15,6 +15,7 @@ TYPE_BINDINGS = {
     "CompositeSchedule": "mbs.schedule.CompositeSchedule",
     "Strategy": "mbs.strategy.BackupStrategy",
     "DumpStrategy": "mbs.strategy.DumpStrategy",
+    "OplogIncrementalStrategy": "mbs.strategy.OplogIncrementalStrategy",
     "CloudBlockStorageStrategy": "mbs.strategy.CloudBlockStorageStrategy",
     "EbsVolumeStorageStrategy": "mbs.strategy.EbsVolumeStorageStrategy",
     "HybridStrategy": "mbs.strategy.HybridStrategy",
@@ -33,6 +34,9 @@ TYPE_BINDINGS = {
     "S3BucketTarget": "mbs.target.S3BucketTarget",
     "RackspaceCloudFilesTarget": "mbs.target.RackspaceCloudFilesTarget",
     "FileReference": "mbs.target.FileReference",
+    "ChunkManifestReference": "mbs.target.ChunkManifestReference",
+    "IndexedArchiveReference": "mbs.target.IndexedArchiveReference",
+    "UploadLedger": "mbs.target.UploadLedger",
     "EbsSnapshotReference": "mbs.target.EbsSnapshotReference",
     "CompositeBlockStorageSnapshotReference":
         "mbs.target.CompositeBlockStorageSnapshotReference",
@@ -43,6 +47,13 @@ TYPE_BINDINGS = {
     "RetainLastNPolicy": "mbs.retention.policy.RetainLastNPolicy",
     "RetainMaxTimePolicy": "mbs.retention.policy.RetainMaxTimePolicy",
     "PlanScheduleAuditor": "mbs.auditors.PlanScheduleAuditor",
+    "TaskWakeupChannel": "mbs.task_wakeup.TaskWakeupChannel",
+    "BandwidthGovernor": "mbs.bandwidth.BandwidthGovernor",
+    "ArchiveCache": "mbs.archive_cache.ArchiveCache",
+    "GzipCodec": "mbs.compression.GzipCodec",
+    "PigzCodec": "mbs.compression.PigzCodec",
+    "ZstdCodec": "mbs.compression.ZstdCodec",
+    "Lz4Codec": "mbs.compression.Lz4Codec",
     "PlanRetentionAuditor": "mbs.auditors.PlanRetentionAuditor",
     "AuditReport": "mbs.audit.AuditReport",
     "AuditEntry": "mbs.audit.AuditEntry",